@@ -0,0 +1,97 @@
+"""Recorded (vcrpy) SDMX responses and a local HTTP server to replay them."""
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit
+
+import yaml
+
+CASSETTE_DIR = 'application/tests/vcr_cassette'
+
+NOT_FOUND = (404, {}, b'Not found')
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server has its own one from Python 3.7 on
+    daemon_threads = True
+
+
+def load_cassette(*paths):
+    """Responses ``(status, headers, body)`` of the cassettes in ``paths`` by request URI."""
+    responses = {}
+    for path in paths:
+        with open(path) as f:
+            cassette = yaml.load(f, Loader=yaml.Loader)
+        for interaction in cassette['interactions']:
+            response = interaction['response']
+            body = response['body']['string']
+            headers = {
+                k: v[0] for k, v in response['headers'].items()
+                if k.lower() in ('content-type', 'content-encoding')}
+            responses[interaction['request']['uri']] = (
+                response['status']['code'], headers, body.encode('utf-8') if isinstance(body, str) else body)
+    return responses
+
+
+def cassette_routes(*paths):
+    """StubServer routes of the cassettes in ``paths``: their responses by path and query."""
+    def route(uri):
+        url = urlsplit(uri)
+        return url.path + (f'?{url.query}' if url.query else '')
+
+    return {route(uri): response for uri, response in load_cassette(*paths).items()}
+
+
+class StubServer(object):
+    """HTTP/1.1 keep-alive server on localhost.
+
+    ``routes`` maps request paths (with their query) to ``(status, headers,
+    body)``, unknown paths are answered with a 404. It can also be a function
+    of the path returning the response.
+    """
+
+    def __init__(self, routes=None):
+        self.routes = {} if routes is None else routes
+        self.requests = 0
+        self.connections = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                stub.connections += 1
+                super().setup()
+
+            def do_GET(self):
+                stub.requests += 1
+                if callable(stub.routes):
+                    status, headers, body = stub.routes(self.path)
+                else:
+                    status, headers, body = stub.routes.get(self.path, NOT_FOUND)
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
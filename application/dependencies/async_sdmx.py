@@ -0,0 +1,237 @@
+import json
+import asyncio
+import functools
+import itertools
+import collections
+import aiohttp
+from application.dependencies.sdmx import (
+    SDMXML, SDMXRequestError, CSVRowFeed, XMLEventFeed, PAUSE, STREAM_CHUNK_SIZE, DEFAULT_HTTP_CONFIG,
+    DEFAULT_PARTITION_CONFIG, DEFAULT_CODELIST_CONCURRENCY, data_format, parse_content)
+from application.dependencies.observations import AsyncObservations
+
+
+def build_async_session(config=None):
+    """Pooled aiohttp session configured like ``build_session``.
+
+    Must be called from a running event loop.
+    """
+    config = {**DEFAULT_HTTP_CONFIG, **(config or {})}
+    connector = aiohttp.TCPConnector(
+        limit=config['pool_connections'] * config['pool_maxsize'], limit_per_host=config['pool_maxsize'])
+    timeout = aiohttp.ClientTimeout(sock_connect=config['connect_timeout'], sock_read=config['read_timeout'])
+    headers = {'Accept-Encoding': 'gzip, deflate' if config['compression'] else 'identity'}
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+
+
+async def async_response(session, url, expected=(200,), **kwargs):
+    resp = await session.get(url, **kwargs)
+
+    if resp.status not in expected:
+        try:
+            raise SDMXRequestError(
+                f'Non 200 HTTP response: {resp.status}: {await resp.text()}')
+        finally:
+            resp.release()
+
+    return resp
+
+
+async def async_request(session, url, **kwargs):
+    resp = await async_response(session, url, **kwargs)
+    try:
+        return parse_content(await resp.read(), resp.headers.get('Content-Type', None))
+    finally:
+        resp.release()
+
+
+async def async_merge_partitions(partitions, concurrency, buffer=DEFAULT_PARTITION_CONFIG['buffer']):
+    """Asynchronous counterpart of ``merge_partitions``."""
+    queues = [asyncio.Queue(buffer) for _ in partitions]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def produce(partition, queue):
+        async with semaphore:
+            try:
+                async for item in partition():
+                    await queue.put((None, item))
+                await queue.put((StopAsyncIteration, None))
+            except Exception as e:
+                await queue.put((e, None))
+
+    tasks = [asyncio.ensure_future(produce(p, q)) for p, q in zip(partitions, queues)]
+    try:
+        for queue in queues:
+            while True:
+                error, item = await queue.get()
+                if error is StopAsyncIteration:
+                    break
+                if error is not None:
+                    raise error
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class AsyncSDMXML(SDMXML):
+    """asyncio flavour of SDMXML sharing its namespaces and parsers.
+
+    Only I/O differs: structures are fetched with ``session`` (an aiohttp
+    ClientSession) and data bodies are fed chunk by chunk into the same
+    incremental parsers, which hand back control whenever a chunk is used up.
+    Structure caching and rate limiting are left to the synchronous client.
+    """
+
+    def __init__(self, root_url, agency_id, version, kind, session,
+                 codelist_concurrency=DEFAULT_CODELIST_CONCURRENCY, missing_values=None, formats=None):
+        super().__init__(
+            root_url, agency_id, version, kind, session=session, codelist_concurrency=codelist_concurrency,
+            missing_values=missing_values, formats=formats)
+        self.agency_dataflows = None
+
+    async def _structure(self, resource, resource_id, parse):
+        return parse(await async_request(self.session, self._structure_url(resource, resource_id)))
+
+    async def dataflows(self):
+        if self.agency_dataflows is None:
+            self.agency_dataflows = await self._structure('dataflow', None, self._build_dataflow)
+        return self.agency_dataflows
+
+    async def dataflow(self, dataflow):
+        result = await self._structure('dataflow', dataflow, self._build_dataflow)
+        if not result:
+            return None
+        return result[0]
+
+    async def _fetch_codelists(self, dimensions, attributes):
+        semaphore = asyncio.Semaphore(self.codelist_concurrency)
+
+        async def get_codelist(code_id):
+            async with semaphore:
+                return await self._structure('codelist', code_id, self._codelist)
+
+        codelists = await asyncio.gather(*[get_codelist(c) for c in self._codelist_ids(dimensions, attributes)])
+        return list(itertools.chain.from_iterable(codelists))
+
+    async def dsd(self, dataflow):
+        dsd = await self._structure('datastructure', dataflow, self._parse_dsd)
+        if dsd['codelist']:
+            return dsd
+        return {
+            **dsd,
+            'codelist': await self._fetch_codelists(dsd['dimensions'], dsd['attributes'])
+        }
+
+    async def _stream(self, resource_id, query=None, params=None, partial=False):
+        url = self._data_url(resource_id, query)
+        headers = {'Accept': self._accept()}
+        resp = await async_response(
+            self.session, url, expected=self._expected_statuses(params, partial), headers=headers, params=params)
+        if resp.status == 404:
+            resp.release()
+            return None
+        return resp
+
+    async def _series(self, resp, dsd):
+        if resp is None:
+            return
+        try:
+            fmt = data_format(resp)
+            if fmt == 'json':
+                for block in self._json_series(json.loads(await resp.read()), dsd):
+                    yield block
+                return
+
+            if fmt == 'csv':
+                feed, parse = CSVRowFeed(), self._csv_series
+            else:
+                feed, parse = XMLEventFeed(tag=self._data_tags()), self._xml_series
+            pending = collections.deque()
+            closed = []
+
+            def source():
+                while True:
+                    while pending:
+                        yield pending.popleft()
+                    if closed:
+                        return
+                    yield PAUSE
+
+            blocks = parse(source(), dsd)
+            async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                pending.extend(feed.feed(chunk))
+                for block in blocks:
+                    if block is PAUSE:
+                        break
+                    yield block
+            pending.extend(feed.close())
+            closed.append(True)
+            for block in blocks:
+                yield block
+        finally:
+            resp.release()
+
+    async def _data(self, resource_id, dsd, query=None, params=None):
+        return AsyncObservations(
+            self._series(await self._stream(resource_id, query, params), dsd),
+            dsd['time_dimension'], dsd['primary_measure'])
+
+    async def _partition_series(self, resource_id, dsd, query, params):
+        async for block in self._series(await self._stream(resource_id, query, params, partial=True), dsd):
+            yield block
+
+    def _partitioned_data(self, resource_id, dsd, keys, partition, params=None):
+        partition = {**DEFAULT_PARTITION_CONFIG, **partition}
+        partitions = [
+            functools.partial(
+                self._partition_series, resource_id, dsd, query, partition_params)
+            for query, partition_params in self._partitions(dsd, keys, partition, params)]
+        return AsyncObservations(
+            async_merge_partitions(partitions, partition['concurrency'], partition['buffer']),
+            dsd['time_dimension'], dsd['primary_measure'])
+
+    async def get_sdmx(self, resource_id, keys={}, partition=None, params=None):
+        df = await self.dataflow(resource_id)
+        dsd_id = df['structure']['id']
+        dsd = await self.dsd(dsd_id)
+        query = self._dict_to_smdx_query(dsd['dimensions'], keys)
+        if partition:
+            data = self._partitioned_data(resource_id, dsd, keys, partition, params)
+        else:
+            data = await self._data(resource_id, dsd, query, params)
+        return {
+            'dataflow': df,
+            'query': query,
+            'data': data,
+            **dsd
+        }
+
+
+async def collect(flows, handle, session=None, concurrency=4, missing_values=None):
+    """Downloads several dataflows concurrently from a single worker.
+
+    ``flows`` are dicts with the keys of a ``dataset`` document (root_url,
+    agency, resource, version, kind, keys and optionally partition and
+    formats). ``handle`` is awaited with each flow and its ``get_sdmx`` result
+    while the download is in progress, so that data can be streamed out.
+    Results of ``handle`` are returned in the order of ``flows``, exceptions
+    included.
+    """
+    own_session = session is None
+    session = session or build_async_session()
+    semaphore = asyncio.Semaphore(concurrency)
+    missing_values = missing_values or {}
+
+    async def collect_flow(f):
+        async with semaphore:
+            req = AsyncSDMXML(
+                f['root_url'], f['agency'], f['version'], f['kind'], session,
+                missing_values=missing_values.get(f['agency'], None), formats=f.get('formats', None))
+            result = await req.get_sdmx(f['resource'], f.get('keys', None) or {}, f.get('partition', None))
+            return await handle(f, result)
+
+    try:
+        return await asyncio.gather(*[collect_flow(f) for f in flows], return_exceptions=True)
+    finally:
+        if own_session:
+            await session.close()
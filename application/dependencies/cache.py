@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import pymongo
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_CONFIG = {
+    'backend': 'mongo',
+    'path': '/tmp/sdmx_cache',
+    'max_age': 60*60,
+    'ttl': 7*24*60*60,
+    'max_entries': 5000
+}
+
+
+# JSON has no tuple: tuples are stored as {"__tuple__": [...]}
+TUPLE = '__tuple__'
+
+
+def cache_key(key):
+    return '|'.join(str(k) if k is not None else '' for k in key)
+
+
+def encode(value):
+    if isinstance(value, tuple):
+        return {TUPLE: [encode(v) for v in value]}
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    if isinstance(value, dict):
+        return {k: encode(v) for k, v in value.items()}
+    return value
+
+
+def dumps(value):
+    """JSON of parsed structures: lists, tuples, dicts and scalars."""
+    return json.dumps(encode(value))
+
+
+def loads(data):
+    return json.loads(data, object_hook=lambda d: tuple(d[TUPLE]) if len(d) == 1 and TUPLE in d else d)
+
+
+class MongoStructureStore(object):
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index('accessed_at')
+
+    def get(self, key):
+        doc = self.collection.find_one({'_id': key})
+        if not doc:
+            return None
+        return {**doc, 'value': loads(doc['value'])}
+
+    def put(self, key, entry):
+        self.collection.replace_one({'_id': key}, {**entry, 'value': dumps(entry['value'])}, upsert=True)
+
+    def touch(self, key, **fields):
+        self.collection.update_one({'_id': key}, {'$set': fields})
+
+    def evict(self, expired_before, max_entries):
+        self.collection.delete_many({'stored_at': {'$lt': expired_before}})
+        extra = self.collection.count_documents({}) - max_entries
+        if extra <= 0:
+            return
+        oldest = self.collection.find({}, {'_id': 1})\
+            .sort('accessed_at', pymongo.ASCENDING).limit(extra)
+        self.collection.delete_many({'_id': {'$in': [d['_id'] for d in oldest]}})
+
+
+class DiskStructureStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{hashlib.md5(key.encode("utf-8")).hexdigest()}.json')
+
+    def get(self, key):
+        try:
+            with open(self._file(key), encoding='utf-8') as f:
+                return loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, entry):
+        tmp = f'{self._file(key)}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(dumps(entry))
+        os.replace(tmp, self._file(key))
+
+    def touch(self, key, **fields):
+        if 'stored_at' in fields:
+            entry = self.get(key)
+            if entry is not None:
+                self.put(key, {**entry, **fields})
+            return
+        try:
+            os.utime(self._file(key))
+        except OSError:
+            pass
+
+    def evict(self, expired_before, max_entries):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                entries.append((os.stat(os.path.join(self.path, name)).st_mtime, name))
+            except OSError:
+                continue
+
+        entries.sort()
+        expired = [e for e in entries if e[0] < expired_before]
+        kept = entries[len(expired):]
+        for _, name in expired + kept[:max(len(kept) - max_entries, 0)]:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+class StructureCache(object):
+    """Parsed structural metadata revalidated with conditional GETs.
+
+    Entries younger than ``max_age`` are served without any request, older
+    ones are revalidated with If-None-Match/If-Modified-Since so that a 304
+    skips both download and parsing. Entries are evicted after ``ttl`` or
+    least recently used first beyond ``max_entries``.
+    """
+
+    def __init__(self, store, max_age=DEFAULT_CACHE_CONFIG['max_age'],
+                 ttl=DEFAULT_CACHE_CONFIG['ttl'], max_entries=DEFAULT_CACHE_CONFIG['max_entries']):
+        self.store = store
+        self.max_age = max_age
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses
+        }
+
+    def _store(self, method, *args, **kwargs):
+        """Calls ``method`` of the store, whose failures count as misses."""
+        try:
+            return getattr(self.store, method)(*args, **kwargs)
+        except Exception as e:
+            _log.warning(f'Structure cache {method} failed: {str(e)}')
+            return None
+
+    def fetch(self, key, request, parse):
+        key = cache_key(key)
+        now = time.time()
+        entry = self._store('get', key)
+
+        if entry is not None and now - entry['stored_at'] < self.max_age:
+            self.hits += 1
+            self._store('touch', key, accessed_at=now)
+            return entry['value']
+
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        resp = request(headers)
+        if resp.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            self._store('touch', key, stored_at=now, accessed_at=now)
+            return entry['value']
+
+        self.misses += 1
+        value = parse(resp)
+        self._store('put', key, {
+            'value': value,
+            'etag': resp.headers.get('ETag', None),
+            'last_modified': resp.headers.get('Last-Modified', None),
+            'stored_at': now,
+            'accessed_at': now
+        })
+        self._store('evict', now - self.ttl, self.max_entries)
+        return value
+
+
+def build_cache(config, database=None):
+    config = {**DEFAULT_CACHE_CONFIG, **(config or {})}
+
+    if config['backend'] == 'mongo' and database is not None:
+        store = MongoStructureStore(database['structure_cache'])
+    elif config['backend'] in ('mongo', 'disk'):
+        _log.info(f'Caching structural metadata on disk in {config["path"]}')
+        store = DiskStructureStore(config['path'])
+    else:
+        raise ValueError(f'Unsupported cache backend: {config["backend"]}')
+
+    return StructureCache(
+        store, max_age=config['max_age'], ttl=config['ttl'], max_entries=config['max_entries'])
@@ -0,0 +1,117 @@
+import hashlib
+from pymongo import UpdateOne
+
+
+def code_ref(row):
+    """Key of a codelist row ``(id, code, code_name, name)``: MD5 of its codelist id and code."""
+    return hashlib.md5(str(row[0:2]).encode('utf-8')).hexdigest()
+
+
+def code_hash(row):
+    return hashlib.md5(str(row[2:4]).encode('utf-8')).hexdigest()
+
+
+class CodelistIndex(object):
+    """Codelist rows ``(id, code, code_name, name)`` grouped by codelist id.
+
+    Maximum and total code lengths are computed once per codelist so that
+    column widths can be inferred without scanning every code again.
+    """
+
+    def __init__(self, rows=()):
+        self.codes = {}
+        self.max_length = {}
+        self.total_length = {}
+        for row in rows:
+            self.add(row)
+
+    @classmethod
+    def of(cls, codelist):
+        if isinstance(codelist, cls):
+            return codelist
+        return cls(codelist)
+
+    def add(self, row):
+        id_, code = row[0], row[1]
+        self.codes.setdefault(id_, []).append(row)
+        self.max_length[id_] = max(self.max_length.get(id_, 1), len(code))
+        self.total_length[id_] = self.total_length.get(id_, 0) + len(code)
+
+    def __contains__(self, id_):
+        return id_ in self.codes
+
+    def __iter__(self):
+        for rows in self.codes.values():
+            yield from rows
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.codes.values())
+
+    def get(self, id_):
+        return self.codes.get(id_, [])
+
+
+class AgencyCodes(object):
+    """Published codes of one agency: a hash of their names by ref, in ``collection``.
+
+    Hashes are loaded once and each codelist is claimed by the first dataset
+    going through it, so that during a publish cycle a codelist is compared
+    at most once per agency and only new or renamed codes are published.
+    New hashes are pending per dataset until its codes were published and
+    ``stage`` stores them along with its checksum, ``commit_codes`` makes them
+    the published ones once the loader acknowledged that checksum.
+    ``release`` gives up the codelists of a dataset which failed.
+    """
+
+    def __init__(self, collection, agency):
+        self.collection = collection
+        self.agency = agency
+        self.hashes = None
+        self.claimed = {}
+        self.pending = {}
+
+    def load(self):
+        if self.hashes is None:
+            self.hashes = {
+                d['ref']: d['hash'] for d in self.collection.find(
+                    {'agency': self.agency, 'hash': {'$exists': True}}, {'ref': 1, 'hash': 1})}
+        return self.hashes
+
+    def delta(self, owner, codelist):
+        """Yields ``(row, ref)`` for the codes of ``codelist`` to publish for dataset ``owner``."""
+        hashes = self.load()
+        pending = self.pending.setdefault(owner, {})
+        for id_, rows in CodelistIndex.of(codelist).codes.items():
+            if self.claimed.setdefault(id_, owner) != owner:
+                continue
+            for row in rows:
+                ref = code_ref(row)
+                digest = code_hash(row)
+                if hashes.get(ref, None) != digest:
+                    pending[ref] = digest
+                    yield row, ref
+
+    def stage(self, owner, checksum):
+        pending = self.pending.pop(owner, None)
+        if not pending:
+            return
+        self.collection.bulk_write([
+            UpdateOne(
+                {'agency': self.agency, 'ref': ref},
+                {'$set': {'pending': {'dataset': owner, 'checksum': checksum, 'hash': digest}}}, upsert=True)
+            for ref, digest in pending.items()], ordered=False)
+
+    def release(self, owner):
+        self.pending.pop(owner, None)
+        self.claimed = {id_: o for id_, o in self.claimed.items() if o != owner}
+
+
+def commit_codes(collection, owner, checksum):
+    """Stores the code hashes staged by dataset ``owner`` with ``checksum``, once it was acknowledged."""
+    requests = [
+        UpdateOne(
+            {'_id': d['_id'], 'pending.checksum': checksum},
+            {'$set': {'hash': d['pending']['hash']}, '$unset': {'pending': ''}})
+        for d in collection.find({'pending.dataset': owner, 'pending.checksum': checksum}, {'pending': 1})]
+    if requests:
+        collection.bulk_write(requests, ordered=False)
@@ -0,0 +1,234 @@
+import time
+import threading
+import collections
+from nameko.dependency_providers import DependencyProvider
+
+DEFAULT_METRICS_CONFIG = {
+    'history': 7
+}
+
+PROMETHEUS_PREFIX = 'sdmx_collector'
+
+
+def metric_key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = collections.Counter()
+
+    def observe(self, stage, seconds):
+        timer = self.timers.get(stage, None)
+        if timer is None:
+            self.timers[stage] = [1, seconds, seconds]
+            return
+        timer[0] += 1
+        timer[1] += seconds
+        if seconds > timer[2]:
+            timer[2] = seconds
+
+    def as_dict(self):
+        return {
+            'timers': {
+                stage: {'count': count, 'seconds': total, 'max': max_}
+                for stage, (count, total, max_) in self.timers.items()},
+            'counters': dict(self.counters)
+        }
+
+
+class Cycle(object):
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.ended_at = None
+        self.stats = Stats()
+        self.datasets = collections.defaultdict(Stats)
+
+    def as_dict(self):
+        return {
+            'started_at': self.started_at,
+            'ended_at': self.ended_at,
+            **self.stats.as_dict(),
+            'datasets': {id_: stats.as_dict() for id_, stats in self.datasets.items()}
+        }
+
+
+class MetricsRegistry(object):
+    """Stage timers and counters, overall and per dataset for the last cycles.
+
+    Timers record self time: a stage measured inside another one is
+    subtracted from its parent, so stages add up to the wall time of the
+    outermost one. ``history`` completed publish cycles are kept.
+    """
+
+    def __init__(self, history=DEFAULT_METRICS_CONFIG['history']):
+        self.totals = Stats()
+        self.running = []
+        self.cycles = collections.deque(maxlen=history)
+
+    def start_cycle(self):
+        cycle = Cycle()
+        self.running.append(cycle)
+        return cycle
+
+    def end_cycle(self, cycle):
+        cycle.ended_at = time.time()
+        self.running.remove(cycle)
+        self.cycles.append(cycle)
+
+    def scope(self, dataset=None, cycle=None):
+        return MetricsScope(self, dataset, cycle)
+
+    def observe(self, stage, seconds, dataset=None, cycle=None):
+        self.totals.observe(stage, seconds)
+        if cycle is not None:
+            cycle.stats.observe(stage, seconds)
+            if dataset is not None:
+                cycle.datasets[dataset].observe(stage, seconds)
+
+    def incr(self, key, value=1, dataset=None, cycle=None):
+        self.totals.counters[key] += value
+        if cycle is not None:
+            cycle.stats.counters[key] += value
+            if dataset is not None:
+                cycle.datasets[dataset].counters[key] += value
+
+    def snapshot(self):
+        return {
+            **self.totals.as_dict(),
+            'running': [c.as_dict() for c in self.running],
+            'cycles': [c.as_dict() for c in self.cycles]
+        }
+
+    def prometheus(self):
+        lines = []
+
+        def family(name, kind, samples):
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name} {kind}')
+            lines.extend(f'{PROMETHEUS_PREFIX}_{metric_key(name, labels)} {value}' for labels, value in samples)
+
+        timers = sorted(self.totals.timers.items())
+        family('stage_seconds_total', 'counter', [({'stage': s}, t[1]) for s, t in timers])
+        family('stage_calls_total', 'counter', [({'stage': s}, t[0]) for s, t in timers])
+
+        counters = collections.defaultdict(list)
+        for key, value in sorted(self.totals.counters.items()):
+            name, _, labels = key.partition('{')
+            counters[name].append((labels, value))
+        for name, samples in counters.items():
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name}_total counter')
+            lines.extend(
+                f'{PROMETHEUS_PREFIX}_{name}_total' + (f'{{{labels}' if labels else '') + f' {value}'
+                for labels, value in samples)
+
+        if self.cycles:
+            last = self.cycles[-1]
+            family('last_cycle_duration_seconds', 'gauge', [({}, last.ended_at - last.started_at)])
+            family('last_cycle_dataset_stage_seconds', 'gauge', [
+                ({'dataset': id_, 'stage': stage}, timer[1])
+                for id_, stats in sorted(last.datasets.items()) for stage, timer in sorted(stats.timers.items())])
+        return '\n'.join(lines) + '\n'
+
+
+class Timer(object):
+
+    __slots__ = ('scope', 'stage', 'stack', 'start')
+
+    def __init__(self, scope, stage):
+        self.scope = scope
+        self.stage = stage
+
+    def __enter__(self):
+        self.stack = self.scope.stack()
+        self.stack.append(0.0)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        children = self.stack.pop()
+        if self.stack:
+            self.stack[-1] += elapsed
+        self.scope.observe(self.stage, elapsed - children)
+
+
+class MetricsScope(object):
+    """Metrics of one dataset within one cycle.
+
+    Timer stacks are thread local, that is green thread local once eventlet
+    has patched threading, so that concurrent partitions do not mix up.
+    """
+
+    def __init__(self, registry, dataset=None, cycle=None):
+        self.registry = registry
+        self.dataset = dataset
+        self.cycle = cycle
+        self.local = threading.local()
+
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def observe(self, stage, seconds):
+        self.registry.observe(stage, seconds, self.dataset, self.cycle)
+
+    def incr(self, name, value=1, **labels):
+        self.registry.incr(metric_key(name, labels), value, self.dataset, self.cycle)
+
+    def timer(self, stage):
+        return Timer(self, stage)
+
+    def meter(self, iterable, stage):
+        """Times each step of ``iterable`` as ``stage``."""
+        items = iter(iterable)
+        while True:
+            with Timer(self, stage):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class NullMetrics(object):
+
+    def observe(self, stage, seconds):
+        pass
+
+    def incr(self, name, value=1, **labels):
+        pass
+
+    def timer(self, stage):
+        return NullTimer()
+
+    def meter(self, iterable, stage):
+        return iterable
+
+
+NULL_METRICS = NullMetrics()
+
+
+class Metrics(DependencyProvider):
+
+    def setup(self):
+        config = {**DEFAULT_METRICS_CONFIG, **(self.container.config.get('METRICS', None) or {})}
+        self.registry = MetricsRegistry(history=config['history'])
+
+    def get_dependency(self, worker_ctx):
+        return self.registry
@@ -0,0 +1,133 @@
+import sys
+import math
+from array import array
+
+
+def intern(value):
+    if value is None:
+        return None
+    return sys.intern(value)
+
+
+DEFAULT_MISSING_VALUES = frozenset(['', '-', '.', '..', ':', 'NaN', 'nan', 'NA', 'N/A', 'n/a'])
+
+
+def to_float(value, missing_values=DEFAULT_MISSING_VALUES):
+    if value is None or value in missing_values:
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def numeric_markers(missing_values):
+    return [m for m in missing_values if not math.isnan(to_float(m, ()))]
+
+
+def coerce_measure(values, missing_values=DEFAULT_MISSING_VALUES):
+    """Converts a whole column of raw measure strings into a float64 array.
+
+    Columns that parse cleanly go through a single C-level ``map(float, ...)``;
+    columns holding missing markers or garbage fall back to per-value
+    handling, where those become NaN. Markers that would parse as numbers
+    (e.g. ``-999``) always take the per-value path.
+    """
+    if not numeric_markers(missing_values):
+        try:
+            return array('d', map(float, values))
+        except (TypeError, ValueError):
+            pass
+    return array('d', [to_float(v, missing_values) for v in values])
+
+
+class SeriesBlock(object):
+    """Observations of one series stored column-wise.
+
+    The series key is kept once per series, the primary measure as a float64
+    array (NaN when missing) and time periods and attribute values as lists of
+    interned strings. Raw measure values are buffered until ``close`` coerces
+    the whole column at once.
+    """
+
+    __slots__ = ('key', 'time', 'raw', 'values', 'attributes')
+
+    def __init__(self, key, attributes=()):
+        self.key = {k: intern(v) for k, v in key.items()}
+        self.time = []
+        self.raw = []
+        self.values = array('d')
+        self.attributes = {a: [] for a in attributes}
+
+    def __len__(self):
+        return len(self.time)
+
+    def append(self, time, value, attributes):
+        self.time.append(intern(time))
+        self.raw.append(value)
+        for a, column in self.attributes.items():
+            column.append(intern(attributes.get(a, None)))
+
+    def close(self, missing_values=DEFAULT_MISSING_VALUES):
+        """Coerces the buffered raw measure column once the series is complete."""
+        if self.raw:
+            self.values.extend(coerce_measure(self.raw, missing_values))
+            self.raw = []
+        return self
+
+    def measure(self, i):
+        value = self.values[i]
+        if math.isnan(value):
+            return None
+        return value
+
+    def rows(self, time_dimension, primary_measure):
+        for i, time in enumerate(self.time):
+            row = dict(self.key)
+            for a, column in self.attributes.items():
+                row[a] = column[i]
+            row[time_dimension] = time
+            row[primary_measure] = self.measure(i)
+            yield row
+
+
+class Observations(object):
+    """Lazy stream of series blocks, iterated as row dicts at the output boundary.
+
+    ``response`` is the HTTP response the blocks are read from, if any.
+    """
+
+    def __init__(self, blocks, time_dimension, primary_measure, response=None):
+        self.blocks = blocks
+        self.time_dimension = time_dimension
+        self.primary_measure = primary_measure
+        self.response = response
+
+    def series(self):
+        return self.blocks
+
+    def close(self):
+        """Releases the response of a stream that will not be read."""
+        if self.response is not None:
+            self.response.close()
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield from block.rows(self.time_dimension, self.primary_measure)
+
+
+class AsyncObservations(object):
+    """Asynchronous counterpart of Observations over an async iterator of blocks."""
+
+    def __init__(self, blocks, time_dimension, primary_measure):
+        self.blocks = blocks
+        self.time_dimension = time_dimension
+        self.primary_measure = primary_measure
+
+    def series(self):
+        return self.blocks
+
+    async def __aiter__(self):
+        async for block in self.blocks:
+            for row in block.rows(self.time_dimension, self.primary_measure):
+                yield row
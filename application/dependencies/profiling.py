@@ -0,0 +1,104 @@
+import time
+import resource
+import tracemalloc
+
+DEFAULT_PROFILE_TOP = 10
+
+
+def rss():
+    """Current resident set size in bytes, None without /proc."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def max_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryProfile(object):
+    """tracemalloc figures and RSS at the stage boundaries of one dataset.
+
+    Each stage records the memory traced when it ends, the traced peak since
+    the previous stage (since the start of tracing before Python 3.9, which
+    can not reset it), the process RSS and the ``top`` allocation sites.
+
+    tracemalloc traces the whole process and its peak is global: profiled
+    datasets are published one at a time.
+    """
+
+    def __init__(self, dataset, top=DEFAULT_PROFILE_TOP):
+        self.dataset = dataset
+        self.top = top
+        self.stages = []
+        self.owner = False
+        self.started_at = None
+        self.last = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.owner = True
+        self._reset_peak()
+        self.started_at = time.time()
+        self.last = time.perf_counter()
+        return self
+
+    def stop(self):
+        if self.owner:
+            tracemalloc.stop()
+            self.owner = False
+
+    @staticmethod
+    def _reset_peak():
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def _top(self):
+        if not self.top:
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+        return [
+            {'where': f'{s.traceback[0].filename}:{s.traceback[0].lineno}', 'size': s.size, 'count': s.count}
+            for s in snapshot.statistics('lineno')[:self.top]]
+
+    def mark(self, stage):
+        if not tracemalloc.is_tracing():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        now = time.perf_counter()
+        self.stages.append({
+            'stage': stage,
+            'seconds': now - self.last,
+            'traced': current,
+            'traced_peak': peak,
+            'rss': rss(),
+            'max_rss': max_rss(),
+            'top': self._top()
+        })
+        self._reset_peak()
+        self.last = time.perf_counter()
+
+    def report(self):
+        peak = max(self.stages, key=lambda s: s['traced_peak'], default=None)
+        return {
+            'dataset': self.dataset,
+            'started_at': self.started_at,
+            'stages': self.stages,
+            'peak_stage': peak['stage'] if peak else None,
+            'max_rss': max_rss()
+        }
+
+
+class NullProfile(object):
+
+    def mark(self, stage):
+        pass
+
+
+NULL_PROFILE = NullProfile()
@@ -1,7 +1,24 @@
+import csv
+import json
+import time
+import codecs
+import random
+import email.utils
+import functools
 import itertools
 import requests
+import eventlet
+from eventlet.greenpool import GreenPool
+from eventlet.queue import LightQueue
+from eventlet.semaphore import Semaphore
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 from lxml import etree
+from pymongo import MongoClient
 from nameko.dependency_providers import DependencyProvider
+from application.dependencies.cache import build_cache
+from application.dependencies.metrics import NULL_METRICS
+from application.dependencies.observations import SeriesBlock, Observations, DEFAULT_MISSING_VALUES
 
 STRUCTURE_NAMESPACES = {
     '2.1': {
@@ -57,44 +74,411 @@ XMLS = (
     'application/vnd.sdmx.genericdata+xml'
 )
 
+DATA_MEDIA_TYPES = {
+    'csv': 'application/vnd.sdmx.data+csv;version=1.0.0',
+    'json': 'application/vnd.sdmx.data+json;version=1.0.0',
+    'xml': None
+}
+
+XML_DATA_MEDIA_TYPES = {
+    'specific': 'application/vnd.sdmx.structurespecificdata+xml;version=2.1',
+    'generic': 'application/vnd.sdmx.genericdata+xml;version=2.1'
+}
+
 PREFIX_ALIASES = {
     'com': 'common',
     'str': 'structure',
     'mes': 'messsage'
 }
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+DEFAULT_CODELIST_CONCURRENCY = 8
+
+DEFAULT_PARTITION_CONFIG = {
+    'size': 10,
+    'concurrency': 4,
+    'buffer': 16
+}
+
+DEFAULT_HTTP_CONFIG = {
+    'pool_connections': 10,
+    'pool_maxsize': 10,
+    'pool_block': False,
+    'compression': True,
+    'connect_timeout': 10,
+    'read_timeout': 300,
+    'retries': 3,
+    'retry_statuses': [429, 500, 502, 503, 504],
+    'backoff_factor': 1,
+    'backoff_max': 120,
+    'rate': None,
+    'burst': 1
+}
+
 
 class SDMXRequestError(Exception):
     pass
 
 
-def parse_response(resp, content_type):
+def parse_content(content, content_type):
     clean_type = content_type.split(';')[0]
     if clean_type in XMLS:
-        return etree.fromstring(resp.content)
+        return etree.fromstring(content)
 
     if clean_type == 'application/json':
-        return resp.json()
+        return json.loads(content)
 
     raise ValueError(f'Unsupported content type: {clean_type}')
 
 
-def sdmx_request(url, **kwargs):
-    resp = requests.get(url, **kwargs)
-
-    if resp.status_code != 200:
+def parse_response(resp, content_type):
+    return parse_content(resp.content, content_type)
+
+
+class TokenBucket(object):
+    """Allows ``rate`` requests per second on average, ``burst`` at once.
+
+    Green threads reserve a token even when none is left and sleep off the
+    debt, so concurrent callers are served in turn without a lock.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            eventlet.sleep(-self.tokens / self.rate)
+
+
+def retry_after(resp):
+    value = resp.headers.get('Retry-After', None)
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class SDMXSession(requests.Session):
+    """Session retrying transient failures of idempotent requests.
+
+    Retried statuses and connection errors wait ``backoff_factor * 2 ** n``
+    seconds with full jitter, or what ``Retry-After`` asks for, capped at
+    ``backoff_max``. Requests to a host are throttled by a token bucket when a
+    ``rate`` is set, and get connect/read timeouts unless given explicitly.
+    Options are looked up by the longest matching ``hosts`` prefix.
+    """
+
+    def __init__(self, config):
+        super().__init__()
+        self.config = config
+        self.hosts = sorted(
+            ((prefix, {**config, **(options or {})}) for prefix, options in (config.get('hosts') or {}).items()),
+            key=lambda h: len(h[0]), reverse=True)
+        self.buckets = {}
+
+    def options(self, url):
+        for prefix, options in self.hosts:
+            if url.lower().startswith(prefix.lower()):
+                return options
+        return self.config
+
+    def throttle(self, url, options):
+        if not options['rate']:
+            return
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(options['rate'], options['burst'])
+        self.buckets[host].acquire()
+
+    def backoff(self, attempt, options, resp=None):
+        delay = random.uniform(0, options['backoff_factor'] * 2 ** attempt)
+        wait = retry_after(resp) if resp is not None else None
+        if wait is not None:
+            delay = max(delay, wait)
+        eventlet.sleep(min(delay, options['backoff_max']))
+
+    def request(self, method, url, *args, **kwargs):
+        options = self.options(url)
+        if kwargs.get('timeout', None) is None:
+            kwargs['timeout'] = (options['connect_timeout'], options['read_timeout'])
+        retries = options['retries'] if method.upper() in ('GET', 'HEAD') else 0
+
+        for attempt in itertools.count():
+            self.throttle(url, options)
+            try:
+                resp = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= retries:
+                    raise
+                self.backoff(attempt, options)
+                continue
+            if resp.status_code not in options['retry_statuses'] or attempt >= retries:
+                return resp
+            resp.close()
+            self.backoff(attempt, options, resp)
+
+
+def build_session(config=None):
+    config = {**DEFAULT_HTTP_CONFIG, **(config or {})}
+
+    def build_adapter(options):
+        return HTTPAdapter(
+            pool_connections=options['pool_connections'],
+            pool_maxsize=options['pool_maxsize'],
+            pool_block=options['pool_block'])
+
+    session = SDMXSession(config)
+    adapter = build_adapter(config)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    for prefix, options in (config.get('hosts') or {}).items():
+        session.mount(prefix, build_adapter({**config, **(options or {})}))
+
+    session.headers['Accept-Encoding'] = 'gzip, deflate' if config['compression'] else 'identity'
+    return session
+
+
+def sdmx_response(url, session=None, expected=(200,), metrics=NULL_METRICS, **kwargs):
+    with metrics.timer('http_request'):
+        resp = (session or requests).get(url, **kwargs)
+    metrics.incr('http_responses', status=resp.status_code)
+    metrics.incr('http_body_bytes', len(resp.content))
+
+    if resp.status_code not in expected:
         raise SDMXRequestError(
             f'Non 200 HTTP response: {resp.status_code}: {resp.text}')
 
+    return resp
+
+
+def sdmx_request(url, session=None, metrics=NULL_METRICS, **kwargs):
+    resp = sdmx_response(url, session=session, metrics=metrics, **kwargs)
+
     content_type = resp.headers.get('Content-Type', None)
 
     return parse_response(resp, content_type)
 
 
+class MeteredResponse(object):
+    """Streamed response whose body reads are timed and counted."""
+
+    def __init__(self, resp, metrics):
+        self.resp = resp
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.resp, name)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for chunk in self.metrics.meter(self.resp.iter_content(chunk_size, decode_unicode), 'http_read'):
+            self.metrics.incr('http_body_bytes', len(chunk))
+            yield chunk
+
+
+def sdmx_stream(url, session=None, expected=(200,), metrics=NULL_METRICS, **kwargs):
+    with metrics.timer('http_request'):
+        resp = (session or requests).get(url, stream=True, **kwargs)
+    metrics.incr('http_responses', status=resp.status_code)
+
+    if resp.status_code not in expected:
+        try:
+            raise SDMXRequestError(
+                f'Non 200 HTTP response: {resp.status_code}: {resp.text}')
+        finally:
+            resp.close()
+
+    return MeteredResponse(resp, metrics)
+
+
+class XMLEventFeed(object):
+
+    def __init__(self, events=('start', 'end'), tag=None):
+        self.parser = etree.XMLPullParser(events=events, tag=tag)
+
+    def feed(self, chunk):
+        self.parser.feed(chunk)
+        return self.parser.read_events()
+
+    def close(self):
+        self.parser.close()
+        return self.parser.read_events()
+
+
+def iter_events(resp, events=('start', 'end'), tag=None):
+    feed = XMLEventFeed(events, tag)
+    try:
+        for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            yield from feed.feed(chunk)
+        yield from feed.close()
+    finally:
+        resp.close()
+
+
+def merge_partitions(partitions, concurrency, buffer=DEFAULT_PARTITION_CONFIG['buffer']):
+    """Runs partition generators concurrently and yields their items in partition order.
+
+    Each partition feeds its own bounded queue, so partitions ahead of the
+    one being consumed prefetch at most ``buffer`` items. The output order
+    does not depend on which download finishes first.
+    """
+    queues = [LightQueue(buffer) for _ in partitions]
+    pool = GreenPool(concurrency)
+    threads = []
+
+    def produce(partition, queue):
+        items = partition()
+        try:
+            for item in items:
+                queue.put((None, item))
+            queue.put((StopIteration, None))
+        except Exception as e:
+            queue.put((e, None))
+        finally:
+            items.close()
+
+    def dispatch():
+        for partition, queue in zip(partitions, queues):
+            threads.append(pool.spawn(produce, partition, queue))
+
+    dispatcher = eventlet.spawn(dispatch)
+    try:
+        for queue in queues:
+            while True:
+                error, item = queue.get()
+                if error is StopIteration:
+                    break
+                if error is not None:
+                    raise error
+                yield item
+    finally:
+        dispatcher.kill()
+        for thread in threads:
+            thread.kill()
+
+
+# Yielded by parsers when their source has no complete event or row yet
+PAUSE = object()
+
+
+class CSVRowFeed(object):
+    """Turns byte chunks into complete CSV rows.
+
+    Lines are only handed to the CSV reader once their quotes are balanced,
+    so quoted values spanning several lines or chunks are parsed whole.
+    """
+
+    def __init__(self, encoding='utf-8-sig'):
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.pending = ''
+        self.lines = []
+        self.quotes = 0
+
+    def _rows(self, lines):
+        complete = []
+        for line in lines:
+            self.lines.append(line + '\n')
+            self.quotes += line.count('"')
+            if self.quotes % 2 == 0:
+                complete.extend(self.lines)
+                self.lines = []
+                self.quotes = 0
+        return list(csv.reader(complete))
+
+    def feed(self, chunk):
+        *lines, self.pending = (self.pending + self.decoder.decode(chunk)).split('\n')
+        return self._rows(lines)
+
+    def close(self):
+        text = self.pending + self.decoder.decode(b'', final=True)
+        self.pending = ''
+        rows = self._rows([text]) if text else []
+        rows.extend(csv.reader(self.lines))
+        self.lines = []
+        return rows
+
+
+def iter_rows(resp):
+    feed = CSVRowFeed()
+    try:
+        for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            yield from feed.feed(chunk)
+        yield from feed.close()
+    finally:
+        resp.close()
+
+
+def read_json(resp):
+    try:
+        return json.loads(b''.join(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE)))
+    finally:
+        resp.close()
+
+
+def data_format(resp):
+    content_type = (resp.headers.get('Content-Type', None) or '').lower()
+    if 'csv' in content_type:
+        return 'csv'
+    if 'json' in content_type:
+        return 'json'
+    return 'xml'
+
+
+def release(element):
+    element.clear(keep_tail=True)
+    parent = element.getparent()
+    if parent is None:
+        return
+    while element.getprevious() is not None:
+        del parent[0]
+
+
+def first_child(node, tag):
+    if node is None:
+        return None
+    for child in node.iterchildren(tag):
+        return child
+    return None
+
+
+def english_name(node, tag):
+    for child in node.iterchildren(tag):
+        if child.get(XML_LANG) == 'en':
+            return child.text
+    return None
+
+
 class SDMXML(object):
 
-    def __init__(self, root_url, agency_id, version, kind):
+    def __init__(self, root_url, agency_id, version, kind, session=None,
+                 codelist_concurrency=DEFAULT_CODELIST_CONCURRENCY, cache=None, catalogue=None,
+                 missing_values=None, formats=None, metrics=None):
         self.root_url = root_url
+        self.metrics = metrics or NULL_METRICS
+        self.formats = tuple(formats or ('xml',))
+        for f in self.formats:
+            if f not in DATA_MEDIA_TYPES:
+                raise ValueError(f'Unsupported data format: {f}')
+        self.missing_values = DEFAULT_MISSING_VALUES | frozenset(missing_values or ())
+        self.session = session
+        self.cache = cache
+        self.catalogue = catalogue
+        self.codelist_concurrency = codelist_concurrency
         self.agency_id = agency_id
         self.version = version
         self.structure_namespaces = STRUCTURE_NAMESPACES[version].get(
@@ -109,170 +493,197 @@ class SDMXML(object):
         self.com_prefix = self._find_prefix('com', self.structure_namespaces)
         self.str_prefix = self._find_prefix('str', self.structure_namespaces)
         self.mes_prefix = self._find_prefix('mes', self.structure_namespaces)
+        self._compile()
 
     def _find_prefix(self, prefix, namespaces):
         if prefix in namespaces:
             return prefix
         return PREFIX_ALIASES[prefix]
 
+    def _compile(self):
+        namespaces = self.structure_namespaces
+        s = self.str_prefix
+        str_ns = f'{{{namespaces[s]}}}'
+        com_ns = f'{{{namespaces[self.com_prefix]}}}' if self.com_prefix in namespaces else str_ns
+
+        self.tags = {
+            'com_name': f'{com_ns}Name',
+            'str_name': f'{str_ns}Name',
+            'structure': f'{str_ns}Structure',
+            'key_family_ref': f'{str_ns}KeyFamilyRef',
+            'key_family_id': f'{str_ns}KeyFamilyID',
+            'key_family_agency_id': f'{str_ns}KeyFamilyAgencyID',
+            'code': f'{str_ns}Code',
+            'local_representation': f'{str_ns}LocalRepresentation',
+            'enumeration': f'{str_ns}Enumeration'
+        }
+
+        if self.kind == 'generic' and 'generic' in self.data_namespaces:
+            gen_ns = f'{{{self.data_namespaces["generic"]}}}'
+            self.tags.update({
+                'series': f'{gen_ns}Series',
+                'series_key': f'{gen_ns}SeriesKey',
+                'value': f'{gen_ns}Value',
+                'obs': f'{gen_ns}Obs',
+                'obs_dimension': f'{gen_ns}ObsDimension',
+                'obs_value': f'{gen_ns}ObsValue'
+            })
+
+        def xpath(path):
+            return etree.XPath(path, namespaces=namespaces)
+
+        if self.version == 'ilo':
+            self.xpaths = {
+                'dataflow': xpath(f'//{s}:Dataflow'),
+                'codelist': xpath(f'.//{s}:CodeList'),
+                'dimension': xpath(f'//{s}:Dimension'),
+                'attribute': xpath(f'//{s}:Attribute'),
+                'time_dimension': xpath(f'//{s}:TimeDimension[1]'),
+                'primary_measure': xpath(f'//{s}:PrimaryMeasure[1]')
+            }
+            return
+        self.xpaths = {
+            'dataflow': xpath(f'//{s}:Dataflow'),
+            'codelist': xpath(f'.//{s}:Codelist'),
+            'dimension': xpath(f'//{s}:DimensionList/{s}:Dimension'),
+            'attribute': xpath(f'//{s}:AttributeList/{s}:Attribute'),
+            'time_dimension': xpath(f'//{s}:DimensionList/{s}:TimeDimension[1]'),
+            'primary_measure': xpath(f'//{s}:MeasureList/{s}:PrimaryMeasure')
+        }
+
     def _build_dataflow(self, tree):
 
         def build_dataflow_21(node):
-            id_ = node.attrib['id']
-            name = node.xpath(
-                f'./{self.com_prefix}:Name[@xml:lang="en"]', namespaces=self.structure_namespaces)
-            structures = node.xpath(f'./{self.str_prefix}:Structure/Ref[1]',
-                                    namespaces=self.structure_namespaces)
-            if not structures:
+            ref = first_child(first_child(node, self.tags['structure']), 'Ref')
+            if ref is None:
                 raise SDMXRequestError(
                     'Can not find structure in dataflow!')
-            struct = {
-                'id': structures[0].attrib['id'],
-                'agency_id': structures[0].attrib['agencyID']
-            }
-
             return {
-                'id': id_,
-                'name': name[0].text if name else None,
-                'structure': struct
+                'id': node.attrib['id'],
+                'name': english_name(node, self.tags['com_name']),
+                'structure': {
+                    'id': ref.attrib['id'],
+                    'agency_id': ref.attrib['agencyID']
+                }
             }
 
         def build_dataflow_ilo(node):
-            id_ = node.attrib['id']
-            name = node.xpath(
-                f'./{self.str_prefix}:Name[@xml:lang="en"]', namespaces=self.structure_namespaces)
-            family_ref = node.xpath(
-                f'./{self.str_prefix}:KeyFamilyRef[1]', namespaces=self.structure_namespaces)
-            if not family_ref:
+            family_ref = first_child(node, self.tags['key_family_ref'])
+            if family_ref is None:
                 raise SDMXRequestError(
                     'Can not find structure in dataflow!')
-            struct = {
-                'id': family_ref[0].xpath(
-                    f'./{self.str_prefix}:KeyFamilyID[1]', namespaces=self.structure_namespaces)[0].text,
-                'agency_id': family_ref[0].xpath(
-                    f'./{self.str_prefix}:KeyFamilyAgencyID[1]', namespaces=self.structure_namespaces)[0].text
-            }
             return {
-                'id': id_,
-                'name': name[0].text if name else None,
-                'structure': struct
+                'id': node.attrib['id'],
+                'name': english_name(node, self.tags['str_name']),
+                'structure': {
+                    'id': first_child(family_ref, self.tags['key_family_id']).text,
+                    'agency_id': first_child(family_ref, self.tags['key_family_agency_id']).text
+                }
             }
 
-        def build_dataflow(node):
-            if self.version == '2.1':
-                return build_dataflow_21(node)
-            elif self.version == 'ilo':
-                return build_dataflow_ilo(node)
+        if self.version == '2.1':
+            build_dataflow = build_dataflow_21
+        elif self.version == 'ilo':
+            build_dataflow = build_dataflow_ilo
+        else:
             raise ValueError(f'Unsupported version {self.version}')
 
-        return [build_dataflow(n) for n in tree.xpath(
-            f'//{self.str_prefix}:Dataflow', namespaces=self.structure_namespaces)]
+        return [build_dataflow(n) for n in self.xpaths['dataflow'](tree)]
+
+    def _structure_url(self, resource, resource_id):
+        return '/'.join(
+            [self.root_url, resource, self.agency_id] + ([resource_id] if resource_id else []))
+
+    def _structure(self, resource, resource_id, parse):
+        url = self._structure_url(resource, resource_id)
+        metrics = self.metrics
+        if self.cache is None:
+            with metrics.timer('parse_structure'):
+                return parse(sdmx_request(url, session=self.session, metrics=metrics))
+
+        def request(headers):
+            return sdmx_response(url, session=self.session, expected=(200, 304), metrics=metrics, headers=headers)
+
+        def parse_body(resp):
+            with metrics.timer('parse_structure'):
+                return parse(parse_response(resp, resp.headers.get('Content-Type', None)))
+
+        with metrics.timer('structure_cache'):
+            return self.cache.fetch(
+                (self.root_url, resource, self.agency_id, resource_id), request, parse_body)
 
     def dataflows(self):
-        url = f'{self.root_url}/dataflow/{self.agency_id}'
-        root = sdmx_request(url)
-        return self._build_dataflow(root)
+        if self.catalogue is not None:
+            return self.catalogue.dataflows(self)
+        return self._structure('dataflow', None, self._build_dataflow)
 
     def dataflow(self, dataflow):
-        url = f'{self.root_url}/dataflow/{self.agency_id}/{dataflow}'
-        root = sdmx_request(url)
-        result = self._build_dataflow(root)
+        if self.catalogue is not None:
+            df = self.catalogue.dataflow(self, dataflow)
+            if df is not None:
+                return df
+        result = self._structure('dataflow', dataflow, self._build_dataflow)
         if not result:
             return None
         return result[0]
 
-    def _codelistv21(self, tree, dimensions, attributes):
-        codelists = tree.xpath(
-            f'.//{self.str_prefix}:Codelist', namespaces=self.structure_namespaces)
+    def _codelistv21(self, tree):
+        name_tag = self.tags['com_name']
 
         def handle_codelist(node):
             id_ = node.attrib['id']
-
-            def handle_code(code):
-                return (
-                    id_, 
-                    code.attrib['id'], 
-                    node.xpath(
-                        f'./{self.com_prefix}:Name[@xml:lang="en"][1]', namespaces=self.structure_namespaces)[0].text,
-                    code.xpath(
-                        f'./{self.com_prefix}:Name[@xml:lang="en"][1]', namespaces=self.structure_namespaces)[0].text
-                )
-            return [handle_code(c) for c in node.xpath(f'./{self.str_prefix}:Code', namespaces=self.structure_namespaces)]
-
-        if codelists:
-            return list(itertools.chain.from_iterable([handle_codelist(n) for n in codelists]))
-
-        dims = filter(lambda x: x[1] is not None,
-                      itertools.chain(dimensions, attributes))
-
-        def get_codelist(el):
-            _, code_id = el
-            url = f'{self.root_url}/codelist/{self.agency_id}/{code_id}'
-            cl_root = sdmx_request(url)
-            return cl_root.xpath(f'.//{self.str_prefix}:Codelist', namespaces=self.structure_namespaces)
+            name = english_name(node, name_tag)
+            return [
+                (id_, code.attrib['id'], name, english_name(code, name_tag))
+                for code in node.iterchildren(self.tags['code'])]
 
         return list(itertools.chain.from_iterable(
-            [handle_codelist(c) for d in dims for c in get_codelist(d)]))
+            [handle_codelist(n) for n in self.xpaths['codelist'](tree)]))
 
-    def _codelistilo(self, tree, dimensions, attributes):
-        codelists = tree.xpath(
-            './/str:CodeList', namespaces=self.structure_namespaces)
+    def _codelistilo(self, tree):
 
         def handle_codelist(node):
             id_ = node.attrib['id']
+            name = english_name(node, self.tags['str_name'])
+            return [(id_, code.attrib['value'], name) for code in node.iterchildren(self.tags['code'])]
 
-            def handle_code(code):
-                return (id_, code.attrib['value'], node.xpath('./str:Name[@xml:lang="en"][1]', namespaces=self.structure_namespaces)[0].text)
-            return [handle_code(c) for c in node.xpath('./str:Code', namespaces=self.structure_namespaces)]
+        return list(itertools.chain.from_iterable(
+            [handle_codelist(n) for n in self.xpaths['codelist'](tree)]))
 
-        if codelists:
-            return list(itertools.chain.from_iterable([handle_codelist(n) for n in codelists]))
+    def _codelist(self, tree):
+        if self.version == '2.1':
+            return self._codelistv21(tree)
+        if self.version == 'ilo':
+            return self._codelistilo(tree)
 
-        dims = filter(lambda x: x[1] is not None,
-                      itertools.chain(dimensions, attributes))
+    @staticmethod
+    def _codelist_ids(dimensions, attributes):
+        return list(dict.fromkeys(
+            d[1] for d in itertools.chain(dimensions, attributes) if d[1] is not None))
 
-        def get_codelist(el):
-            _, code_id = el
-            url = f'{self.root_url}/codelist/{self.agency_id}/{code_id}'
-            cl_root = sdmx_request(url)
-            return cl_root.xpath('.//str:CodeList', namespaces=self.structure_namespaces)
+    def _fetch_codelists(self, dimensions, attributes):
+        code_ids = self._codelist_ids(dimensions, attributes)
 
-        return list(itertools.chain.from_iterable(
-            [handle_codelist(c) for d in dims for c in get_codelist(d)]))
+        def get_codelist(code_id):
+            return self._structure('codelist', code_id, self._codelist)
 
-    def _codelist(self, tree, dimensions, attributes):
-        if self.version == '2.1':
-            return self._codelistv21(tree, dimensions, attributes)
-        if self.version == 'ilo':
-            return self._codelistilo(tree, dimensions, attributes)
+        pool = GreenPool(self.codelist_concurrency)
+        return list(itertools.chain.from_iterable(pool.imap(get_codelist, code_ids)))
 
     def _dsdv21(self, root):
 
         def handle_node(node):
-            id_ = node.attrib['id']
-            reprs = node.xpath(
-                f'./{self.str_prefix}:LocalRepresentation[1]', namespaces=self.structure_namespaces)
-            if not reprs:
-                return (id_, None)
-            enum = reprs[0].xpath(f'./{self.str_prefix}:Enumeration/Ref[1]',
-                                  namespaces=self.structure_namespaces)
-            if enum:
-                return (id_, enum[0].attrib['id'])
-            return (id_, None)
-
-        dimensions = [
-            handle_node(n) for n in root.xpath(
-                f'//{self.str_prefix}:DimensionList/{self.str_prefix}:Dimension', namespaces=self.structure_namespaces)]
-        attributes = [
-            handle_node(n) for n in root.xpath(
-                f'//{self.str_prefix}:AttributeList/{self.str_prefix}:Attribute', namespaces=self.structure_namespaces)]
-        codelist = self._codelist(root, dimensions, attributes)
-        td_node = root.xpath(
-            f'//{self.str_prefix}:DimensionList/{self.str_prefix}:TimeDimension[1]', namespaces=self.structure_namespaces)
+            enum = first_child(first_child(
+                first_child(node, self.tags['local_representation']), self.tags['enumeration']), 'Ref')
+            return (node.attrib['id'], enum.attrib['id'] if enum is not None else None)
+
+        dimensions = [handle_node(n) for n in self.xpaths['dimension'](root)]
+        attributes = [handle_node(n) for n in self.xpaths['attribute'](root)]
+        codelist = self._codelist(root)
+        td_node = self.xpaths['time_dimension'](root)
         if not td_node:
             raise SDMXRequestError('Time dimension not found!')
-        pm_node = root.xpath(
-            f'//{self.str_prefix}:MeasureList/{self.str_prefix}:PrimaryMeasure', namespaces=self.structure_namespaces)
+        pm_node = self.xpaths['primary_measure'](root)
         if not pm_node:
             raise SDMXRequestError('Primary measure not found')
         return {
@@ -287,19 +698,13 @@ class SDMXML(object):
         def handle_node(node):
             return (node.attrib['conceptRef'], node.attrib.get('codelist', None))
 
-        dimensions = [
-            handle_node(n) for n in root.xpath(
-                f'//{self.str_prefix}:Dimension', namespaces=self.structure_namespaces)]
-        attributes = [
-            handle_node(n) for n in root.xpath(
-                f'//{self.str_prefix}:Attribute', namespaces=self.structure_namespaces)]
-        codelist = self._codelist(root, dimensions, attributes)
-        pm_node = root.xpath(
-            f'//{self.str_prefix}:PrimaryMeasure[1]', namespaces=self.structure_namespaces)
+        dimensions = [handle_node(n) for n in self.xpaths['dimension'](root)]
+        attributes = [handle_node(n) for n in self.xpaths['attribute'](root)]
+        codelist = self._codelist(root)
+        pm_node = self.xpaths['primary_measure'](root)
         if not pm_node:
             raise SDMXRequestError('Primary measure not found!')
-        td_node = root.xpath(
-            f'//{self.str_prefix}:TimeDimension[1]', namespaces=self.structure_namespaces)
+        td_node = self.xpaths['time_dimension'](root)
         if not td_node:
             raise SDMXRequestError('Time dimension not found!')
         return {
@@ -310,66 +715,389 @@ class SDMXML(object):
             'time_dimension': td_node[0].attrib['conceptRef']
         }
 
-    def dsd(self, dataflow):
-        url = f'{self.root_url}/datastructure/{self.agency_id}/{dataflow}'
-        root = sdmx_request(url)
+    def _parse_dsd(self, root):
         if self.version == '2.1':
             return self._dsdv21(root)
         if self.version == 'ilo':
             return self._dsdilo(root)
 
+    def dsd(self, dataflow):
+        dsd = self._structure('datastructure', dataflow, self._parse_dsd)
+        if dsd['codelist']:
+            return dsd
+        return {
+            **dsd,
+            'codelist': self._fetch_codelists(dsd['dimensions'], dsd['attributes'])
+        }
+
     def _dict_to_smdx_query(self, dimensions, keys):
         return '.'.join([
             keys.get(d[0], '') for d in dimensions
         ])
 
-    def _data(self, resource_id, dsd, query=None):
-        if self.kind != 'specific':
+    @staticmethod
+    def _expected_statuses(params, partial):
+        # Filtered requests and partitions may legitimately match nothing (NoResultsFound)
+        return (200, 404) if params or partial else (200,)
+
+    def _stream(self, resource_id, query=None, params=None, partial=False):
+        url = self._data_url(resource_id, query)
+        headers = {'Accept': self._accept()}
+        resp = sdmx_stream(
+            url, session=self.session, expected=self._expected_statuses(params, partial), metrics=self.metrics,
+            headers=headers, params=params)
+        if resp.status_code == 404:
+            resp.close()
+            return None
+        return resp
+
+    def _data_url(self, resource_id, query=None):
+        if self.kind not in XML_DATA_MEDIA_TYPES:
             raise ValueError(f'{self.kind} not supported yet!')
-        headers = {
-            'Accept': 'application/vnd.sdmx.structurespecificdata+xml;version=2.1'
-            if self.kind == 'specific' else 'application/vnd.sdmx.genericdata+xml;version=2.1'}
-        url = f'{self.root_url}/data/{resource_id}/{query or ""}'
-        root = sdmx_request(url, headers=headers)
-
-        def handle_serie(serie):
-            dims = {d[0]: serie.attrib.get(d[0], None) for d in dsd['dimensions']}
-
-            def handle_obs(obs):
-                atts = {a[0]: obs.attrib.get(
-                    a[0], None) for a in dsd['attributes'] 
-                    + [(dsd['time_dimension'], None)] 
-                    + [(dsd['primary_measure'], None)]}
-                return dict(dims, **atts)
-            
-            return [handle_obs(n) for n in serie.xpath(
-                './Obs', namespaces=self.data_namespaces)]
-
-        return itertools.chain.from_iterable(
-            [handle_serie(n) for n in root.xpath(
-                '//Series', namespaces=self.data_namespaces)])
-
-    def get_sdmx(self, resource_id, keys={}):
+        if self.kind == 'generic' and 'generic' not in self.data_namespaces:
+            raise ValueError(f'{self.kind} not supported yet for version {self.version}!')
+        return f'{self.root_url}/data/{resource_id}/{query or ""}'
+
+    def _accept(self):
+        media_types = {**DATA_MEDIA_TYPES, 'xml': XML_DATA_MEDIA_TYPES[self.kind]}
+        return ', '.join(
+            f'{media_types[f]};q={1 - i / 10:.1f}' if i else media_types[f] for i, f in enumerate(self.formats))
+
+    def _data(self, resource_id, dsd, query=None, params=None):
+        return self._observations(self._stream(resource_id, query, params), dsd)
+
+    def _partition_series(self, resource_id, dsd, query, params):
+        yield from self.metrics.meter(
+            self._series(self._stream(resource_id, query, params, partial=True), dsd), 'parse_data')
+
+    def _partitions(self, dsd, keys, partition, params=None):
+        """``(query, params)`` of each partition of a flow.
+
+        Period windows ending before the ``startPeriod`` of ``params``, that of
+        an incremental download, are dropped and the first one starts there.
+        """
+        size = partition['size']
+        params = params or {}
+        dimension = partition.get('dimension', None)
+
+        if dimension:
+            codelists = dict(dsd['dimensions'])
+            if dimension not in codelists:
+                raise ValueError(f'Unknown partition dimension: {dimension}')
+            if keys.get(dimension, None):
+                codes = keys[dimension].split('+')
+            else:
+                codes = [c[1] for c in dsd['codelist'] if c[0] == codelists[dimension]]
+            if not codes:
+                raise ValueError(f'No code to partition {dimension} with')
+            return [
+                (self._dict_to_smdx_query(
+                    dsd['dimensions'], {**keys, dimension: '+'.join(codes[i:i + size])}), params or None)
+                for i in range(0, len(codes), size)]
+
+        if partition.get('start_period', None) is None:
+            raise ValueError('A partition needs either a dimension or a start_period')
+        start = int(partition['start_period'])
+        end = int(partition.get('end_period', None) or time.gmtime().tm_year)
+        query = self._dict_to_smdx_query(dsd['dimensions'], keys)
+        since = params.get('startPeriod', None)
+        first = int(since[:4]) if since and since[:4].isdigit() else None
+        windows = []
+        for year in range(start, end + 1, size):
+            last = min(year + size - 1, end)
+            if first is not None and last < first:
+                continue
+            period = since if first is not None and year <= first else str(year)
+            windows.append((query, {**params, 'startPeriod': period, 'endPeriod': str(last)}))
+        return windows
+
+    def _partitioned_data(self, resource_id, dsd, keys, partition, params=None):
+        """Downloads a flow as several concurrent requests merged into one stream.
+
+        Partitions either split ``dimension`` codes (those of ``keys`` or of its
+        codelist) in groups of ``size``, or split ``start_period`` to
+        ``end_period`` in windows of ``size`` years. Period windows return a
+        series once per window, which series delta publishing does not support.
+        """
+        partition = {**DEFAULT_PARTITION_CONFIG, **partition}
+        partitions = [
+            functools.partial(
+                self._partition_series, resource_id, dsd, query, partition_params)
+            for query, partition_params in self._partitions(dsd, keys, partition, params)]
+        return Observations(
+            self.metrics.meter(
+                merge_partitions(partitions, partition['concurrency'], partition['buffer']), 'partition_wait'),
+            dsd['time_dimension'], dsd['primary_measure'])
+
+    def _observations(self, resp, dsd):
+        return Observations(
+            self.metrics.meter(self._series(resp, dsd), 'parse_data'), dsd['time_dimension'], dsd['primary_measure'],
+            response=resp)
+
+    def _data_tags(self):
+        if self.kind == 'generic':
+            return tuple(self.tags[t] for t in ('series', 'series_key', 'value', 'obs', 'obs_dimension', 'obs_value'))
+        return ('Series', 'Obs')
+
+    def _series(self, resp, dsd):
+        if resp is None:
+            return iter(())
+        fmt = data_format(resp)
+        if fmt == 'csv':
+            return self._csv_series(iter_rows(resp), dsd)
+        if fmt == 'json':
+            return self._json_series(read_json(resp), dsd)
+        return self._xml_series(iter_events(resp, tag=self._data_tags()), dsd)
+
+    def _xml_series(self, events, dsd):
+        if self.kind == 'generic':
+            return self._generic_series(events, dsd)
+        return self._specific_series(events, dsd)
+
+    def _csv_series(self, rows, dsd):
+        """Blocks out of SDMX-CSV rows, the first one being the header.
+
+        Headers may carry labels (``FREQ: Frequency``). Consecutive rows sharing
+        the same dimension values make one block.
+        """
+        dimensions = [d[0] for d in dsd['dimensions']]
+        attributes = [a[0] for a in dsd['attributes']]
+        header = None
+
+        def cell(row, i):
+            if i is None or i >= len(row):
+                return None
+            return row[i] or None
+
+        block = None
+        current = None
+        for row in rows:
+            if row is PAUSE:
+                yield PAUSE
+                continue
+            if not row:
+                continue
+            if header is None:
+                header = row
+                index = {c.split(':', 1)[0].strip(): i for i, c in enumerate(header)}
+                dimension_index = [index.get(d, None) for d in dimensions]
+                attribute_index = [(a, index[a]) for a in attributes if a in index]
+                time_index = index.get(dsd['time_dimension'], None)
+                value_index = index.get(dsd['primary_measure'], None)
+                continue
+            key = tuple(cell(row, i) for i in dimension_index)
+            if key != current:
+                if block is not None:
+                    yield block.close(self.missing_values)
+                block = SeriesBlock(dict(zip(dimensions, key)), attributes)
+                current = key
+            block.append(
+                cell(row, time_index), cell(row, value_index), {a: cell(row, i) for a, i in attribute_index})
+        if block is not None:
+            yield block.close(self.missing_values)
+
+    def _json_series(self, message, dsd):
+        """Blocks out of an SDMX-JSON message, series or flat observations.
+
+        Keys such as ``0:1:0`` index the values of the structure components.
+        The message is decoded at once, JSON being compact enough for it.
+        """
+        dimensions = [d[0] for d in dsd['dimensions']]
+        attributes = [a[0] for a in dsd['attributes']]
+        time_dimension = dsd['time_dimension']
+        root = message.get('data', message)
+        structure = root.get('structure', None) or root['structures'][0]
+
+        def components(items):
+            return [(c['id'], [v.get('id', v.get('name', None)) for v in c['values']]) for c in items]
+
+        series_components = components(structure['dimensions'].get('series', []))
+        obs_components = components(structure['dimensions'].get('observation', []))
+        attribute_components = components(structure.get('attributes', {}).get('observation', []))
+
+        def decode(key, items):
+            return {id_: values[int(i)] for (id_, values), i in zip(items, key.split(':')) if i != ''}
+
+        def observation(obs):
+            attrib = {
+                id_: values[i] if i is not None else None
+                for (id_, values), i in zip(attribute_components, obs[1:])}
+            return obs[0] if obs else None, attrib
+
+        for dataset in root.get('dataSets', []):
+            if 'series' in dataset:
+                for key, series in dataset['series'].items():
+                    series_key = decode(key, series_components)
+                    block = SeriesBlock({d: series_key.get(d, None) for d in dimensions}, attributes)
+                    for obs_key, obs in series.get('observations', {}).items():
+                        value, attrib = observation(obs)
+                        block.append(decode(obs_key, obs_components).get(time_dimension, None), value, attrib)
+                    yield block.close(self.missing_values)
+                continue
+
+            block = None
+            current = None
+            for obs_key, obs in dataset.get('observations', {}).items():
+                key = decode(obs_key, obs_components)
+                series_key = tuple(key.get(d, None) for d in dimensions)
+                if series_key != current:
+                    if block is not None:
+                        yield block.close(self.missing_values)
+                    block = SeriesBlock(dict(zip(dimensions, series_key)), attributes)
+                    current = series_key
+                value, attrib = observation(obs)
+                block.append(key.get(time_dimension, None), value, attrib)
+            if block is not None:
+                yield block.close(self.missing_values)
+
+    def _specific_series(self, events, dsd):
+        dimensions = [d[0] for d in dsd['dimensions']]
+        attributes = [a[0] for a in dsd['attributes']]
+        time_dimension = dsd['time_dimension']
+        primary_measure = dsd['primary_measure']
+        block = None
+
+        for item in events:
+            if item is PAUSE:
+                yield PAUSE
+                continue
+            event, node = item
+            if node.tag == 'Series':
+                if event == 'start':
+                    block = SeriesBlock({d: node.attrib.get(d, None) for d in dimensions}, attributes)
+                else:
+                    yield block.close(self.missing_values)
+                    block = None
+                    release(node)
+            elif event == 'end' and block is not None:
+                attrib = node.attrib
+                block.append(attrib.get(time_dimension, None), attrib.get(primary_measure, None), attrib)
+                release(node)
+
+    def _generic_series(self, events, dsd):
+        """Same blocks as ``_specific_series`` out of a GenericData message.
+
+        Key values, observation dimension, value and attributes are child
+        elements instead of XML attributes, so the parser tracks whether it is
+        inside the series key or an observation. Observations are released as
+        soon as they are read, as for structure specific messages.
+        """
+        dimensions = [d[0] for d in dsd['dimensions']]
+        attributes = [a[0] for a in dsd['attributes']]
+        tags = self.tags
+        block = None
+        key = None
+        obs = None
+
+        for item in events:
+            if item is PAUSE:
+                yield PAUSE
+                continue
+            event, node = item
+            tag = node.tag
+            if event == 'start':
+                if tag == tags['series_key']:
+                    key = {}
+                elif tag == tags['obs']:
+                    obs = {'time': None, 'value': None, 'attributes': {}}
+                continue
+
+            if tag == tags['value']:
+                if key is not None:
+                    key[node.attrib.get('id', None)] = node.attrib.get('value', None)
+                elif obs is not None:
+                    obs['attributes'][node.attrib.get('id', None)] = node.attrib.get('value', None)
+            elif tag == tags['series_key']:
+                block = SeriesBlock({d: key.get(d, None) for d in dimensions}, attributes)
+                key = None
+            elif tag == tags['obs_dimension'] and obs is not None:
+                obs['time'] = node.attrib.get('value', None)
+            elif tag == tags['obs_value'] and obs is not None:
+                obs['value'] = node.attrib.get('value', None)
+            elif tag == tags['obs']:
+                if block is not None:
+                    block.append(obs['time'], obs['value'], obs['attributes'])
+                obs = None
+                release(node)
+            elif tag == tags['series']:
+                if block is not None:
+                    yield block.close(self.missing_values)
+                block = None
+                release(node)
+
+    def get_sdmx(self, resource_id, keys={}, partition=None, params=None):
         df = self.dataflow(resource_id)
         dsd_id = df['structure']['id']
         dsd = self.dsd(dsd_id)
         query = self._dict_to_smdx_query(dsd['dimensions'], keys)
+        if partition:
+            data = self._partitioned_data(resource_id, dsd, keys, partition, params)
+        else:
+            data = self._data(resource_id, dsd, query, params)
         return {
             'dataflow': df,
             'query': query,
-            'data': self._data(resource_id, dsd, query),
+            'data': data,
             **dsd
         }
 
 
-class SDMXWrapper(object):
+class DataflowCatalogue(object):
+    """Agency dataflows downloaded once and indexed by dataflow id.
+
+    A catalogue lives as long as the wrapper owning it and its forks, that is
+    one worker and therefore one publish cycle.
+    """
+
+    def __init__(self):
+        self.catalogues = {}
+        self.locks = {}
 
-    def initialize(self, root_url, agency_id, resource_id, version, kind, keys):
-        req = SDMXML(root_url, agency_id, version, kind)
-        self.flow = req.get_sdmx(resource_id, keys)
+    def _load(self, req):
+        key = (req.root_url, req.agency_id, req.version)
+        if key not in self.catalogues:
+            with self.locks.setdefault(key, Semaphore()):
+                if key not in self.catalogues:
+                    flows = req._structure('dataflow', None, req._build_dataflow)
+                    self.catalogues[key] = (flows, {df['id']: df for df in flows})
+        return self.catalogues[key]
 
-        self.agency_dataflows = SDMXML(root_url, agency_id, version, kind)\
-            .dataflows()
+    def dataflows(self, req):
+        return self._load(req)[0]
+
+    def dataflow(self, req, dataflow):
+        return self._load(req)[1].get(dataflow, None)
+
+
+class SDMXWrapper(object):
+
+    def __init__(self, session=None, codelist_concurrency=DEFAULT_CODELIST_CONCURRENCY, cache=None,
+                 catalogue=None, missing_values=None, metrics=None):
+        self.session = session
+        self.metrics = metrics
+        self.codelist_concurrency = codelist_concurrency
+        self.cache = cache
+        self.catalogue = catalogue or DataflowCatalogue()
+        self.missing_values = missing_values or {}
+
+    def fork(self, metrics=None):
+        return SDMXWrapper(
+            session=self.session, codelist_concurrency=self.codelist_concurrency, cache=self.cache,
+            catalogue=self.catalogue, missing_values=self.missing_values, metrics=metrics)
+
+    def initialize(self, root_url, agency_id, resource_id, version, kind, keys, partition=None, params=None,
+                   formats=None):
+        req = SDMXML(
+            root_url, agency_id, version, kind, session=self.session,
+            codelist_concurrency=self.codelist_concurrency, cache=self.cache, catalogue=self.catalogue,
+            missing_values=self.missing_values.get(agency_id, None), formats=formats, metrics=self.metrics)
+        self.flow = req.get_sdmx(resource_id, keys, partition, params)
+        self.agency_dataflows = req.dataflows()
+
+    def cache_stats(self):
+        if self.cache is None:
+            return None
+        return self.cache.stats()
 
     def name(self):
         return self.flow['dataflow']['name']
@@ -401,5 +1129,37 @@ class SDMXWrapper(object):
 
 class SDMX(DependencyProvider):
 
+    def setup(self):
+        config = self.container.config.get('SDMX', {}) or {}
+        self.session = build_session(config.get('http', {}))
+        self.codelist_concurrency = config.get('codelist_concurrency', DEFAULT_CODELIST_CONCURRENCY)
+        self.missing_values = config.get('missing_values', None) or {}
+        self.client = None
+        self.cache = None
+        if config.get('cache'):
+            self.cache = build_cache(config['cache'], self._cache_database())
+
+    def _cache_database(self):
+        config = self.container.config
+        if not config.get('MONGODB_CONNECTION_URL'):
+            return None
+        # Same settings as the MongoDatabase dependency of the service
+        params = {}
+        if config.get('MONGODB_USER'):
+            params['username'] = config['MONGODB_USER']
+            if config.get('MONGODB_PASSWORD'):
+                params['password'] = config['MONGODB_PASSWORD']
+            if config.get('MONGODB_AUTHENTICATION_BASE'):
+                params['authSource'] = config['MONGODB_AUTHENTICATION_BASE']
+        self.client = MongoClient(config['MONGODB_CONNECTION_URL'], **params)
+        return self.client[config.get('MONGODB_DB_NAME', self.container.service_name)]
+
+    def stop(self):
+        self.session.close()
+        if self.client is not None:
+            self.client.close()
+
     def get_dependency(self, worker_ctx):
-        return SDMXWrapper()
+        return SDMXWrapper(
+            session=self.session, codelist_concurrency=self.codelist_concurrency, cache=self.cache,
+            missing_values=self.missing_values)
@@ -0,0 +1,70 @@
+import mmap
+import struct
+import tempfile
+from bson import BSON
+
+DEFAULT_SPILL_BATCH = 500
+
+# Every BSON document starts with its own length as a little endian int32
+BSON_LENGTH = struct.Struct('<i')
+
+
+class RecordSpill(object):
+    """Rows staged in a temporary file as a sequence of BSON batches.
+
+    Rows are appended batch by batch, each batch being a BSON document of at
+    most ``batch_size`` rows, so that only one batch is held in memory while
+    writing. Once written, batches are read back in order through a memory
+    map. The file is removed on ``close``.
+    """
+
+    def __init__(self, directory=None, batch_size=DEFAULT_SPILL_BATCH):
+        self.file = tempfile.TemporaryFile(prefix='sdmx-spill-', dir=directory or None)
+        self.batch_size = batch_size
+        self.pending = []
+        self.rows = 0
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = BSON.encode({'rows': self.pending})
+        self.file.write(data)
+        self.rows += len(self.pending)
+        self.size += len(data)
+        self.pending = []
+
+    def batches(self):
+        self.flush()
+        self.file.flush()
+        if not self.size:
+            return
+        with mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ) as view:
+            offset = 0
+            while offset < self.size:
+                length, = BSON_LENGTH.unpack_from(view, offset)
+                yield BSON(view[offset:offset + length]).decode()['rows']
+                offset += length
+
+    def records(self):
+        for batch in self.batches():
+            yield from batch
+
+    def close(self):
+        self.pending = []
+        self.file.close()
@@ -0,0 +1,73 @@
+import logging
+from eventlet.semaphore import Semaphore
+from nameko.dependency_providers import DependencyProvider
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError, BulkWriteError
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_STATE_CONFIG = {
+    'batch_size': 200
+}
+
+
+class StateWriter(object):
+    """Updates of dataset documents queued and written with bulk_write.
+
+    Updates are written in order, one ordered bulk_write per ``batch_size``
+    updates or whenever ``flush`` is called. Whoever reads a document which
+    may have queued updates flushes first.
+
+    Errors are logged, not raised: an update rejected by Mongo is dropped and
+    the ones behind it are written, all of them are queued again when Mongo
+    can not be reached.
+    """
+
+    def __init__(self, batch_size=DEFAULT_STATE_CONFIG['batch_size']):
+        self.batch_size = batch_size
+        self.pending = []
+        self.collection = None
+        self.lock = Semaphore()
+
+    def update(self, collection, query, update):
+        self.collection = collection
+        self.pending.append(UpdateOne(query, update))
+        if len(self.pending) >= self.batch_size:
+            self.flush(collection)
+
+    def flush(self, collection=None):
+        """Writes the queued updates and returns whether the queue is empty."""
+        collection = collection if collection is not None else self.collection
+        with self.lock:
+            requests, self.pending = self.pending, []
+            while requests:
+                try:
+                    collection.bulk_write(requests, ordered=True)
+                    return True
+                except BulkWriteError as e:
+                    # Updates before the first error were written, the ones after it were not attempted
+                    error = e.details['writeErrors'][0]
+                    _log.error(f'Dropping dataset update {requests[error["index"]]}: {error["errmsg"]}')
+                    requests = requests[error['index'] + 1:]
+                except PyMongoError as e:
+                    _log.error(f'Can not write {len(requests)} dataset updates, queued again: {str(e)}')
+                    self.pending = requests + self.pending
+                    return False
+            return True
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class DatasetUpdates(DependencyProvider):
+
+    def setup(self):
+        config = {**DEFAULT_STATE_CONFIG, **(self.container.config.get('STATE', None) or {})}
+        self.writer = StateWriter(batch_size=config['batch_size'])
+
+    def stop(self):
+        if len(self.writer) and not self.writer.flush():
+            _log.error(f'{len(self.writer)} dataset updates are lost')
+
+    def get_dependency(self, worker_ctx):
+        return self.writer
@@ -0,0 +1,132 @@
+"""Replays one dataset through the publishing pipeline with memory profiling.
+
+SDMX responses come from recorded (vcrpy) cassettes instead of the network,
+nothing is written to MongoDB or RabbitMQ: published messages are only
+serialized and counted. The memory report of the run is printed and
+optionally written as JSON.
+
+    python -m application.replay --dataset dataset.json cassette.yaml [cassette.yaml ...]
+
+``--dataset`` is a JSON document, inline or in a file, with the fields of the
+``dataset`` collection: root_url, agency, resource, version, kind, keys and
+optionally partition and formats.
+"""
+import io
+import os
+import sys
+import json
+import argparse
+from http import HTTPStatus
+
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+from application.cassettes import NOT_FOUND, load_cassette
+from application.dependencies.sdmx import SDMXWrapper, build_session
+from application.dependencies.metrics import MetricsRegistry
+from application.dependencies.state import StateWriter
+from application.services.sdmx_collector import SDMXCollectorService, PublishOptions
+
+
+class CassetteAdapter(HTTPAdapter):
+    """Answers requests with recorded responses, 404 for what was not recorded."""
+
+    def __init__(self, responses):
+        super().__init__()
+        self.responses = responses
+
+    def send(self, request, **kwargs):
+        status, headers, body = self.responses.get(request.url, NOT_FOUND)
+        raw = HTTPResponse(
+            body=io.BytesIO(body), headers=headers, status=status, reason=HTTPStatus(status).phrase,
+            preload_content=False, decode_content=True)
+        return self.build_response(request, raw)
+
+
+class OfflineCollection(object):
+
+    def find(self, *args, **kwargs):
+        return []
+
+    def find_one(self, *args, **kwargs):
+        return None
+
+    def update_one(self, *args, **kwargs):
+        pass
+
+    def bulk_write(self, *args, **kwargs):
+        pass
+
+
+class OfflineDatabase(object):
+
+    def __getitem__(self, name):
+        return OfflineCollection()
+
+
+def replay(dataset, cassettes, chunked=False, series_delta=False, spill=None):
+    """Publishes ``dataset`` out of ``cassettes`` and returns the publish report."""
+    session = build_session({'retries': 0})
+    adapter = CassetteAdapter(load_cassette(*cassettes))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    published = []
+
+    service = SDMXCollectorService()
+    service.sdmx = SDMXWrapper(session=session)
+    service.database = OfflineDatabase()
+    service.metrics = MetricsRegistry()
+    service.updates = StateWriter()
+    service.pub_input = lambda body: published.append(len(body))
+
+    result = service.publish_dataflow(
+        {'keys': {}, **dataset},
+        options=PublishOptions(chunked=chunked, series_delta=series_delta, profile_memory=True, spill=spill))
+    return {**result, 'messages': len(published), 'message_bytes': sum(published)}
+
+
+def print_report(result):
+    def mib(size):
+        return f'{size / 2 ** 20:9.1f}' if size is not None else f'{"-":>9}'
+
+    report = result['memory_profile']
+    print(f'{report["dataset"]}: {result["status"]} in {result["elapsed"]:.1f}s, '
+          f'{result["messages"]} messages of {result["message_bytes"]} bytes')
+    print(f'{"stage":<12} {"seconds":>8} {"traced":>9} {"peak":>9} {"rss":>9} {"max rss":>9}  (MiB)')
+    for stage in report['stages']:
+        print(f'{stage["stage"]:<12} {stage["seconds"]:8.2f} {mib(stage["traced"])} {mib(stage["traced_peak"])}'
+              f' {mib(stage["rss"])} {mib(stage["max_rss"])}')
+    for stage in report['stages']:
+        if stage['stage'] == report['peak_stage']:
+            print(f'\nLargest allocations at the end of {stage["stage"]}:')
+            for top in stage['top']:
+                print(f'{mib(top["size"])} MiB {top["count"]:>9} blocks  {top["where"]}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cassettes', nargs='+', help='vcrpy cassettes holding the SDMX responses')
+    parser.add_argument('--dataset', required=True, help='dataset document, as JSON or a JSON file')
+    parser.add_argument('--chunked', action='store_true', help='publish batches instead of a single message')
+    parser.add_argument('--series-delta', action='store_true')
+    parser.add_argument('--spill', metavar='DIR', help='stage rows on disk in this directory')
+    parser.add_argument('--output', help='write the memory report to this JSON file')
+    args = parser.parse_args(argv)
+
+    if os.path.isfile(args.dataset):
+        with open(args.dataset) as f:
+            dataset = json.load(f)
+    else:
+        dataset = json.loads(args.dataset)
+
+    result = replay(
+        dataset, args.cassettes, chunked=args.chunked, series_delta=args.series_delta, spill=args.spill)
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0 if result['status'] == 'PUBLISHED' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,19 @@
 import logging
 import re
-import math
-import functools
+import time
 import itertools
 import hashlib
-from nameko.dependency_providers import DependencyProvider
+import tempfile
+import collections
+import datetime
+import functools
+import eventlet
+from eventlet.greenpool import GreenPool
+from eventlet.semaphore import Semaphore
+from nameko.dependency_providers import DependencyProvider, Config
 from nameko.rpc import rpc
 from nameko.timer import timer
+from nameko.web.handlers import http
 from nameko.events import event_handler, BROADCAST
 from nameko.messaging import Publisher
 from nameko.constants import PERSISTENT
@@ -15,9 +22,40 @@ from nameko_mongodb import MongoDatabase
 import bson.json_util
 import pymongo
 from application.dependencies.sdmx import SDMX
+from application.dependencies.codelist import CodelistIndex, AgencyCodes, code_ref, commit_codes
+from application.dependencies.metrics import Metrics, NULL_METRICS
+from application.dependencies.profiling import MemoryProfile, NULL_PROFILE
+from application.dependencies.spill import RecordSpill
+from application.dependencies.state import DatasetUpdates
 
 _log = logging.getLogger(__name__)
 
+DEFAULT_PUBLISH_CONFIG = {
+    'concurrency': 4,
+    'agency_concurrency': 2,
+    'dataset_timeout': 60*60,
+    'chunked': False,
+    'series_delta': False,
+    'incremental': False,
+    'incremental_mode': 'start_period',
+    'incremental_lookback': 1,
+    'incremental_full_refresh': 30*24*60*60,
+    'profile_memory': False,
+    'spill': False,
+    'spill_dir': None,
+    'skip_unchanged': False,
+    'force_refresh': 7*24*60*60
+}
+
+INCREMENTAL_MODES = ('start_period', 'updated_after')
+
+DEFAULT_CHUNK_SIZE = 500
+
+PERIOD_PATTERN = re.compile(r'^(\d{4})(?:-([QSTWAD])?(\d{1,3})(?:-(\d{2}))?)?$')
+
+# Months in a reporting period: quarters, semesters and trimesters
+PERIOD_MONTHS = {'Q': 3, 'S': 6, 'T': 4}
+
 
 class ErrorHandler(DependencyProvider):
 
@@ -33,24 +71,174 @@ class SDMXCollectorError(Exception):
     pass
 
 
+class NonContiguousSeriesError(SDMXCollectorError):
+    pass
+
+
+class PublishOptions(object):
+    """How datasets are downloaded and published, out of the PUBLISH config.
+
+    ``chunked`` datasets are published as a header, record batches and a
+    trailer, only their changed series with ``series_delta``. With
+    ``incremental_mode``, only the latest periods are downloaded and
+    published, each with its delete keys. With ``spill``, a directory,
+    rows are staged on disk while the checksum is computed. With
+    ``skip_unchanged``, nothing is published when that checksum is the
+    acknowledged one, unless it was acknowledged more than ``force_refresh``
+    seconds ago.
+    """
+
+    def __init__(self, dataset_timeout=DEFAULT_PUBLISH_CONFIG['dataset_timeout'], chunked=False,
+                 series_delta=False, incremental_mode=None,
+                 incremental_lookback=DEFAULT_PUBLISH_CONFIG['incremental_lookback'], incremental_full_refresh=None,
+                 profile_memory=False, spill=None, skip_unchanged=False, force_refresh=None):
+        self.dataset_timeout = dataset_timeout
+        self.chunked = chunked
+        self.series_delta = series_delta
+        self.incremental_mode = incremental_mode
+        self.incremental_lookback = incremental_lookback
+        self.incremental_full_refresh = incremental_full_refresh
+        self.profile_memory = profile_memory
+        self.spill = spill
+        self.skip_unchanged = skip_unchanged
+        self.force_refresh = force_refresh
+
+    @classmethod
+    def from_config(cls, config, profile_memory=None):
+        config = {**DEFAULT_PUBLISH_CONFIG, **(config or {})}
+        return cls(
+            dataset_timeout=config['dataset_timeout'],
+            chunked=config['chunked'],
+            series_delta=config['series_delta'],
+            incremental_mode=config['incremental_mode'] if config['incremental'] else None,
+            incremental_lookback=config['incremental_lookback'],
+            incremental_full_refresh=config['incremental_full_refresh'],
+            profile_memory=config['profile_memory'] if profile_memory is None else profile_memory,
+            spill=(config['spill_dir'] or tempfile.gettempdir()) if config['spill'] else None,
+            skip_unchanged=config['skip_unchanged'],
+            force_refresh=config['force_refresh'])
+
+    def replace(self, **kwargs):
+        return PublishOptions(**{**vars(self), **kwargs})
+
+
+@functools.lru_cache(maxsize=4096)
+def period_key(period):
+    """Sort key of an SDMX time period: the date it starts, then the period itself.
+
+    Periods of different frequencies compare by their start, e.g.
+    ``2019-Q4`` before ``2019-12``, unknown formats before any other.
+    """
+    match = PERIOD_PATTERN.match(period)
+    start = datetime.date.min
+    if match:
+        year, kind, number, day = match.groups()
+        year = int(year)
+        try:
+            if number is None or kind == 'A':
+                start = datetime.date(year, 1, 1)
+            elif kind in PERIOD_MONTHS:
+                start = datetime.date(year, PERIOD_MONTHS[kind] * (int(number) - 1) + 1, 1)
+            elif kind == 'W':
+                start = datetime.datetime.strptime(f'{year}-W{int(number):02d}-1', '%G-W%V-%u').date()
+            elif kind == 'D':
+                start = datetime.date(year, 1, 1) + datetime.timedelta(days=int(number) - 1)
+            else:
+                start = datetime.date(year, int(number), int(day or 1))
+        except ValueError:
+            pass
+    return start, period
+
+
+def shift_period(period, years):
+    """``period`` moved by ``years`` years, in the same format."""
+    if not PERIOD_PATTERN.match(period):
+        return period
+    shifted = f'{int(period[:4]) + years:04d}{period[4:]}'
+    # No 29th of February in most years
+    return shifted[:-5] + '02-28' if shifted.endswith('-02-29') else shifted
+
+
+class DatasetChecksum(object):
+    """MD5 of a record stream updated row by row, with one digest per series.
+
+    Series are identified by the values of ``series_columns`` joined the way
+    SDMX keys are, e.g. ``A.FR.B1GQ``. The latest value of ``time_column``
+    is kept as well, and whether each series came in one run of rows.
+    """
+
+    def __init__(self, series_columns=(), time_column=None):
+        self.series_columns = series_columns
+        self.time_column = time_column
+        self.hasher = hashlib.md5()
+        self.series = {}
+        self.max_period = None
+        self.contiguous = True
+        self.last_key = None
+
+    def series_key(self, row):
+        return '.'.join(row.get(c, None) or '' for c in self.series_columns)
+
+    def update(self, row):
+        encoded = str(row).encode('utf-8')
+        self.hasher.update(encoded)
+        if self.series_columns:
+            key = self.series_key(row)
+            if key not in self.series:
+                self.series[key] = hashlib.md5()
+            elif key != self.last_key:
+                self.contiguous = False
+            self.last_key = key
+            self.series[key].update(encoded)
+        if self.time_column:
+            period = row.get(self.time_column, None)
+            if period is not None and period != self.max_period and (
+                    self.max_period is None or period_key(period) > period_key(self.max_period)):
+                self.max_period = period
+
+    def track(self, records):
+        for r in records:
+            self.update(r)
+            yield r
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def series_digests(self):
+        return {k: h.hexdigest() for k, h in self.series.items()}
+
+
+def create_indexes(database):
+    database.db['dataset'].create_index(
+        [('agency', pymongo.ASCENDING), ('resource', pymongo.ASCENDING)])
+    database.db['dataset'].create_index('id')
+    database.db['codelist'].create_index(
+        [('agency', pymongo.ASCENDING), ('ref', pymongo.ASCENDING)], unique=True)
+    database.db['codelist'].create_index('pending.dataset')
+    database.db['series'].create_index(
+        [('dataset', pymongo.ASCENDING), ('key', pymongo.ASCENDING)], unique=True)
+
+
 class SDMXCollectorService(object):
     name = 'sdmx_collector'
-    database = MongoDatabase(result_backend=False)
+    database = MongoDatabase(result_backend=False, on_after_setup=create_indexes)
+    updates = DatasetUpdates()
     sdmx = SDMX()
     error = ErrorHandler()
+    config = Config()
+    metrics = Metrics()
     pub_input = Publisher(exchange=Exchange(
         name='all_inputs', type='topic', durable=True, auto_delete=True, delivery_mode=PERSISTENT))
     pub_notif = Publisher(exchange=Exchange(
         name='all_notifications', type='topic', durable=True, auto_delete=True, delivery_mode=PERSISTENT))
 
-    def add_dataflow(self, root_url, agency_id, resource_id, version, kind, keys):
+    def add_dataflow(self, root_url, agency_id, resource_id, version, kind, keys, partition=None, formats=None):
         try:
             self.sdmx.initialize(root_url, agency_id, resource_id, version, kind, keys)
         except Exception as e:
             raise SDMXCollectorError(str(e))
-        self.database['dataset'].create_index(
-            [('agency', pymongo.ASCENDING), ('resource', pymongo.ASCENDING)])
-        self.database['dataset'].create_index('id')
+        # The data request only validates the dataflow, its body is downloaded when published
+        self.sdmx.data().close()
         _id = SDMXCollectorService.table_name(agency_id, resource_id)
         doc = {
             'agency': agency_id,
@@ -59,6 +247,8 @@ class SDMXCollectorService(object):
             'version': version,
             'kind': kind,
             'keys': keys or {},
+            'partition': partition or None,
+            'formats': formats or None,
             'root_url': root_url
         }
         self.database['dataset'].update_one(
@@ -66,8 +256,16 @@ class SDMXCollectorService(object):
         return _id
 
     def get_dataflows(self):
+        self.updates.flush(self.database['dataset'])
         return self.database['dataset'].find({})
 
+    def find_dataset(self, query, projection=None):
+        self.updates.flush(self.database['dataset'])
+        return self.database['dataset'].find_one(query, projection)
+
+    def update_dataset(self, query, update):
+        self.updates.update(self.database['dataset'], query, update)
+
     @staticmethod
     def clean(l):
         return re.sub(r'[^0-9a-zA-Z_]+', '_', l)
@@ -80,19 +278,15 @@ class SDMXCollectorService(object):
     def to_table_meta(meta, provider, dataflow):
         table_name = SDMXCollectorService.table_name(provider, dataflow)
 
-        codelist = meta['codelist']
+        codelist = CodelistIndex.of(meta['codelist'])
 
         def handle_dim_att(d, is_dim = True):
             name, code = d
-            cl = [c for c in codelist if c[0] == code]
-            if not cl:
+            if code not in codelist:
                 return (SDMXCollectorService.clean(name), 'TEXT')
             if is_dim:
-                size = functools.reduce(lambda x, y: len(
-                    y[1]) if len(y[1]) > x else x, cl, 1)
-                return (SDMXCollectorService.clean(name), f'VARCHAR({size})')
-            size = functools.reduce(lambda x, y: x + len(y[1]), cl, 0)
-            return (SDMXCollectorService.clean(name), f'VARCHAR({size})')
+                return (SDMXCollectorService.clean(name), f'VARCHAR({codelist.max_length[code]})')
+            return (SDMXCollectorService.clean(name), f'VARCHAR({codelist.total_length[code]})')
 
         table_meta = [handle_dim_att(d) for d in meta['dimensions'] if d[1]]
         table_meta = table_meta + [handle_dim_att(d, is_dim=False) for d in meta['attributes'] if d[1]]
@@ -106,10 +300,31 @@ class SDMXCollectorService(object):
             'write_policy': 'delete_bulk_insert',
             'meta': table_meta,
             'target_table': table_name,
-            'chunk_size': 500,
+            'chunk_size': DEFAULT_CHUNK_SIZE,
             'delete_keys': {'query': meta['query']}
         }
 
+    @staticmethod
+    def records(meta, observations):
+        clean = SDMXCollectorService.clean
+        dimensions = [(clean(d[0]), d[0]) for d in meta['dimensions'] if d[1]]
+        attributes = [(clean(a[0]), a[0]) for a in meta['attributes'] if a[1]]
+        time_column = clean(meta['time_dimension'])
+        measure_column = clean(meta['primary_measure'])
+        query = meta['query']
+
+        for block in observations.series():
+            key = {c: block.key.get(d, None) for c, d in dimensions}
+            columns = [(c, block.attributes.get(a, None)) for c, a in attributes]
+            for i, period in enumerate(block.time):
+                row = dict(key)
+                for c, column in columns:
+                    row[c] = column[i] if column is not None else None
+                row[time_column] = period
+                row[measure_column] = block.measure(i)
+                row['query'] = query
+                yield row
+
     @staticmethod
     def codelist_table_meta(agency):
         return {
@@ -127,18 +342,87 @@ class SDMXCollectorService(object):
 
     @staticmethod
     def checksum(data):
-        return hashlib.md5(
-            ''.join([str(r) for r in data]).encode('utf-8')).hexdigest()
+        checksum = DatasetChecksum()
+        for r in data:
+            checksum.update(r)
+        return checksum.hexdigest()
 
-    def get_status(self, provider, dataflow, checksum):
-        old = self.database['dataset'].find_one(
-            {'agency': provider, 'resource': dataflow})
+    def get_status(self, provider, dataflow, checksum, state=None):
+        old = state if state is not None else self.find_dataset({'agency': provider, 'resource': dataflow})
         if not old or 'checksum' not in old:
             return 'CREATED'
         if old['checksum'] == checksum:
             return 'UNCHANGED'
         return 'UPDATED'
 
+    @staticmethod
+    def refresh_due(f, force_refresh, now=None):
+        """Whether dataset ``f`` was last acknowledged more than ``force_refresh`` seconds ago."""
+        if not force_refresh:
+            return False
+        acknowledged_at = f.get('acknowledged_at', None)
+        return acknowledged_at is None or (now or time.time()) - acknowledged_at >= force_refresh
+
+    def get_series_digests(self, id_):
+        digests = {
+            d['key']: d['digest'] for d in self.database['series'].find(
+                {'dataset': id_, 'digest': {'$exists': True}}, {'key': 1, 'digest': 1})}
+        return digests or None
+
+    def stage_series_digests(self, id_, checksum, digests):
+        if not digests:
+            return
+        self.database['series'].bulk_write([
+            pymongo.UpdateOne(
+                {'dataset': id_, 'key': key}, {'$set': {'pending': {'checksum': checksum, 'digest': digest}}},
+                upsert=True)
+            for key, digest in digests.items()], ordered=False)
+
+    def commit_series_digests(self, id_, checksum):
+        """Makes the digests staged with ``checksum`` the acknowledged ones of dataset ``id_``."""
+        collection = self.database['series']
+        requests = [
+            pymongo.UpdateOne(
+                {'_id': d['_id'], 'pending.checksum': checksum},
+                {'$set': {'digest': d['pending']['digest'], 'checksum': checksum}, '$unset': {'pending': ''}})
+            for d in collection.find({'dataset': id_, 'pending.checksum': checksum}, {'pending': 1})]
+        if not requests:
+            return
+        collection.bulk_write(requests, ordered=False)
+        # Series which are not in the acknowledged dataset anymore, nor staged since
+        collection.delete_many({'dataset': id_, 'checksum': {'$ne': checksum}, 'pending': {'$exists': False}})
+
+    def stage_incremental(self, id_, checksum, fetched_at, max_period, incremental):
+        self.update_dataset(
+            {'id': id_}, {'$set': {'pending_incremental': {
+                'checksum': checksum,
+                'fetched_at': fetched_at,
+                'max_period': max_period,
+                'incremental': incremental
+            }}})
+
+    @staticmethod
+    def incremental_params(f, mode, lookback=DEFAULT_PUBLISH_CONFIG['incremental_lookback'], full_refresh=None,
+                           now=None):
+        """Query parameters downloading dataset ``f`` incrementally, None to download it whole.
+
+        ``start_period`` downloads start ``lookback`` years before the latest
+        period loaded, so that revised periods are loaded again. Datasets are
+        downloaded whole when their last whole download was acknowledged more
+        than ``full_refresh`` seconds ago.
+        """
+        if mode not in INCREMENTAL_MODES:
+            raise ValueError(f'Unsupported incremental mode: {mode}')
+        state = f.get('incremental', None) or {}
+        if full_refresh and (
+                state.get('full_at', None) is None or (now or time.time()) - state['full_at'] >= full_refresh):
+            return None
+        if mode == 'updated_after' and state.get('fetched_at', None):
+            return {'updatedAfter': state['fetched_at']}
+        if mode == 'start_period' and state.get('max_period', None):
+            return {'startPeriod': shift_period(state['max_period'], -lookback)}
+        return None
+
     @staticmethod
     def dataflow_to_entity(df):
         return {
@@ -149,46 +433,50 @@ class SDMXCollectorService(object):
             'informations': df
         }
 
-    def get_dataset(self, root_url, agency, resource, version, kind, keys):
-        self.sdmx.initialize(root_url, agency, resource, version, kind, keys)
+    @staticmethod
+    def chunks(records, size):
+        records = iter(records)
+        while True:
+            chunk = list(itertools.islice(records, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def prepare_dataset(self, root_url, agency, resource, version, kind, keys, sdmx=None, partition=None,
+                        params=None, formats=None, codes=None):
+        """Downloads the structures of a dataset and prepares its records.
+
+        Records and codelist rows are generators. With ``codes``, the
+        AgencyCodes of the agency, only the codes it did not publish yet are
+        produced.
+        """
+        sdmx = sdmx or self.sdmx
+        sdmx.initialize(
+            root_url, agency, resource, version, kind, keys, partition=partition, params=params, formats=formats)
         meta = {
-            'name': self.sdmx.name(),
-            'codelist': self.sdmx.codelist(),
-            'dimensions': self.sdmx.dimensions(),
-            'attributes': self.sdmx.attributes(),
-            'primary_measure': self.sdmx.primary_measure(),
-            'time_dimension': self.sdmx.time_dimension(),
-            'query': self.sdmx.query()
+            'name': sdmx.name(),
+            'codelist': CodelistIndex(sdmx.codelist()),
+            'dimensions': sdmx.dimensions(),
+            'attributes': sdmx.attributes(),
+            'primary_measure': sdmx.primary_measure(),
+            'time_dimension': sdmx.time_dimension(),
+            'query': sdmx.query()
         }
         table_meta = SDMXCollectorService.to_table_meta(
             meta, agency, resource)
-        
-        def handle_number(m, v):
-            if m.lower() in ('float', 'double'):
-                try:
-                    d = float(v)
-                    if math.isnan(d):
-                        return None
-                    return d
-                except:
-                    return None
-            return v
-
-        data = [{k[0]: handle_number(k[1], r.get(k[0], None)
-                if k[0] != 'query' else meta['query'])
-                for k in table_meta['meta']}
-                for r in self.sdmx.data()]
+        data = SDMXCollectorService.records(meta, sdmx.data())
 
         codelist_meta = SDMXCollectorService.codelist_table_meta(agency)
+        columns = [m[0] for m in codelist_meta['meta']]
+        if codes is None:
+            codelist = (dict(zip(columns, r + (code_ref(r),))) for r in meta['codelist'])
+        else:
+            codelist = (dict(zip(columns, r + (ref,))) for r, ref in codes.delta(
+                table_meta['target_table'], meta['codelist']))
 
-        def hash_row(row):
-            h = hashlib.md5(str(row).encode('utf-8'))
-            return h.hexdigest()
-        codelist = [dict(zip(
-            [m[0] for m in codelist_meta['meta']], r + (hash_row(r[0:2]),))) for r in meta['codelist']]
-
-        checksum = SDMXCollectorService.checksum(data)
         return {
+            'series_columns': [SDMXCollectorService.clean(d[0]) for d in meta['dimensions'] if d[1]],
+            'time_column': SDMXCollectorService.clean(meta['time_dimension']),
             'referential': {
                 'entities': [
                     {
@@ -202,51 +490,528 @@ class SDMXCollectorService(object):
                             'table': table_meta['target_table']
                         }
                     },
-                    *[SDMXCollectorService.dataflow_to_entity(d) for d in self.sdmx.agency_dataflows]
+                    *[SDMXCollectorService.dataflow_to_entity(d) for d in sdmx.agency_dataflows]
                 ]
             },
+            'table_meta': table_meta,
+            'records': data,
+            'codelist_meta': codelist_meta,
+            'codelist': codelist,
+            'id': table_meta['target_table'],
+            'meta': {
+                'type': SDMXCollectorService.clean(agency).lower(),
+                'source': 'sdmx'
+            }
+        }
+
+    def get_dataset(self, root_url, agency, resource, version, kind, keys, options=None, sdmx=None,
+                    partition=None, incremental=None, formats=None, metrics=None, profile=None, codes=None,
+                    state=None):
+        """Downloads a dataset as a single message, None when ``options`` skip it as unchanged.
+
+        With ``incremental`` query parameters, the dataset table is split in
+        one datastore entry per period downloaded, each with delete keys, and
+        None is returned when no period was. ``state`` is the dataset
+        document, when already loaded.
+        """
+        options = options or PublishOptions()
+        metrics = metrics or NULL_METRICS
+        profile = profile or NULL_PROFILE
+        fetched_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        dataset = self.prepare_dataset(
+            root_url, agency, resource, version, kind, keys, sdmx=sdmx, partition=partition, params=incremental,
+            formats=formats, codes=codes)
+        profile.mark('structures')
+        hasher = DatasetChecksum(time_column=dataset['time_column'])
+        if options.spill and not incremental:
+            with SDMXCollectorService.spill_records(
+                    dataset['records'], hasher, options.spill, DEFAULT_CHUNK_SIZE, metrics) as spilled:
+                checksum = hasher.hexdigest()
+                status = self.get_status(agency, resource, checksum, state=state)
+                if options.skip_unchanged and status == 'UNCHANGED':
+                    profile.mark('rows')
+                    metrics.incr('skipped_rows', spilled.rows)
+                    return None
+                with metrics.timer('read_spill'):
+                    data = list(spilled.records())
+        else:
+            data = []
+            for chunk in metrics.meter(
+                    SDMXCollectorService.chunks(dataset['records'], DEFAULT_CHUNK_SIZE), 'build_rows'):
+                with metrics.timer('checksum'):
+                    for r in chunk:
+                        hasher.update(r)
+                data.extend(chunk)
+            metrics.incr('rows', len(data))
+            checksum = hasher.hexdigest()
+            status = 'UPDATED' if incremental else self.get_status(agency, resource, checksum, state=state)
+            if options.skip_unchanged and status == 'UNCHANGED':
+                profile.mark('rows')
+                metrics.incr('skipped_rows', len(data))
+                return None
+        profile.mark('rows')
+        if incremental and hasher.max_period is None:
+            _log.info(f'Dataset {dataset["id"]} has no new period: nothing to publish')
+            return None
+        tables = [{**dataset['table_meta'], 'records': data}]
+        if incremental:
+            series_key = DatasetChecksum(dataset['series_columns']).series_key
+            tables = [
+                {**dataset['table_meta'], 'delete_keys': delete_keys, 'records': list(group)}
+                for delete_keys, group in SDMXCollectorService.period_groups(
+                    dataset, data, series_key if 'updatedAfter' in incremental else None)]
+        codelist = list(dataset['codelist'])
+        profile.mark('codelist')
+        if options.incremental_mode:
+            self.stage_incremental(dataset['id'], checksum, fetched_at, hasher.max_period, bool(incremental))
+        return {
+            'referential': dataset['referential'],
             'datastore': [
+                *tables,
                 {
-                    **table_meta,
-                    'records': data
-                },
-                {
-                    **codelist_meta,
+                    **dataset['codelist_meta'],
                     'records': codelist
                 }
             ],
             'checksum': checksum,
-            'id': table_meta['target_table'],
-            'status': self.get_status(agency, resource, checksum),
-            'meta': {
-                'type': SDMXCollectorService.clean(agency).lower(),
-                'source': 'sdmx'
+            'id': dataset['id'],
+            'status': status,
+            'meta': dataset['meta']
+        }
+
+    @staticmethod
+    def spill_records(records, checksum, directory, size, metrics=NULL_METRICS):
+        """Checksums ``records`` while writing them to a RecordSpill in ``directory``."""
+        spilled = RecordSpill(directory, size)
+        try:
+            for chunk in metrics.meter(SDMXCollectorService.chunks(records, size), 'build_rows'):
+                with metrics.timer('checksum'):
+                    for r in chunk:
+                        checksum.update(r)
+                with metrics.timer('spill'):
+                    spilled.extend(chunk)
+                metrics.incr('rows', len(chunk))
+            with metrics.timer('spill'):
+                spilled.flush()
+        except BaseException:
+            spilled.close()
+            raise
+        metrics.incr('spill_bytes', spilled.size)
+        return spilled
+
+    def series_batches(self, dataset, checksum, old_series, sequence, metrics=NULL_METRICS):
+        table_meta = dataset['table_meta']
+        columns = dataset['series_columns']
+        size = table_meta.get('chunk_size', DEFAULT_CHUNK_SIZE)
+        query = dataset['table_meta']['delete_keys']
+
+        def delete_keys(key):
+            return {**query, **{c: v or None for c, v in zip(columns, key.split('.'))}}
+
+        seen = set()
+        for key, group in itertools.groupby(dataset['records'], key=checksum.series_key):
+            if key in seen:
+                raise NonContiguousSeriesError(f'Series {key} of {dataset["id"]} is not contiguous')
+            seen.add(key)
+            with metrics.timer('build_rows'):
+                records = list(group)
+            with metrics.timer('checksum'):
+                for r in records:
+                    checksum.update(r)
+            metrics.incr('rows', len(records))
+            if old_series.get(key, None) == checksum.series[key].hexdigest():
+                continue
+            for i, chunk in enumerate(SDMXCollectorService.chunks(records, size)):
+                yield {
+                    'part': 'records',
+                    'id': dataset['id'],
+                    'sequence': next(sequence),
+                    'target_table': table_meta['target_table'],
+                    'delete_keys': delete_keys(key) if i == 0 else None,
+                    'records': chunk,
+                    'meta': dataset['meta']
+                }
+
+        for key in old_series.keys() - seen:
+            yield {
+                'part': 'records',
+                'id': dataset['id'],
+                'sequence': next(sequence),
+                'target_table': table_meta['target_table'],
+                'delete_keys': delete_keys(key),
+                'records': [],
+                'meta': dataset['meta']
+            }
+
+    @staticmethod
+    def period_groups(dataset, records, series_key=None):
+        """Sorts ``records`` and groups them by period, and by series with ``series_key``.
+
+        Each group comes with the delete keys of the rows it replaces.
+        """
+        columns = dataset['series_columns']
+        time_column = dataset['time_column']
+        query = dataset['table_meta']['delete_keys']
+        records.sort(key=lambda r: r[time_column] or '')
+
+        def group_key(row):
+            return (row[time_column], series_key(row) if series_key else None)
+
+        for (period, key), group in itertools.groupby(records, key=group_key):
+            delete_keys = {**query, time_column: period}
+            if key is not None:
+                delete_keys.update({c: v or None for c, v in zip(columns, key.split('.'))})
+            yield delete_keys, group
+
+    def period_batches(self, dataset, checksum, sequence, by_series=False, metrics=NULL_METRICS):
+        table_meta = dataset['table_meta']
+        size = table_meta.get('chunk_size', DEFAULT_CHUNK_SIZE)
+
+        with metrics.timer('build_rows'):
+            records = list(dataset['records'])
+        with metrics.timer('checksum'):
+            for r in records:
+                checksum.update(r)
+        metrics.incr('rows', len(records))
+
+        for delete_keys, group in SDMXCollectorService.period_groups(
+                dataset, records, checksum.series_key if by_series else None):
+            for i, chunk in enumerate(SDMXCollectorService.chunks(group, size)):
+                yield {
+                    'part': 'records',
+                    'id': dataset['id'],
+                    'sequence': next(sequence),
+                    'target_table': table_meta['target_table'],
+                    'delete_keys': delete_keys if i == 0 else None,
+                    'records': chunk,
+                    'meta': dataset['meta']
+                }
+
+    def dataset_messages(self, root_url, agency, resource, version, kind, keys, options=None, sdmx=None,
+                         partition=None, incremental=None, formats=None, metrics=None, profile=None, codes=None,
+                         state=None):
+        """Yields a dataset as a header, numbered record batches and a trailer.
+
+        Batches hold at most ``chunk_size`` records of one table, the trailer
+        carries the checksum and status. With ``incremental`` query parameters,
+        only the periods downloaded are published, each with delete keys.
+        ``state`` is the dataset document, when already loaded.
+        """
+        options = options or PublishOptions()
+        metrics = metrics or NULL_METRICS
+        profile = profile or NULL_PROFILE
+        series_delta = options.series_delta
+        if series_delta and partition and not partition.get('dimension', None):
+            # Period windows return every series once per window
+            _log.info(f'Series delta is not supported with period partitions: publishing the whole {resource}')
+            series_delta = False
+        fetched_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        dataset = self.prepare_dataset(
+            root_url, agency, resource, version, kind, keys, sdmx=sdmx, partition=partition, params=incremental,
+            formats=formats, codes=codes)
+        profile.mark('structures')
+        id_ = dataset['id']
+        old_series = self.get_series_digests(id_) if series_delta and not incremental else None
+        table_meta = dataset['table_meta']
+        size = table_meta.get('chunk_size', DEFAULT_CHUNK_SIZE)
+        checksum = DatasetChecksum(dataset['series_columns'], dataset['time_column'])
+        spilled = None
+        skip_unchanged = options.skip_unchanged
+        spill = options.spill
+        if (skip_unchanged or old_series is not None) and not incremental:
+            # Status and series contiguity are known before the header is published
+            spill = spill or tempfile.gettempdir()
+        if spill and not incremental:
+            spilled = SDMXCollectorService.spill_records(dataset['records'], checksum, spill, size, metrics)
+            profile.mark('spill')
+            if skip_unchanged and self.get_status(
+                    agency, resource, checksum.hexdigest(), state=state) == 'UNCHANGED':
+                metrics.incr('skipped_rows', spilled.rows)
+                spilled.close()
+                _log.info(f'Dataset {id_} is unchanged: nothing to publish')
+                return
+            if old_series is not None and not checksum.contiguous:
+                _log.warning(f'Series of {id_} are not contiguous: publishing the whole dataset')
+                old_series = None
+        if old_series is not None or incremental:
+            table_meta = {**table_meta, 'delete_keys': None}
+        yield {
+            'part': 'header',
+            'id': id_,
+            'referential': dataset['referential'],
+            'datastore': [table_meta, dataset['codelist_meta']],
+            'meta': dataset['meta']
+        }
+
+        sequence = itertools.count()
+
+        def batch(chunk):
+            return {
+                'part': 'records',
+                'id': id_,
+                'sequence': next(sequence),
+                'target_table': table_meta['target_table'],
+                'records': chunk,
+                'meta': dataset['meta']
+            }
+
+        if incremental:
+            yield from self.period_batches(
+                dataset, checksum, sequence, by_series='updatedAfter' in incremental, metrics=metrics)
+        elif spilled is not None:
+            try:
+                if old_series is not None:
+                    # Series digests are computed again while reading back
+                    checksum = DatasetChecksum(dataset['series_columns'], dataset['time_column'])
+                    yield from self.series_batches(
+                        {**dataset, 'records': spilled.records()}, checksum, old_series, sequence, metrics=metrics)
+                else:
+                    for chunk in metrics.meter(spilled.batches(), 'read_spill'):
+                        yield batch(chunk)
+            finally:
+                spilled.close()
+        else:
+            for chunk in metrics.meter(SDMXCollectorService.chunks(dataset['records'], size), 'build_rows'):
+                with metrics.timer('checksum'):
+                    for r in chunk:
+                        checksum.update(r)
+                metrics.incr('rows', len(chunk))
+                yield batch(chunk)
+
+        profile.mark('rows')
+        codelist_meta = dataset['codelist_meta']
+        for chunk in SDMXCollectorService.chunks(
+                dataset['codelist'], codelist_meta.get('chunk_size', DEFAULT_CHUNK_SIZE)):
+            yield {
+                'part': 'records',
+                'id': id_,
+                'sequence': next(sequence),
+                'target_table': codelist_meta['target_table'],
+                'records': chunk,
+                'meta': dataset['meta']
             }
+        profile.mark('codelist')
+
+        digest = checksum.hexdigest()
+        if incremental:
+            status = 'UNCHANGED' if checksum.max_period is None else 'UPDATED'
+        else:
+            self.stage_series_digests(id_, digest, checksum.series_digests())
+            status = self.get_status(agency, resource, digest, state=state)
+        self.stage_incremental(id_, digest, fetched_at, checksum.max_period, bool(incremental))
+        if codes is not None:
+            codes.stage(id_, digest)
+        yield {
+            'part': 'trailer',
+            'id': id_,
+            'batches': next(sequence),
+            'checksum': digest,
+            'status': status,
+            'meta': dataset['meta']
         }
 
     def update_checksum(self, id_, checksum):
-        self.database['dataset'].update_one(
-            {'id': id_}, {'$set': {'checksum': checksum}})
+        old = self.find_dataset(
+            {'id': id_}, {'pending_incremental': 1, 'incremental': 1}) or {}
+        updates = {'checksum': checksum, 'acknowledged_at': time.time()}
+        unset = {}
+
+        pending = old.get('pending_incremental', None)
+        if pending and pending['checksum'] == checksum:
+            state = old.get('incremental', None) or {}
+            periods = [p for p in (pending['max_period'], state.get('max_period', None)) if p is not None]
+            updates['incremental'] = {
+                'fetched_at': pending['fetched_at'],
+                'max_period': max(periods, key=period_key) if periods else None,
+                'full_at': state.get('full_at', None) if pending['incremental'] else updates['acknowledged_at']
+            }
+            unset['pending_incremental'] = ''
+            if pending['incremental']:
+                # Partial downloads must not replace the whole dataset checksum
+                del updates['checksum']
+
+        update = {'$set': updates}
+        if unset:
+            update['$unset'] = unset
+        self.update_dataset({'id': id_}, update)
+        self.commit_series_digests(id_, checksum)
+        commit_codes(self.database['codelist'], id_, checksum)
+
+    def publish_messages(self, args, options=None, partition=None, incremental=None, formats=None, metrics=None,
+                         profile=None, codes=None, state=None):
+        """Publishes the messages of a dataset and returns how many bytes were published."""
+        options = options or PublishOptions()
+        metrics = metrics or NULL_METRICS
+        profile = profile or NULL_PROFILE
+        published = 0
+        for message in self.dataset_messages(
+                *args, options=options, sdmx=self.sdmx.fork(metrics=metrics), partition=partition,
+                incremental=incremental, formats=formats, metrics=metrics, profile=profile, codes=codes,
+                state=state):
+            with metrics.timer('serialize'):
+                body = bson.json_util.dumps(message)
+            with metrics.timer('publish'):
+                self.pub_input(body)
+            metrics.incr('messages')
+            metrics.incr('message_bytes', len(body))
+            published += len(body)
+        profile.mark('publish')
+        return published
+
+    def store_published_bytes(self, agency, resource, size):
+        self.update_dataset(
+            {'agency': agency, 'resource': resource}, {'$set': {'published_bytes': size}})
+
+    def store_memory_profile(self, agency, resource, report):
+        self.update_dataset(
+            {'agency': agency, 'resource': resource}, {'$set': {'memory_profile': report}})
+
+    def publish_dataflow(self, f, options=None, cycle=None, codes=None):
+        """Publishes dataset ``f`` and returns its publish report.
+
+        With ``codes``, the AgencyCodes of the agency, only codes not yet
+        published are, and their hashes are stored once the dataset is
+        acknowledged.
+        """
+        options = options or PublishOptions()
+        timeout = options.dataset_timeout
+        agency = f['agency']
+        resource = f['resource']
+        id_ = SDMXCollectorService.table_name(agency, resource)
+        metrics = self.metrics.scope(id_, cycle)
+        profile = MemoryProfile(id_).start() if options.profile_memory else NULL_PROFILE
+        start = time.time()
+        _log.info(
+            f'Downloading dataset {resource} provided by {agency} ...')
+        try:
+            with eventlet.Timeout(timeout):
+                args = (f['root_url'], agency, resource, f['version'], f['kind'], f['keys'])
+                partition = f.get('partition', None)
+                formats = f.get('formats', None)
+                dataset_options = options.replace(skip_unchanged=options.skip_unchanged and not (
+                    SDMXCollectorService.refresh_due(f, options.force_refresh)))
+                incremental = None
+                if options.incremental_mode:
+                    incremental = SDMXCollectorService.incremental_params(
+                        f, options.incremental_mode, lookback=options.incremental_lookback,
+                        full_refresh=options.incremental_full_refresh)
+                if options.chunked:
+                    published = self.publish_messages(
+                        args, options=dataset_options, partition=partition, incremental=incremental,
+                        formats=formats, metrics=metrics, profile=profile, codes=codes, state=f)
+                else:
+                    dataset = self.get_dataset(
+                        *args, options=dataset_options, sdmx=self.sdmx.fork(metrics=metrics), partition=partition,
+                        incremental=incremental, formats=formats, metrics=metrics, profile=profile, codes=codes,
+                        state=f)
+                    published = 0
+                if not options.chunked and dataset is not None:
+                    _log.info(f'Publishing {dataset["id"]} ...')
+                    with metrics.timer('serialize'):
+                        body = bson.json_util.dumps(dataset)
+                    profile.mark('serialize')
+                    with metrics.timer('publish'):
+                        self.pub_input(body)
+                    profile.mark('publish')
+                    metrics.incr('messages')
+                    metrics.incr('message_bytes', len(body))
+                    published = len(body)
+                    if codes is not None:
+                        codes.stage(id_, dataset['checksum'])
+                if published:
+                    self.store_published_bytes(agency, resource, published)
+            if published:
+                status = 'PUBLISHED'
+            else:
+                status = 'UNCHANGED'
+                metrics.incr('skipped_bytes', f.get('published_bytes', None) or 0)
+        except eventlet.Timeout:
+            _log.error(f'Can not handle dataset {resource} provided by {agency}: timed out after {timeout}s')
+            status = 'TIMEOUT'
+        except Exception as e:
+            _log.error(f'Can not handle dataset {resource} provided by {agency}: {str(e)}')
+            status = 'FAILED'
+        if status in ('TIMEOUT', 'FAILED') and codes is not None:
+            codes.release(id_)
+        elapsed = time.time() - start
+        metrics.incr('datasets', status=status)
+        _log.info(f'Dataset {resource} provided by {agency}: {status} in {elapsed:.1f}s')
+        result = {
+            'agency': agency,
+            'resource': resource,
+            'status': status,
+            'elapsed': elapsed
+        }
+        if options.profile_memory:
+            profile.stop()
+            report = {**profile.report(), 'status': status}
+            _log.info(f'Dataset {resource} provided by {agency}: peak memory in stage {report["peak_stage"]}')
+            self.store_memory_profile(agency, resource, report)
+            result['memory_profile'] = report
+        return result
+
+    @staticmethod
+    def interleave(datasets):
+        """Datasets taken in turn from each agency."""
+        agencies = {}
+        for f in datasets:
+            agencies.setdefault(f['agency'], []).append(f)
+        return [f for group in itertools.zip_longest(*agencies.values()) for f in group if f is not None]
 
     @timer(interval=24*60*60)
     @rpc
-    def publish(self):
-        for f in self.get_dataflows():
+    def publish(self, profile_memory=None):
+        config = {**DEFAULT_PUBLISH_CONFIG, **(self.config.get('PUBLISH', None) or {})}
+        options = PublishOptions.from_config(config, profile_memory=profile_memory)
+        concurrency = config['concurrency']
+        if options.profile_memory and concurrency > 1:
+            # tracemalloc traces the whole process, profiles are only per dataset one at a time
+            _log.info('Memory profiling: publishing one dataset at a time')
+            concurrency = 1
+        pool = GreenPool(concurrency)
+        agencies = collections.defaultdict(lambda: Semaphore(config['agency_concurrency']))
+        report = []
+        cycle = self.metrics.start_cycle()
+        codes = {}
+
+        def collect(f, slot):
             agency = f['agency']
-            resource = f['resource']
-            root_url = f['root_url']
-            version = f['version']
-            kind = f['kind']
-            keys = f['keys']
-            _log.info(
-                f'Downloading dataset {resource} provided by {agency} ...')
+            if agency not in codes:
+                codes[agency] = AgencyCodes(self.database['codelist'], agency)
             try:
-                dataset = self.get_dataset(root_url, agency, resource, version, kind, keys)
-            except Exception as e:
-                _log.error(f'Can not handle dataset {resource} provided by {agency}: {str(e)}')
-                continue
-            _log.info('Publishing ...')
-            self.pub_input(bson.json_util.dumps(dataset))
+                report.append(self.publish_dataflow(f, options=options, cycle=cycle, codes=codes[agency]))
+            finally:
+                slot.release()
+
+        # Dataset documents are read at once, their status is then looked up in memory
+        datasets = list(self.get_dataflows())
+        try:
+            for f in SDMXCollectorService.interleave(datasets):
+                # The agency slot is taken first: waiting for it must not hold a pool slot
+                slot = agencies[f['agency']]
+                slot.acquire()
+                pool.spawn_n(collect, f, slot)
+            pool.waitall()
+        finally:
+            self.metrics.end_cycle(cycle)
+            self.updates.flush(self.database['dataset'])
+
+        skipped = cycle.stats.counters
+        _log.info(f'Unchanged datasets: skipped {skipped["skipped_rows"]} rows and {skipped["skipped_bytes"]} bytes')
+        _log.info(f'Structure cache statistics: {self.sdmx.cache_stats()}')
+        return report
+
+    @timer(interval=60)
+    def flush_updates(self):
+        self.updates.flush(self.database['dataset'])
+
+    @rpc
+    def get_metrics(self):
+        return self.metrics.snapshot()
+
+    @http('GET', '/metrics')
+    def prometheus_metrics(self, request):
+        return 200, {'Content-Type': 'text/plain; version=0.0.4'}, self.metrics.prometheus()
 
     @event_handler(
         'loader', 'input_loaded', handler_type=BROADCAST, reliable_delivery=False)
@@ -295,7 +1060,8 @@ class SDMXCollectorService(object):
             return
 
         id_ = self.add_dataflow(
-            config['root_url'], config['agency'], config['resource'], config['version'], config['kind'], config['keys'])
+            config['root_url'], config['agency'], config['resource'], config['version'], config['kind'], config['keys'],
+            partition=config.get('partition', None), formats=config.get('formats', None))
 
         self.pub_notif(bson.json_util.dumps({
             'id': id_,
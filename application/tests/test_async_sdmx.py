@@ -0,0 +1,163 @@
+import eventlet
+eventlet.monkey_patch()
+
+import asyncio
+from urllib.parse import urlsplit
+import vcr
+import pytest
+from application.cassettes import StubServer, cassette_routes
+from application.tests.test_sdmx import PARTITION_DSD, partition_routes
+from application.dependencies.sdmx import SDMXML, SDMXRequestError
+from application.dependencies.async_sdmx import (
+    AsyncSDMXML, build_async_session, async_merge_partitions, collect)
+
+
+def rows(d):
+    return [list(block.rows(d['time_dimension'], d['primary_measure'])) for block in d['data'].series()]
+
+
+async def async_rows(d):
+    rows = []
+    async for block in d['data'].series():
+        rows.append(list(block.rows(d['time_dimension'], d['primary_measure'])))
+    return rows
+
+
+def run(coroutine):
+    """Runs ``coroutine`` on a new event loop, asyncio.run needs Python 3.7."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize('root_url, agency_id, resource_id, keys, cassette', [
+    ('https://bdm.insee.fr/series/sdmx', 'FR1', 'CHOMAGE-TRIM-NATIONAL', {}, 'FR1/data.yaml'),
+    ('http://ec.europa.eu/eurostat/SDMX/diss-web/rest', 'ESTAT', 'nama_10_gdp',
+     {'FREQ': 'A', 'GEO': 'FR', 'UNIT': 'CLV10_MEUR', 'NA_ITEM': 'B1GQ'}, 'ESTAT/data.yaml'),
+    ('https://www.ilo.org/sdmx/rest', 'ILO', 'DF_YI_ALL_EMP_TEMP_SEX_AGE_NB',
+     {'SEX': 'SEX_T', 'AGE': 'AGE_5YRBANDS_TOTAL'}, 'ILO/data.yaml')])
+def test_same_results_as_sdmxml(root_url, agency_id, resource_id, keys, cassette):
+    cassette = f'application/tests/vcr_cassette/{cassette}'
+    with vcr.use_cassette(cassette):
+        expected = SDMXML(root_url, agency_id, '2.1', 'specific').get_sdmx(resource_id, keys)
+        expected_rows = rows(expected)
+
+    async def get_sdmx(url):
+        async with build_async_session() as session:
+            req = AsyncSDMXML(f'{url}{urlsplit(root_url).path}', agency_id, '2.1', 'specific', session)
+            d = await req.get_sdmx(resource_id, keys)
+            return d, await async_rows(d)
+
+    with StubServer(cassette_routes(cassette)) as server:
+        d, data = run(get_sdmx(server.url))
+
+    for k in ('dataflow', 'query', 'dimensions', 'attributes', 'codelist', 'time_dimension', 'primary_measure'):
+        assert d[k] == expected[k]
+    assert data == expected_rows
+    assert data
+
+
+def test_collect():
+    cassettes = ('application/tests/vcr_cassette/FR1/data.yaml', 'application/tests/vcr_cassette/ESTAT/data.yaml')
+
+    async def handle(f, d):
+        size = 0
+        async for block in d['data'].series():
+            size += len(block)
+        return size
+
+    with StubServer(cassette_routes(*cassettes)) as server:
+        flows = [
+            {'root_url': f'{server.url}/series/sdmx', 'agency': 'FR1', 'resource': 'CHOMAGE-TRIM-NATIONAL',
+             'version': '2.1', 'kind': 'specific', 'keys': {}},
+            {'root_url': f'{server.url}/eurostat/SDMX/diss-web/rest', 'agency': 'ESTAT', 'resource': 'nama_10_gdp',
+             'version': '2.1', 'kind': 'specific',
+             'keys': {'FREQ': 'A', 'GEO': 'FR', 'UNIT': 'CLV10_MEUR', 'NA_ITEM': 'B1GQ'}},
+            {'root_url': f'{server.url}/series/sdmx', 'agency': 'FR1', 'resource': 'UNKNOWN',
+             'version': '2.1', 'kind': 'specific', 'keys': {}}]
+        results = run(collect(flows, handle, concurrency=2))
+
+    assert results[0] > 0
+    assert results[1] > 0
+    assert isinstance(results[2], SDMXRequestError)
+
+
+def test_async_merge_partitions():
+
+    def partition(p, n):
+        async def items():
+            for i in range(n):
+                await asyncio.sleep(0.001 * (3 - p))
+                yield (p, i)
+        return items
+
+    async def merge(partitions, concurrency, buffer):
+        items = []
+        async for item in async_merge_partitions(partitions, concurrency, buffer):
+            items.append(item)
+        return items
+
+    assert run(merge([partition(p, 5) for p in range(4)], 3, 2)) == [
+        (p, i) for p in range(4) for i in range(5)]
+
+
+def test_async_partitioned_data():
+
+    async def geos(url):
+        async with build_async_session() as session:
+            req = AsyncSDMXML(url, 'FOO', '2.1', 'specific', session)
+            data = req._partitioned_data('DF', PARTITION_DSD, {}, {'dimension': 'GEO', 'size': 2})
+            geos = []
+            async for block in data.series():
+                geos.append(block.key['GEO'])
+            return geos
+
+    with StubServer(partition_routes('DE+ES')) as server:
+        assert run(geos(server.url)) == ['FR', 'IT', 'PT']
+
+
+class BytesResponse(object):
+
+    def __init__(self, content, headers):
+        self.content = content
+        self.headers = headers
+
+    def iter_content(self, chunk_size=None):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def test_csv_stream():
+    dsd = {
+        'dimensions': [('GEO', 'CL_GEO')],
+        'attributes': [('OBS_COMMENT', None)],
+        'time_dimension': 'TIME_PERIOD',
+        'primary_measure': 'OBS_VALUE'
+    }
+    lines = ['DATAFLOW,GEO,TIME_PERIOD,OBS_VALUE,OBS_COMMENT']
+    lines.extend(
+        f'FOO:BAR(1.0),G{s},{t},{s * t},"multi\nline, {s}"' for s in range(500) for t in range(20))
+    content = '\r\n'.join(lines).encode('utf-8')
+    headers = {'Content-Type': 'application/vnd.sdmx.data+csv;version=1.0.0'}
+    expected = [list(b.rows('TIME_PERIOD', 'OBS_VALUE')) for b in SDMXML(
+        'http://foo.bar', 'FOO', '2.1', 'specific')._observations(BytesResponse(content, headers), dsd).series()]
+    assert len(expected) == 500
+    assert expected[-1][-1]['OBS_COMMENT'] == 'multi\nline, 499'
+
+    async def parse(url):
+        async with build_async_session() as session:
+            req = AsyncSDMXML(url, 'FOO', '2.1', 'specific', session)
+            resp = await session.get(f'{url}/data')
+            rows = []
+            async for block in req._series(resp, dsd):
+                rows.append(list(block.rows('TIME_PERIOD', 'OBS_VALUE')))
+            return rows
+
+    with StubServer() as server:
+        server.routes['/data'] = (200, headers, content)
+        assert run(parse(server.url)) == expected
@@ -0,0 +1,101 @@
+import eventlet
+eventlet.monkey_patch()
+
+import os
+import vcr
+import pytest
+from unittest import mock
+from pymongo import MongoClient
+from pymongo.errors import AutoReconnect
+from application.dependencies.cache import (
+    StructureCache, DiskStructureStore, MongoStructureStore, build_cache, dumps, loads)
+from application.dependencies.sdmx import SDMXML
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def database():
+    client = MongoClient()
+
+    yield client['test_db']
+
+    client.drop_database('test_db')
+    client.close()
+
+
+def check_revalidation(store):
+    cache = StructureCache(store, max_age=0)
+    sent = []
+
+    def request(headers):
+        sent.append(headers)
+        if headers.get('If-None-Match') == '"v1"':
+            return FakeResponse(304)
+        return FakeResponse(200, ['FOO'], {'ETag': '"v1"', 'Last-Modified': 'Sat, 31 Aug 2019 14:05:34 GMT'})
+
+    def parse(resp):
+        return [v.lower() for v in resp.body]
+
+    key = ('http://foo.bar', 'codelist', 'FOO', 'CL_FOO')
+    assert cache.fetch(key, request, parse) == ['foo']
+    assert cache.fetch(key, request, lambda r: pytest.fail('parsed a 304')) == ['foo']
+    assert sent == [
+        {}, {'If-None-Match': '"v1"', 'If-Modified-Since': 'Sat, 31 Aug 2019 14:05:34 GMT'}]
+    assert cache.stats() == {'hits': 0, 'revalidated': 1, 'misses': 1}
+
+
+def test_disk_revalidation(tmp_path):
+    check_revalidation(DiskStructureStore(str(tmp_path)))
+
+
+def test_mongo_revalidation(database):
+    check_revalidation(MongoStructureStore(database['structure_cache']))
+
+
+def test_disk_eviction(tmp_path):
+    cache = StructureCache(DiskStructureStore(str(tmp_path)), max_entries=2)
+    for i in range(4):
+        cache.fetch(('http://foo.bar', 'codelist', 'FOO', i), lambda h: FakeResponse(200, i), lambda r: r.body)
+    assert len(os.listdir(str(tmp_path))) == 2
+
+
+def test_store_errors_are_misses():
+    store = mock.Mock()
+    for method in (store.get, store.touch, store.put, store.evict):
+        method.side_effect = AutoReconnect('Mongo is down')
+    cache = StructureCache(store)
+    key = ('http://foo.bar', 'codelist', 'FOO', 'CL_FOO')
+    assert cache.fetch(key, lambda h: FakeResponse(200, ['FOO']), lambda r: r.body) == ['FOO']
+    assert cache.stats() == {'hits': 0, 'revalidated': 0, 'misses': 1}
+    assert store.put.called and store.evict.called
+
+
+def test_structures_stored_as_json(tmp_path, database):
+    value = {'dimensions': [('FREQ', 'CL_FREQ'), ('GEO', None)], 'codelist': [('CL_FREQ', 'A', ('x', 1))], 'n': 1.5}
+    assert loads(dumps(value)) == value
+    assert isinstance(loads(dumps(value))['codelist'][0][2], tuple)
+
+    entry = {'value': value, 'etag': None, 'last_modified': None, 'stored_at': 0, 'accessed_at': 0}
+    for store in (DiskStructureStore(str(tmp_path)), MongoStructureStore(database['structure_cache'])):
+        store.put('key', entry)
+        assert store.get('key')['value'] == value
+    assert [name[-5:] for name in os.listdir(str(tmp_path))] == ['.json']
+
+
+@vcr.use_cassette('application/tests/vcr_cassette/FR1/dsd.yaml')
+def test_fr1_dsd_cached(tmp_path):
+    cache = build_cache({'backend': 'disk', 'path': str(tmp_path)})
+    req = SDMXML('https://bdm.insee.fr/series/sdmx', 'FR1', '2.1', 'specific', cache=cache)
+    first = req.dsd('CHOMAGE-TRIM-NATIONAL')
+    misses = cache.stats()['misses']
+    assert misses == 14
+
+    assert req.dsd('CHOMAGE-TRIM-NATIONAL') == first
+    assert cache.stats() == {'hits': misses, 'revalidated': 0, 'misses': misses}
@@ -2,6 +2,7 @@ import eventlet
 eventlet.monkey_patch()
 
 import vcr
+from unittest import mock
 from nameko.testing.services import dummy, entrypoint_hook
 from application.dependencies.sdmx import SDMX
 
@@ -26,4 +27,15 @@ def test_end_to_end(container_factory):
         c, a, d = get_meta('FR1', 'CHOMAGE-TRIM-NATIONAL')
         assert isinstance(c, list)
         assert isinstance(a, list)
-        assert isinstance(d, list)
\ No newline at end of file
+        assert isinstance(d, list)
+
+
+def test_cache_database_credentials(container_factory):
+    config = {
+        'MONGODB_CONNECTION_URL': 'mongodb://foo.bar:27017', 'MONGODB_DB_NAME': 'foo', 'MONGODB_USER': 'user',
+        'MONGODB_PASSWORD': 'secret', 'MONGODB_AUTHENTICATION_BASE': 'admin', 'SDMX': {'cache': {'backend': 'mongo'}}}
+    with mock.patch('application.dependencies.sdmx.MongoClient') as client:
+        container_factory(DummyService, config).start()
+    client.assert_called_once_with(
+        'mongodb://foo.bar:27017', username='user', password='secret', authSource='admin')
+    client.return_value.__getitem__.assert_called_once_with('foo')
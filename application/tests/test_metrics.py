@@ -0,0 +1,81 @@
+from application.dependencies.metrics import MetricsRegistry, NULL_METRICS
+from application.tests.test_services import mock_sdmx
+from application.services.sdmx_collector import SDMXCollectorService
+from nameko.testing.services import worker_factory
+import time
+
+
+def test_self_time():
+    registry = MetricsRegistry()
+    cycle = registry.start_cycle()
+    scope = registry.scope('insee_foo', cycle)
+
+    with scope.timer('outer'):
+        time.sleep(0.02)
+        with scope.timer('inner'):
+            time.sleep(0.05)
+    assert list(scope.meter(range(3), 'inner')) == [0, 1, 2]
+    scope.incr('http_responses', status=200)
+    scope.incr('http_responses', 2, status=200)
+    registry.end_cycle(cycle)
+
+    snapshot = registry.snapshot()
+    timers = snapshot['timers']
+    assert 0.02 <= timers['outer']['seconds'] < 0.05
+    assert timers['inner']['seconds'] >= 0.05
+    assert timers['inner']['count'] == 5
+    assert snapshot['counters'] == {'http_responses{status="200"}': 3}
+    assert snapshot['running'] == []
+    assert snapshot['cycles'][0]['datasets']['insee_foo']['counters'] == {'http_responses{status="200"}': 3}
+
+
+def test_history():
+    registry = MetricsRegistry(history=2)
+    for _ in range(3):
+        registry.end_cycle(registry.start_cycle())
+    assert len(registry.snapshot()['cycles']) == 2
+
+
+def test_prometheus():
+    registry = MetricsRegistry()
+    cycle = registry.start_cycle()
+    scope = registry.scope('insee_foo', cycle)
+    with scope.timer('parse_data'):
+        pass
+    scope.incr('http_responses', status=200)
+    registry.end_cycle(cycle)
+
+    lines = registry.prometheus().splitlines()
+    assert '# TYPE sdmx_collector_stage_seconds_total counter' in lines
+    assert 'sdmx_collector_stage_calls_total{stage="parse_data"} 1' in lines
+    assert 'sdmx_collector_http_responses_total{status="200"} 1' in lines
+    assert any(l.startswith('sdmx_collector_last_cycle_dataset_stage_seconds{dataset="insee_foo",stage="parse_data"}')
+               for l in lines)
+
+
+def test_null_metrics():
+    rows = [1, 2]
+    assert NULL_METRICS.meter(rows, 'build_rows') is rows
+    with NULL_METRICS.timer('checksum'):
+        NULL_METRICS.incr('rows', 2)
+
+
+def test_dataset_messages_stages():
+    registry = MetricsRegistry()
+    service = worker_factory(SDMXCollectorService, metrics=registry)
+    mock_sdmx(
+        service, [('AGE', 'CL_AGE')], [('CL_AGE', '1', 'desc', 'foo')],
+        [{'AGE': '1', 'time_dimension': str(2000 + r), 'obs_value': str(r)} for r in range(1200)])
+    service.get_status = lambda *args, **kwargs: 'CREATED'
+    service.stage_series_digests = service.stage_incremental = lambda *args: None
+
+    service.publish_messages(
+        ('http://foo.bar', 'INSEE', 'MY-DATASET', '2.1', 'specific', {}), metrics=registry.scope('insee_my_dataset'))
+
+    snapshot = registry.snapshot()
+    assert snapshot['timers']['build_rows']['count'] == 4
+    assert snapshot['timers']['checksum']['count'] == 3
+    assert snapshot['timers']['serialize']['count'] == snapshot['timers']['publish']['count'] == 6
+    assert snapshot['counters']['rows'] == 1200
+    assert snapshot['counters']['messages'] == 6
+    assert service.sdmx.fork.call_args[1]['metrics'].dataset == 'insee_my_dataset'
@@ -0,0 +1,26 @@
+import math
+from application.dependencies.observations import SeriesBlock, Observations, coerce_measure
+
+
+def test_coerce_measure():
+    assert list(coerce_measure(['1', '2.5', '-3e2'])) == [1.0, 2.5, -300.0]
+
+    values = coerce_measure(['1', 'NaN', '', '-', ':', None, 'garbage', '4'])
+    assert [v for v in values if not math.isnan(v)] == [1.0, 4.0]
+    assert len(values) == 8
+
+    values = coerce_measure(['1', '-999'], frozenset(['-999']))
+    assert values[0] == 1.0
+    assert math.isnan(values[1])
+
+
+def test_series_block():
+    block = SeriesBlock({'GEO': 'FR'}, ['OBS_STATUS'])
+    block.append('2018', '1.5', {'OBS_STATUS': 'p'})
+    block.append('2019', 'NaN', {})
+    block.close()
+
+    assert len(block) == 2
+    assert list(Observations(iter([block]), 'TIME_PERIOD', 'OBS_VALUE')) == [
+        {'GEO': 'FR', 'OBS_STATUS': 'p', 'TIME_PERIOD': '2018', 'OBS_VALUE': 1.5},
+        {'GEO': 'FR', 'OBS_STATUS': None, 'TIME_PERIOD': '2019', 'OBS_VALUE': None}]
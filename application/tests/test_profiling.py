@@ -0,0 +1,114 @@
+from application.dependencies.profiling import MemoryProfile, NULL_PROFILE
+from application.dependencies.metrics import MetricsRegistry
+from application.dependencies.state import StateWriter
+from application.services.sdmx_collector import SDMXCollectorService, PublishOptions
+from application.replay import main
+from application.tests.test_services import mock_sdmx
+from nameko.testing.services import worker_factory
+from pymongo import MongoClient
+from unittest import mock
+import eventlet
+import tracemalloc
+import json
+import pytest
+
+
+@pytest.fixture
+def database():
+    client = MongoClient()
+
+    yield client['test_db']
+
+    client.drop_database('test_db')
+    client.close()
+
+
+def test_memory_profile():
+    profile = MemoryProfile('insee_foo', top=3).start()
+    data = [bytes(1024) for _ in range(1000)]
+    del data[100:]
+    profile.mark('rows')
+    profile.mark('publish')
+    profile.stop()
+    NULL_PROFILE.mark('rows')
+
+    report = profile.report()
+    assert not tracemalloc.is_tracing()
+    assert [s['stage'] for s in report['stages']] == ['rows', 'publish']
+    assert report['peak_stage'] == 'rows'
+    rows = report['stages'][0]
+    assert rows['traced_peak'] >= 1000 * 1024
+    assert rows['traced'] < 1000 * 1024
+    assert len(rows['top']) == 3 and 'test_profiling.py' in rows['top'][0]['where']
+    assert report['max_rss'] > 0
+
+
+def test_publish_profile(database):
+    service = worker_factory(SDMXCollectorService, database=database, updates=StateWriter(), metrics=MetricsRegistry())
+    mock_sdmx(
+        service, [('AGE', 'CL_AGE')], [('CL_AGE', str(a), 'desc', 'foo') for a in range(10)],
+        [{'AGE': str(r % 10), 'time_dimension': '2019', 'obs_value': str(r)} for r in range(100)])
+    database.dataset.insert_one({'agency': 'INSEE', 'resource': 'MY-DATASET'})
+    f = {'root_url': 'http://foo.bar', 'agency': 'INSEE', 'resource': 'MY-DATASET', 'version': '2.1',
+         'kind': 'specific', 'keys': {}}
+
+    result = service.publish_dataflow(f, PublishOptions(dataset_timeout=10))
+    assert 'memory_profile' not in result
+
+    result = service.publish_dataflow(f, PublishOptions(dataset_timeout=10, profile_memory=True))
+    stages = [s['stage'] for s in result['memory_profile']['stages']]
+    assert stages == ['structures', 'rows', 'codelist', 'serialize', 'publish']
+    stored = service.find_dataset({'agency': 'INSEE'})['memory_profile']
+    assert stored['status'] == 'PUBLISHED'
+    assert [s['stage'] for s in stored['stages']] == stages
+
+    result = service.publish_dataflow(
+        f, PublishOptions(dataset_timeout=10, chunked=True, profile_memory=True))
+    assert [s['stage'] for s in result['memory_profile']['stages']] == ['structures', 'rows', 'codelist', 'publish']
+
+
+def test_publish_profile_concurrency(database):
+    service = worker_factory(
+        SDMXCollectorService, database=database, updates=StateWriter(), metrics=MetricsRegistry(),
+        config={'PUBLISH': {'concurrency': 3, 'chunked': True}})
+    mock_sdmx(
+        service, [('AGE', 'CL_AGE')], [('CL_AGE', str(a), 'desc', 'foo') for a in range(10)],
+        [{'AGE': str(r % 10), 'time_dimension': '2019', 'obs_value': str(r)} for r in range(100)])
+    for i in range(3):
+        database.dataset.insert_one({
+            'agency': 'INSEE', 'resource': f'DF{i}', 'root_url': 'http://foo.bar',
+            'version': '2.1', 'kind': 'specific', 'keys': {}})
+    running = []
+    publish_dataflow = service.publish_dataflow
+
+    def mock_publish_dataflow(*args, **kwargs):
+        running.append(None)
+        assert len(running) == 1, 'Profiled datasets are published one at a time'
+        eventlet.sleep(0.01)
+        try:
+            return publish_dataflow(*args, **kwargs)
+        finally:
+            running.pop()
+
+    with mock.patch.object(service, 'publish_dataflow', side_effect=mock_publish_dataflow):
+        report = service.publish(profile_memory=True)
+
+    assert [r['status'] for r in report] == ['PUBLISHED'] * 3
+    assert all(r['memory_profile']['stages'] and r['memory_profile']['peak_stage'] for r in report)
+    assert not tracemalloc.is_tracing()
+
+
+def test_replay(tmp_path):
+    dataset = {
+        'root_url': 'https://bdm.insee.fr/series/sdmx', 'agency': 'FR1', 'resource': 'CHOMAGE-TRIM-NATIONAL',
+        'version': '2.1', 'kind': 'specific'}
+    output = tmp_path / 'report.json'
+    assert main([
+        '--dataset', json.dumps(dataset), '--output', str(output),
+        'application/tests/vcr_cassette/FR1/data.yaml', 'application/tests/vcr_cassette/FR1/dataflow.yaml']) == 0
+
+    result = json.loads(output.read_text())
+    assert result['status'] == 'PUBLISHED'
+    assert result['messages'] == 1
+    assert result['memory_profile']['dataset'] == 'fr1_chomage_trim_national'
+    assert result['memory_profile']['peak_stage'] in ('rows', 'serialize')
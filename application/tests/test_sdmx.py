@@ -1,8 +1,17 @@
 import eventlet
 eventlet.monkey_patch()
 
+import json
+import time
+import types
+import requests
+import functools
+import pytest
 import vcr
-from application.dependencies.sdmx import SDMXML
+from application.dependencies.sdmx import (
+    SDMXML, DataflowCatalogue, SDMXRequestError, build_session, merge_partitions, sdmx_request)
+from application.dependencies.observations import Observations
+from application.cassettes import StubServer
 
 
 def check_dataflow(df):
@@ -120,4 +129,310 @@ def test_estat_data():
 def test_ilo_std_data():
     d = SDMXML('https://www.ilo.org/sdmx/rest', 'ILO', '2.1', 'specific').get_sdmx(
         'DF_YI_ALL_EMP_TEMP_SEX_AGE_NB', keys={'SEX': 'SEX_T', 'AGE': 'AGE_5YRBANDS_TOTAL'})
-    check_data(d)
\ No newline at end of file
+    check_data(d)
+
+@vcr.use_cassette('application/tests/vcr_cassette/ESTAT/data.yaml')
+def test_estat_data_is_lazy():
+    d = SDMXML('http://ec.europa.eu/eurostat/SDMX/diss-web/rest', 'ESTAT', '2.1', 'specific').get_sdmx(
+        'nama_10_gdp', keys={'FREQ': 'A', 'GEO': 'FR', 'UNIT': 'CLV10_MEUR', 'NA_ITEM': 'B1GQ'})
+    assert isinstance(d['data'], Observations)
+    assert isinstance(d['data'].series(), types.GeneratorType)
+    first = next(iter(d['data']))
+    assert first['GEO'] == 'FR'
+    assert first['OBS_VALUE']
+
+
+class ChunkedResponse(object):
+
+    def __init__(self, content, size, headers=None):
+        self.content = content
+        self.size = size
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        for i in range(0, len(self.content), self.size):
+            yield self.content[i:i + self.size]
+
+    def close(self):
+        self.closed = True
+
+
+def test_specific_data_stream():
+    series = ''.join(
+        f'<Series GEO="G{s}"><Obs TIME_PERIOD="{t}" OBS_VALUE="{s * t}" OBS_STATUS="p"/></Series>'
+        for s in range(50) for t in range(3))
+    content = (
+        '<message:StructureSpecificData xmlns:message="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message">'
+        f'<message:DataSet>{series}</message:DataSet></message:StructureSpecificData>').encode('utf-8')
+    resp = ChunkedResponse(content, 7)
+    dsd = {
+        'dimensions': [('GEO', 'CL_GEO')],
+        'attributes': [('OBS_STATUS', 'CL_OBS_STATUS'), ('UNIT_MULT', None)],
+        'time_dimension': 'TIME_PERIOD',
+        'primary_measure': 'OBS_VALUE'
+    }
+    blocks = list(SDMXML('http://foo.bar', 'FOO', '2.1', 'specific')._observations(resp, dsd).series())
+    assert len(blocks) == 150
+    assert blocks[-1].key == {'GEO': 'G49'}
+    assert list(blocks[-1].values) == [98.0]
+    assert list(blocks[-1].rows('TIME_PERIOD', 'OBS_VALUE')) == [{
+        'GEO': 'G49', 'OBS_STATUS': 'p', 'UNIT_MULT': None, 'TIME_PERIOD': '2', 'OBS_VALUE': 98.0}]
+    assert resp.closed
+
+    # Streams which are not read release their response
+    resp = ChunkedResponse(content, 7)
+    SDMXML('http://foo.bar', 'FOO', '2.1', 'specific')._observations(resp, dsd).close()
+    assert resp.closed
+
+
+def test_generic_data_stream():
+    series = ''.join(
+        '<generic:Series><generic:SeriesKey>'
+        f'<generic:Value id="FREQ" value="A"/><generic:Value id="GEO" value="G{s}"/></generic:SeriesKey>'
+        '<generic:Attributes><generic:Value id="UNIT_MULT" value="0"/></generic:Attributes>'
+        f'<generic:Obs><generic:ObsDimension value="{t}"/><generic:ObsValue value="{s * t if t else "NaN"}"/>'
+        '<generic:Attributes><generic:Value id="OBS_STATUS" value="p"/></generic:Attributes></generic:Obs>'
+        '</generic:Series>'
+        for s in range(50) for t in range(3))
+    content = (
+        '<message:GenericData xmlns:message="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message" '
+        'xmlns:generic="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/data/generic">'
+        f'<message:DataSet>{series}</message:DataSet></message:GenericData>').encode('utf-8')
+    resp = ChunkedResponse(content, 7)
+    dsd = {
+        'dimensions': [('FREQ', 'CL_FREQ'), ('GEO', 'CL_GEO')],
+        'attributes': [('OBS_STATUS', 'CL_OBS_STATUS'), ('UNIT_MULT', None)],
+        'time_dimension': 'TIME_PERIOD',
+        'primary_measure': 'OBS_VALUE'
+    }
+    observations = SDMXML('http://foo.bar', 'FOO', '2.1', 'generic')._observations(resp, dsd)
+    blocks = list(observations.series())
+    assert len(blocks) == 150
+    assert blocks[-1].key == {'FREQ': 'A', 'GEO': 'G49'}
+    assert list(blocks[-1].rows('TIME_PERIOD', 'OBS_VALUE')) == [{
+        'FREQ': 'A', 'GEO': 'G49', 'OBS_STATUS': 'p', 'UNIT_MULT': None, 'TIME_PERIOD': '2', 'OBS_VALUE': 98.0}]
+    assert blocks[0].measure(0) is None
+    assert resp.closed
+
+    # No generic namespace is known for ILO's own version
+    with pytest.raises(ValueError):
+        SDMXML('http://foo.bar', 'ILO', 'ilo', 'generic')._data_url('DF')
+
+
+def test_csv_and_json_data():
+    dsd = {
+        'dimensions': [('FREQ', 'CL_FREQ'), ('GEO', 'CL_GEO')],
+        'attributes': [('OBS_STATUS', 'CL_OBS_STATUS')],
+        'time_dimension': 'TIME_PERIOD',
+        'primary_measure': 'OBS_VALUE'
+    }
+    req = SDMXML('http://foo.bar', 'FOO', '2.1', 'specific', formats=['csv', 'json', 'xml'])
+    assert req._accept() == (
+        'application/vnd.sdmx.data+csv;version=1.0.0, application/vnd.sdmx.data+json;version=1.0.0;q=0.9, '
+        'application/vnd.sdmx.structurespecificdata+xml;version=2.1;q=0.8')
+    with pytest.raises(ValueError):
+        SDMXML('http://foo.bar', 'FOO', '2.1', 'specific', formats=['xls'])
+
+    expected = [
+        {'FREQ': 'A', 'GEO': 'FR', 'OBS_STATUS': 'p', 'TIME_PERIOD': '2018', 'OBS_VALUE': 1.5},
+        {'FREQ': 'A', 'GEO': 'FR', 'OBS_STATUS': None, 'TIME_PERIOD': '2019', 'OBS_VALUE': None},
+        {'FREQ': 'A', 'GEO': 'DE', 'OBS_STATUS': None, 'TIME_PERIOD': '2018', 'OBS_VALUE': 3.0}]
+
+    content = (
+        'DATAFLOW,FREQ: Frequency,GEO,TIME_PERIOD,OBS_VALUE,OBS_STATUS\r\n'
+        'FOO:BAR(1.0),A,FR,2018,1.5,p\r\nFOO:BAR(1.0),A,FR,2019,NaN,\r\nFOO:BAR(1.0),A,DE,2018,3,\r\n').encode('utf-8')
+    resp = ChunkedResponse(content, 5, {'Content-Type': 'application/vnd.sdmx.data+csv; version=1.0.0'})
+    assert list(req._observations(resp, dsd)) == expected
+    assert resp.closed
+
+    values = {
+        'structure': {
+            'dimensions': {
+                'series': [
+                    {'id': 'FREQ', 'values': [{'id': 'A'}]},
+                    {'id': 'GEO', 'values': [{'id': 'DE'}, {'id': 'FR'}]}],
+                'observation': [{'id': 'TIME_PERIOD', 'values': [{'id': '2018'}, {'id': '2019'}]}]
+            },
+            'attributes': {'observation': [{'id': 'OBS_STATUS', 'values': [{'id': 'p'}]}]}
+        },
+        'dataSets': [{'series': {
+            '0:1': {'observations': {'0': [1.5, 0], '1': [None, None]}},
+            '0:0': {'observations': {'0': [3]}}}}]
+    }
+    resp = ChunkedResponse(
+        json.dumps(values).encode('utf-8'), 5, {'Content-Type': 'application/vnd.sdmx.data+json;version=1.0.0'})
+    assert list(req._observations(resp, dsd)) == expected
+
+    values['structure']['dimensions'] = {'observation': [
+        *values['structure']['dimensions']['series'], *values['structure']['dimensions']['observation']]}
+    values['dataSets'] = [{'observations': {'0:1:0': [1.5, 0], '0:1:1': [None], '0:0:0': [3]}}]
+    resp = ChunkedResponse(json.dumps({'data': values}).encode('utf-8'), 5, {'Content-Type': 'application/json'})
+    assert list(req._observations(resp, dsd)) == expected
+
+def test_build_session():
+    session = build_session({'pool_maxsize': 3, 'hosts': {'https://ec.europa.eu': {'pool_maxsize': 1}}})
+    assert session.headers['Accept-Encoding'] == 'gzip, deflate'
+    assert session.get_adapter('https://bdm.insee.fr/series')._pool_maxsize == 3
+    assert session.get_adapter('https://ec.europa.eu/eurostat')._pool_maxsize == 1
+
+    session = build_session({'compression': False})
+    assert session.headers['Accept-Encoding'] == 'identity'
+
+
+def scripted(responses, times):
+    """StubServer routes answering each request with the next ``(status, headers, delay)``."""
+    responses = list(responses)
+
+    def respond(path):
+        times.append(time.monotonic())
+        status, headers, delay = responses.pop(0) if responses else (200, {}, 0)
+        eventlet.sleep(delay)
+        return status, {**headers, 'Content-Type': 'application/xml'}, b'<foo/>'
+    return respond
+
+
+def test_session_retries():
+    session = build_session({'retries': 2, 'backoff_factor': 0.01, 'rate': None})
+
+    times = []
+    with StubServer(scripted([(503, {}, 0), (429, {'Retry-After': '0.2'}, 0)], times)) as server:
+        assert sdmx_request(f'{server.url}/data', session=session).tag == 'foo'
+        assert len(times) == 3
+        assert times[2] - times[1] >= 0.2
+
+    times = []
+    with StubServer(scripted([(503, {}, 0)] * 3, times)) as server:
+        with pytest.raises(SDMXRequestError):
+            sdmx_request(f'{server.url}/data', session=session)
+        assert len(times) == 3
+
+    session = build_session({'retries': 0, 'read_timeout': 0.1})
+    with StubServer(scripted([(200, {}, 1)], [])) as server:
+        with pytest.raises(requests.Timeout):
+            sdmx_request(f'{server.url}/data', session=session)
+
+
+def test_session_rate_limit():
+    times = []
+    with StubServer(scripted([], times)) as server:
+        session = build_session({'rate': 1000, 'hosts': {server.url: {'rate': 20, 'burst': 2}}})
+        for _ in range(6):
+            sdmx_request(f'{server.url}/data', session=session)
+        assert times[-1] - times[0] >= 0.18
+        assert session.options(f'{server.url}/data')['rate'] == 20
+        assert session.options('http://foo.bar/data')['rate'] == 1000
+
+@vcr.use_cassette('application/tests/vcr_cassette/FR1/dsd.yaml')
+def test_fr1_dsd_with_session():
+    df = SDMXML(
+        'https://bdm.insee.fr/series/sdmx', 'FR1', '2.1', 'specific',
+        session=build_session()).dsd('CHOMAGE-TRIM-NATIONAL')
+    check_dsd(df)
+
+
+def test_ilo_dsd_codelists_fetched_once():
+    with vcr.use_cassette('application/tests/vcr_cassette/ILO/dsd.yaml') as cassette:
+        df = SDMXML(
+            'https://www.ilo.org/ilostat/sdmx/ws/rest', 'ILO', 'ilo', 'specific',
+            codelist_concurrency=4).dsd('CP_ALL_ALL')
+        check_dsd(df)
+        assert cassette.play_count == len({r.uri for r in cassette.requests})
+        assert cassette.play_count < len(cassette.requests)
+
+
+def test_fr1_dataflow_from_catalogue():
+    catalogue = DataflowCatalogue()
+    with vcr.use_cassette('application/tests/vcr_cassette/FR1/dataflow.yaml') as cassette:
+        for _ in range(3):
+            req = SDMXML('https://bdm.insee.fr/series/sdmx', 'FR1', '2.1', 'specific', catalogue=catalogue)
+            df = req.dataflow('CHOMAGE-TRIM-NATIONAL')
+            assert df['id'] == 'CHOMAGE-TRIM-NATIONAL'
+            check_dataflow(req.dataflows())
+        assert cassette.play_count == 1
+
+
+def test_merge_partitions():
+
+    def partition(p, n):
+        for i in range(n):
+            eventlet.sleep(0.001 * (3 - p))
+            yield (p, i)
+
+    partitions = [functools.partial(partition, p, 5) for p in range(4)]
+    assert list(merge_partitions(partitions, 3, buffer=2)) == [(p, i) for p in range(4) for i in range(5)]
+
+    def failing():
+        yield (9, 0)
+        raise SDMXRequestError('Non 200 HTTP response: 413')
+
+    with pytest.raises(SDMXRequestError):
+        list(merge_partitions([functools.partial(partition, 0, 2), failing], 2))
+
+
+def test_partitions():
+    req = SDMXML('http://foo.bar', 'FOO', '2.1', 'specific')
+    dsd = {
+        'dimensions': [('FREQ', 'CL_FREQ'), ('GEO', 'CL_GEO')],
+        'codelist': [('CL_GEO', g, 'desc', 'foo') for g in ('FR', 'DE', 'IT')] + [('CL_FREQ', 'A', 'desc', 'foo')]
+    }
+    partition = {'dimension': 'GEO', 'size': 2}
+    assert req._partitions(dsd, {'FREQ': 'A'}, partition) == [('A.FR+DE', None), ('A.IT', None)]
+    assert req._partitions(dsd, {'GEO': 'BE+NL'}, partition) == [('.BE+NL', None)]
+
+    partition = {'start_period': 2000, 'end_period': 2004, 'size': 2}
+    assert req._partitions(dsd, {}, partition) == [
+        ('.', {'startPeriod': '2000', 'endPeriod': '2001'}),
+        ('.', {'startPeriod': '2002', 'endPeriod': '2003'}),
+        ('.', {'startPeriod': '2004', 'endPeriod': '2004'})]
+    # Incremental downloads skip the windows before their startPeriod
+    assert req._partitions(dsd, {}, partition, {'startPeriod': '2003-Q2'}) == [
+        ('.', {'startPeriod': '2003-Q2', 'endPeriod': '2003'}),
+        ('.', {'startPeriod': '2004', 'endPeriod': '2004'})]
+    assert req._partitions(dsd, {}, partition, {'updatedAfter': 'foo'})[0] == (
+        '.', {'updatedAfter': 'foo', 'startPeriod': '2000', 'endPeriod': '2001'})
+    assert req._partitions(dsd, {}, {'dimension': 'GEO', 'size': 2}, {'startPeriod': '2003'}) == [
+        ('.FR+DE', {'startPeriod': '2003'}), ('.IT', {'startPeriod': '2003'})]
+
+    with pytest.raises(ValueError):
+        req._partitions(dsd, {}, {'dimension': 'UNIT', 'size': 2})
+    with pytest.raises(ValueError):
+        req._partitions(dsd, {}, {'size': 2})
+
+
+PARTITION_DSD = {
+    'dimensions': [('GEO', 'CL_GEO')],
+    'attributes': [],
+    'codelist': [('CL_GEO', g, 'desc', 'foo') for g in ('FR', 'IT', 'DE', 'ES', 'PT')],
+    'time_dimension': 'TIME_PERIOD',
+    'primary_measure': 'OBS_VALUE'
+}
+
+
+def partition_routes(*empty):
+    """StubServer routes of the GEO partitions of PARTITION_DSD, ``empty`` ones answering NoResultsFound."""
+    def data(geos):
+        series = ''.join(f'<Series GEO="{g}"><Obs TIME_PERIOD="2019" OBS_VALUE="1"/></Series>' for g in geos)
+        return (
+            '<message:StructureSpecificData xmlns:message="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message">'
+            f'<message:DataSet>{series}</message:DataSet></message:StructureSpecificData>').encode('utf-8')
+
+    headers = {'Content-Type': 'application/vnd.sdmx.structurespecificdata+xml; version=2.1'}
+    routes = {}
+    for query in ('FR+IT', 'DE+ES', 'PT'):
+        if query in empty:
+            routes[f'/data/DF/{query}'] = (404, {'Content-Type': 'text/plain'}, b'NoResultsFound')
+        else:
+            routes[f'/data/DF/{query}'] = (200, headers, data(query.split('+')))
+    return routes
+
+
+def test_partitioned_data():
+    with StubServer(partition_routes('DE+ES')) as server:
+        req = SDMXML(server.url, 'FOO', '2.1', 'specific', session=build_session({'retries': 0}))
+        data = req._partitioned_data('DF', PARTITION_DSD, {}, {'dimension': 'GEO', 'size': 2})
+        assert [b.key['GEO'] for b in data.series()] == ['FR', 'IT', 'PT']
+
+        server.routes['/data/DF/PT'] = (500, {}, b'Internal error')
+        with pytest.raises(SDMXRequestError):
+            list(req._partitioned_data('DF', PARTITION_DSD, {}, {'dimension': 'GEO', 'size': 2}).series())
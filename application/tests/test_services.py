@@ -1,11 +1,54 @@
-from application.services.sdmx_collector import SDMXCollectorService, SDMXCollectorError
+from application.services.sdmx_collector import (
+    SDMXCollectorService, SDMXCollectorError, DatasetChecksum, PublishOptions,
+    period_key, shift_period)
 from nameko.testing.services import worker_factory
 from pymongo import MongoClient
+from application.dependencies.observations import SeriesBlock, Observations
+from application.dependencies.codelist import CodelistIndex, AgencyCodes, code_ref, commit_codes
+from application.dependencies.metrics import MetricsRegistry
+from application.dependencies.state import StateWriter
+from unittest import mock
+import itertools
+import collections
+import bson.json_util
+import hashlib
 import pytest
 import eventlet
 eventlet.monkey_patch()
 
 
+def observations(rows, dimensions, attributes=()):
+
+    def blocks():
+        for key, group in itertools.groupby(rows, key=lambda r: tuple(r[d] for d in dimensions)):
+            block = SeriesBlock(dict(zip(dimensions, key)), attributes)
+            for r in group:
+                block.append(r['time_dimension'], r['obs_value'], r)
+            yield block.close()
+
+    return Observations(blocks(), 'time_dimension', 'obs_value')
+
+
+def mock_sdmx(service, dimensions, codelist, rows):
+    """Mocks the SDMX dependency of ``service`` with one dataflow.
+
+    ``dimensions`` are ``(name, codelist id)`` pairs, ``codelist`` the rows
+    of their codelists and ``rows`` the observations, as dicts. Both can be
+    functions so that a test changes them between downloads.
+    """
+    service.sdmx.fork.return_value = service.sdmx
+    service.sdmx.name.return_value = 'My dataset'
+    service.sdmx.codelist.side_effect = codelist if callable(codelist) else lambda: codelist
+    service.sdmx.dimensions.return_value = dimensions
+    service.sdmx.attributes.return_value = []
+    service.sdmx.primary_measure.return_value = 'obs_value'
+    service.sdmx.time_dimension.return_value = 'time_dimension'
+    service.sdmx.query.return_value = ''
+    service.sdmx.agency_dataflows = []
+    service.sdmx.data.side_effect = lambda: observations(
+        rows() if callable(rows) else rows, [name for name, _ in dimensions])
+
+
 @pytest.fixture
 def database():
     client = MongoClient()
@@ -17,7 +60,7 @@ def database():
 
 
 def test_add_dataflow(database):
-    service = worker_factory(SDMXCollectorService, database=database)
+    service = worker_factory(SDMXCollectorService, database=database, updates=StateWriter())
 
     def mock_initialize(root_url, agency, resource, version, kind, keys):
         if agency != 'INSEE':
@@ -27,13 +70,14 @@ def test_add_dataflow(database):
 
     service.add_dataflow('http://foo.bar', 'INSEE', 'DATAFLOW', '2.1', 'specific', {})
     assert service.database.dataset.find_one({'agency': 'INSEE'})
+    service.sdmx.data.return_value.close.assert_called_once_with()
 
     with pytest.raises(SDMXCollectorError):
         service.add_dataflow('http://foo.bar', '?', '?', '2.1', 'specific', {})
 
 
 def test_get_dataset(database):
-    service = worker_factory(SDMXCollectorService, database=database)
+    service = worker_factory(SDMXCollectorService, database=database, updates=StateWriter())
 
     def mock_codelist():
         return [
@@ -70,7 +114,9 @@ def test_get_dataset(database):
     service.sdmx.time_dimension.side_effect = mock_time_dimension
 
     def mock_data():
-        return ([{'AGE': '0', 'indicateur': 'XY', 'time_dimension': '2019-Q4', 'obs_value': '35' if r > 0 else 'NaN'} for r in range(5)])
+        return observations([
+            {'AGE': '0', 'indicateur': 'XY', 'time_dimension': '2019-Q4', 'obs_value': '35' if r > 0 else 'NaN'}
+            for r in range(5)], ['AGE', 'indicateur'], ['obs_type', 'other'])
     service.sdmx.data.side_effect = mock_data
 
     dataset = service.get_dataset('http://foo.bar', 'INSEE', 'MY-DATASET', '2.1', 'specific', {})
@@ -119,3 +165,413 @@ def test_get_dataset(database):
     assert 'common_name' in referential['entities'][0]
     assert 'id' in referential['entities'][0]
     assert referential['entities'][0]['id'] == 'insee_my_dataset'
+
+
+def test_publish(database):
+    metrics = MetricsRegistry()
+    service = worker_factory(
+        SDMXCollectorService, database=database, updates=StateWriter(), metrics=metrics,
+        config={'PUBLISH': {'concurrency': 3, 'agency_concurrency': 1, 'dataset_timeout': 0.5}})
+    for agency, resource in (('INSEE', 'SLOW'), ('INSEE', 'FAST'), ('ESTAT', 'BROKEN'), ('ESTAT', 'STUCK')):
+        database.dataset.insert_one({
+            'agency': agency, 'resource': resource, 'root_url': 'http://foo.bar',
+            'version': '2.1', 'kind': 'specific', 'keys': {}})
+
+    def mock_get_dataset(root_url, agency, resource, version, kind, keys, options=None, sdmx=None, partition=None,
+                         incremental=None, formats=None, metrics=None, profile=None, codes=None, state=None):
+        if resource == 'BROKEN':
+            raise ValueError('Broken dataset!')
+        eventlet.sleep({'SLOW': 0.1, 'FAST': 0, 'STUCK': 10}[resource])
+        return {'id': resource.lower(), 'checksum': 'foo'}
+
+    with mock.patch.object(service, 'get_dataset', side_effect=mock_get_dataset):
+        report = service.publish()
+
+    statuses = {r['resource']: r['status'] for r in report}
+    assert statuses == {'SLOW': 'PUBLISHED', 'FAST': 'PUBLISHED', 'BROKEN': 'FAILED', 'STUCK': 'TIMEOUT'}
+    assert all(r['elapsed'] >= 0 for r in report)
+    assert service.pub_input.call_count == 2
+
+    cycle = service.get_metrics()['cycles'][0]
+    assert cycle['counters'] == {
+        'datasets{status="PUBLISHED"}': 2, 'datasets{status="FAILED"}': 1, 'datasets{status="TIMEOUT"}': 1,
+        'messages': 2, 'message_bytes': 66}
+    assert cycle['datasets']['insee_fast']['timers']['publish']['count'] == 1
+
+
+def test_publish_agency_slots(database):
+    service = worker_factory(
+        SDMXCollectorService, database=database, updates=StateWriter(), metrics=MetricsRegistry(),
+        config={'PUBLISH': {'concurrency': 4, 'agency_concurrency': 2}})
+    # Documents grouped by agency, the way they usually come back
+    for agency in ('INSEE', 'ESTAT'):
+        for i in range(4):
+            database.dataset.insert_one({
+                'agency': agency, 'resource': f'DF{i}', 'root_url': 'http://foo.bar',
+                'version': '2.1', 'kind': 'specific', 'keys': {}})
+    running = collections.Counter()
+    peaks = []
+
+    def mock_get_dataset(root_url, agency, resource, *args, **kwargs):
+        running[agency] += 1
+        peaks.append((sum(running.values()), running[agency]))
+        eventlet.sleep(0.05)
+        running[agency] -= 1
+        return {'id': resource.lower(), 'checksum': 'foo'}
+
+    with mock.patch.object(service, 'get_dataset', side_effect=mock_get_dataset):
+        service.publish()
+
+    assert max(total for total, _ in peaks) == 4
+    assert max(agency for _, agency in peaks) == 2
+    assert [f['agency'] for f in SDMXCollectorService.interleave(database.dataset.find({}))] == [
+        'INSEE', 'ESTAT'] * 4
+
+
+def test_dataset_messages(database):
+    service = worker_factory(SDMXCollectorService, database=database, updates=StateWriter())
+    mock_sdmx(
+        service, [('AGE', 'CL_AGE')], [('CL_AGE', str(a), 'desc', 'foo') for a in range(700)],
+        [{'AGE': str(r % 700), 'time_dimension': '2019', 'obs_value': str(r)} for r in range(1200)])
+
+    messages = list(service.dataset_messages('http://foo.bar', 'INSEE', 'MY-DATASET', '2.1', 'specific', {}))
+    header, batches, trailer = messages[0], messages[1:-1], messages[-1]
+
+    assert header['part'] == 'header'
+    assert [t['target_table'] for t in header['datastore']] == ['insee_my_dataset', 'insee_codelist']
+    assert 'records' not in header['datastore'][0]
+    assert header['referential']['entities'][0]['id'] == 'insee_my_dataset'
+
+    assert [b['sequence'] for b in batches] == list(range(5))
+    assert [len(b['records']) for b in batches] == [500, 500, 200, 500, 200]
+    assert [b['target_table'] for b in batches] == ['insee_my_dataset'] * 3 + ['insee_codelist'] * 2
+
+    assert trailer['part'] == 'trailer'
+    assert trailer['batches'] == 5
+    assert trailer['status'] == 'CREATED'
+    dataset = service.get_dataset('http://foo.bar', 'INSEE', 'MY-DATASET', '2.1', 'specific', {})
+    assert trailer['checksum'] == dataset['checksum']
+    assert all(m['id'] == 'insee_my_dataset' for m in messages)
+
+
+def test_checksum():
+    rows = [{'AGE': str(r), 'obs_value': float(r)} for r in range(10)]
+    assert SDMXCollectorService.checksum(iter(rows)) == hashlib.md5(
+        ''.join([str(r) for r in rows]).encode('utf-8')).hexdigest()
+
+    checksum = DatasetChecksum(['AGE'])
+    list(checksum.track(rows + rows[:2]))
+    assert len(checksum.series_digests()) == 10
+    assert checksum.series_digests()['0'] == hashlib.md5(str(rows[0]).encode('utf-8') * 2).hexdigest()
+    assert not checksum.contiguous
+    checksum = DatasetChecksum(['AGE'])
+    list(checksum.track(rows + rows[-1:]))
+    assert checksum.contiguous
+
+
+def test_series_delta(database):
+    service = worker_factory(SDMXCollectorService, database=database, updates=StateWriter())
+    database.dataset.insert_one({'id': 'insee_my_dataset', 'agency': 'INSEE', 'resource': 'MY-DATASET'})
+
+    def publish(rows):
+        mock_sdmx(
+            service, [('GEO', 'CL_GEO')], [('CL_GEO', g, 'desc', 'foo') for g in ('FR', 'DE', 'IT')],
+            [{'GEO': g, 'time_dimension': t, 'obs_value': v} for g, t, v in rows])
+        messages = list(service.dataset_messages(
+            'http://foo.bar', 'INSEE', 'MY-DATASET', '2.1', 'specific', {}, options=PublishOptions(series_delta=True)))
+        service.update_checksum('insee_my_dataset', messages[-1]['checksum'])
+        return [m for m in messages if m['part'] == 'records' and m['target_table'] == 'insee_my_dataset']
+
+    batches = publish([('FR', '2018', '1'), ('FR', '2019', '2'), ('DE', '2019', '3'), ('IT', '2019', '4')])
+    assert sum(len(b['records']) for b in batches) == 4
+    assert all('delete_keys' not in b for b in batches)
+
+    batches = publish([('FR', '2018', '1'), ('FR', '2019', '2'), ('DE', '2019', '5')])
+    assert [(b['delete_keys'], len(b['records'])) for b in batches] == [
+        ({'query': '', 'GEO': 'DE'}, 1), ({'query': '', 'GEO': 'IT'}, 0)]
+
+    assert publish([('FR', '2018', '1'), ('FR', '2019', '2'), ('DE', '2019', '5')]) == []
+    # Series deleted from the dataset are forgotten
+    assert set(service.get_series_digests('insee_my_dataset')) == {'FR', 'DE'}
+
+    # Contiguity is checked before the header: such datasets are published whole
+    batches = publish([('FR', '2018', '1'), ('DE', '2019', '5'), ('FR', '2019', '2')])
+    assert [len(b['records']) for b in batches] == [3]
+    assert all('delete_keys' not in b for b in batches)
+
+    # Period windows return a series once per window: series delta is switched off before publishing anything
+    mock_sdmx(
+        service, [('GEO', 'CL_GEO')], [('CL_GEO', g, 'desc', 'foo') for g in ('FR', 'DE', 'IT')],
+        [{'GEO': g, 'time_dimension': t, 'obs_value': v}
+         for g, t, v in (('FR', '2018', '1'), ('DE', '2018', '5'), ('FR', '2019', '2'))])
+    messages = list(service.dataset_messages(
+        'http://foo.bar', 'INSEE', 'MY-DATASET', '2.1', 'specific', {}, options=PublishOptions(series_delta=True),
+        partition={'start_period': 2018, 'size': 1}))
+    assert messages[0]['datastore'][0]['delete_keys'] == {'query': ''}
+    assert [len(m['records']) for m in messages if m['part'] == 'records'] == [3, 3]
+
+
+def test_spill(database, tmp_path):
+    service = worker_factory(SDMXCollectorService, database=database, updates=StateWriter())
+    mock_sdmx(
+        service, [('AGE', 'CL_AGE')], [('CL_AGE', str(a), 'desc', 'foo') for a in range(7)],
+        [{'AGE': str(r // 200), 'time_dimension': str(r % 200), 'obs_value': str(r)} for r in range(1200)])
+    database.dataset.insert_one({'id': 'insee_my_dataset', 'agency': 'INSEE', 'resource': 'MY-DATASET'})
+    args = ('http://foo.bar', 'INSEE', 'MY-DATASET', '2.1', 'specific', {})
+    spill = PublishOptions(spill=str(tmp_path))
+
+    expected = list(service.dataset_messages(*args))
+    assert list(service.dataset_messages(*args, options=spill)) == expected
+    assert list(tmp_path.iterdir()) == []
+    dataset = service.get_dataset(*args)
+    assert service.get_dataset(*args, options=spill) == dataset
+
+    service.update_checksum('insee_my_dataset', expected[-1]['checksum'])
+    assert list(service.dataset_messages(*args, options=spill))[-1]['status'] == 'UNCHANGED'
+    assert list(service.dataset_messages(*args, options=spill.replace(skip_unchanged=True))) == []
+    assert service.get_dataset(*args, options=spill.replace(skip_unchanged=True)) is None
+    assert list(service.dataset_messages(*args))[-1]['status'] == 'UNCHANGED'
+
+    database.dataset.update_one({'id': 'insee_my_dataset'}, {'$set': {'checksum': 'foo'}})
+    messages = list(service.dataset_messages(*args, options=spill.replace(series_delta=True)))
+    # Series were read back from disk: all of them are unchanged, only the codelist is left
+    assert [(m['target_table'], len(m['records'])) for m in messages if m['part'] == 'records'] == [
+        ('insee_codelist', 7)]
+    assert messages[-1]['checksum'] == expected[-1]['checksum']
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_skip_unchanged(database):
+    metrics = MetricsRegistry()
+    service = worker_factory(
+        SDMXCollectorService, database=database, updates=StateWriter(), metrics=metrics,
+        config={'PUBLISH': {'skip_unchanged': True, 'force_refresh': 3600}})
+    mock_sdmx(
+        service, [('AGE', 'CL_AGE')], [('CL_AGE', str(a), 'desc', 'foo') for a in range(7)],
+        [{'AGE': str(r % 7), 'time_dimension': '2019', 'obs_value': str(r)} for r in range(7)])
+    database.dataset.insert_one({
+        'id': 'insee_my_dataset', 'agency': 'INSEE', 'resource': 'MY-DATASET', 'root_url': 'http://foo.bar',
+        'version': '2.1', 'kind': 'specific', 'keys': {}})
+    args = ('http://foo.bar', 'INSEE', 'MY-DATASET', '2.1', 'specific', {})
+
+    assert [r['status'] for r in service.publish()] == ['PUBLISHED']
+    body = service.pub_input.call_args[0][0]
+    assert database.dataset.find_one({'id': 'insee_my_dataset'})['published_bytes'] == len(body)
+
+    service.update_checksum('insee_my_dataset', service.get_dataset(*args)['checksum'])
+    assert [r['status'] for r in service.publish()] == ['UNCHANGED']
+    assert service.pub_input.call_count == 1
+    assert metrics.cycles[-1].stats.counters['skipped_rows'] == 7
+    assert metrics.cycles[-1].stats.counters['skipped_bytes'] == len(body)
+
+    # Unchanged but not acknowledged for longer than force_refresh
+    database.dataset.update_one({'id': 'insee_my_dataset'}, {'$inc': {'acknowledged_at': -3600}})
+    assert [r['status'] for r in service.publish()] == ['PUBLISHED']
+    assert service.pub_input.call_count == 2
+
+    assert not SDMXCollectorService.refresh_due({'acknowledged_at': 100}, 60, now=150)
+    assert SDMXCollectorService.refresh_due({'acknowledged_at': 100}, 60, now=160)
+    assert SDMXCollectorService.refresh_due({}, 60)
+    assert not SDMXCollectorService.refresh_due({}, None)
+
+
+def test_incremental(database):
+    service = worker_factory(SDMXCollectorService, database=database, updates=StateWriter())
+    database.dataset.insert_one({'id': 'insee_my_dataset', 'agency': 'INSEE', 'resource': 'MY-DATASET'})
+
+    def publish(rows, mode=None):
+        doc = service.find_dataset({'id': 'insee_my_dataset'})
+        incremental = SDMXCollectorService.incremental_params(doc, mode) if mode else None
+        mock_sdmx(
+            service, [('GEO', 'CL_GEO')], [('CL_GEO', g, 'desc', 'foo') for g in ('FR', 'DE')],
+            [{'GEO': g, 'time_dimension': t, 'obs_value': v} for g, t, v in rows])
+        messages = list(service.dataset_messages(
+            'http://foo.bar', 'INSEE', 'MY-DATASET', '2.1', 'specific', {}, incremental=incremental))
+        assert service.sdmx.initialize.call_args[1]['params'] == incremental
+        service.update_checksum('insee_my_dataset', messages[-1]['checksum'])
+        return messages
+
+    messages = publish([('FR', '2018', '1'), ('FR', '2019', '2'), ('DE', '2019', '3')])
+    checksum = messages[-1]['checksum']
+    doc = service.find_dataset({'id': 'insee_my_dataset'})
+    assert doc['incremental']['max_period'] == '2019'
+    assert doc['incremental']['full_at'] == doc['acknowledged_at']
+    assert SDMXCollectorService.incremental_params(doc, 'start_period') == {'startPeriod': '2018'}
+    assert SDMXCollectorService.incremental_params(doc, 'start_period', lookback=0) == {'startPeriod': '2019'}
+    # Whole downloads every full_refresh seconds
+    full_at = doc['incremental']['full_at']
+    assert SDMXCollectorService.incremental_params(
+        doc, 'start_period', full_refresh=60, now=full_at + 30) == {'startPeriod': '2018'}
+    assert SDMXCollectorService.incremental_params(doc, 'start_period', full_refresh=60, now=full_at + 60) is None
+    assert SDMXCollectorService.incremental_params(doc, 'updated_after') == {
+        'updatedAfter': doc['incremental']['fetched_at']}
+    with pytest.raises(ValueError):
+        SDMXCollectorService.incremental_params(doc, 'foo')
+
+    messages = publish([('FR', '2019', '2'), ('FR', '2020', '4'), ('DE', '2019', '3')], 'start_period')
+    assert messages[0]['datastore'][0]['delete_keys'] is None
+    batches = [m for m in messages if m['part'] == 'records' and m['target_table'] == 'insee_my_dataset']
+    assert [(b['delete_keys'], len(b['records'])) for b in batches] == [
+        ({'query': '', 'time_dimension': '2019'}, 2), ({'query': '', 'time_dimension': '2020'}, 1)]
+    assert messages[-1]['status'] == 'UPDATED'
+    doc = service.find_dataset({'id': 'insee_my_dataset'})
+    assert doc['checksum'] == checksum
+    assert doc['incremental']['max_period'] == '2020'
+    assert doc['incremental']['full_at'] == full_at
+    assert 'pending_incremental' not in doc
+
+    messages = publish([('DE', '2020', '5')], 'updated_after')
+    batches = [m for m in messages if m['part'] == 'records' and m['target_table'] == 'insee_my_dataset']
+    assert [b['delete_keys'] for b in batches] == [{'query': '', 'time_dimension': '2020', 'GEO': 'DE'}]
+
+    assert publish([], 'start_period')[-1]['status'] == 'UNCHANGED'
+
+    # Frequencies are mixed: the latest period is the one starting last
+    publish([('FR', '2020-12', '6'), ('DE', '2020-Q4', '7')], 'start_period')
+    doc = service.find_dataset({'id': 'insee_my_dataset'})
+    assert doc['incremental']['max_period'] == '2020-12'
+    assert SDMXCollectorService.incremental_params(doc, 'start_period') == {'startPeriod': '2019-12'}
+
+
+def test_period_key():
+    periods = ['2019-Q4', '2019-12', '2019', '2019-W50', '2019-S2', '2019-12-31', '2020-A1', '2019-D001', 'foo']
+    assert sorted(periods, key=period_key) == [
+        'foo', '2019', '2019-D001', '2019-S2', '2019-Q4', '2019-12', '2019-W50', '2019-12-31', '2020-A1']
+    assert shift_period('2019-Q4', -1) == '2018-Q4'
+    assert shift_period('2020-02-29', -1) == '2019-02-28'
+    assert shift_period('foo', -1) == 'foo'
+
+
+def test_incremental_single_message(database):
+    service = worker_factory(
+        SDMXCollectorService, database=database, updates=StateWriter(), metrics=MetricsRegistry(),
+        pub_input=mock.Mock(), config={'PUBLISH': {'incremental': True}})
+    database.dataset.insert_one({
+        'id': 'insee_my_dataset', 'agency': 'INSEE', 'resource': 'MY-DATASET', 'root_url': 'http://foo.bar',
+        'version': '2.1', 'kind': 'specific', 'keys': {}})
+
+    def publish(rows):
+        mock_sdmx(
+            service, [('GEO', 'CL_GEO')], [('CL_GEO', g, 'desc', 'foo') for g in ('FR', 'DE')],
+            [{'GEO': g, 'time_dimension': t, 'obs_value': v} for g, t, v in rows])
+        service.pub_input.reset_mock()
+        report = service.publish()
+        if not service.pub_input.called:
+            return report[0]['status'], None
+        message = bson.json_util.loads(service.pub_input.call_args[0][0])
+        service.update_checksum('insee_my_dataset', message['checksum'])
+        return report[0]['status'], message
+
+    # The first download is whole, later ones start a year before the latest period
+    status, message = publish([('FR', '2018', '1'), ('FR', '2019', '2'), ('DE', '2019', '3')])
+    assert len(message['datastore']) == 2 and message['datastore'][0]['delete_keys'] == {'query': ''}
+    assert service.sdmx.initialize.call_args[1]['params'] is None
+
+    status, message = publish([('FR', '2018', '1'), ('FR', '2019', '2'), ('DE', '2020', '4')])
+    assert service.sdmx.initialize.call_args[1]['params'] == {'startPeriod': '2018'}
+    assert [(t['delete_keys'], len(t['records'])) for t in message['datastore'][:-1]] == [
+        ({'query': '', 'time_dimension': '2018'}, 1), ({'query': '', 'time_dimension': '2019'}, 1),
+        ({'query': '', 'time_dimension': '2020'}, 1)]
+    assert message['status'] == 'UPDATED'
+    assert service.find_dataset({'id': 'insee_my_dataset'})['incremental']['max_period'] == '2020'
+
+    assert publish([]) == ('UNCHANGED', None)
+
+
+def test_publish_options():
+    options = PublishOptions.from_config({'incremental': True, 'spill': True, 'spill_dir': '/foo'}, profile_memory=True)
+    assert (options.incremental_mode, options.spill, options.profile_memory) == ('start_period', '/foo', True)
+    assert PublishOptions.from_config(None).incremental_mode is None
+    assert options.replace(spill=None).spill is None and options.spill == '/foo'
+
+
+def test_codelist_index():
+    codelist = CodelistIndex([
+        ('CL_GEO', 'FR', 'desc', 'foo'),
+        ('CL_AGE', '0', 'desc', 'foo'),
+        ('CL_GEO', 'FR_IDF', 'desc', 'foo')
+    ])
+    assert 'CL_GEO' in codelist
+    assert 'CL_FOO' not in codelist
+    assert len(codelist) == 3
+    assert [r[1] for r in codelist.get('CL_GEO')] == ['FR', 'FR_IDF']
+    assert codelist.max_length['CL_GEO'] == 6
+    assert codelist.total_length['CL_GEO'] == 8
+    assert CodelistIndex.of(codelist) is codelist
+
+    meta = {
+        'codelist': codelist,
+        'dimensions': [('GEO', 'CL_GEO'), ('AGE', 'CL_AGE'), ('SEX', 'CL_SEX')],
+        'attributes': [('STATUS', 'CL_GEO')],
+        'time_dimension': 'TIME_PERIOD',
+        'primary_measure': 'OBS_VALUE',
+        'query': 'all'
+    }
+    table_meta = SDMXCollectorService.to_table_meta(meta, 'ESTAT', 'foo')
+    assert table_meta['meta'][:4] == [
+        ('GEO', 'VARCHAR(6)'), ('AGE', 'VARCHAR(1)'), ('SEX', 'TEXT'), ('STATUS', 'VARCHAR(8)')]
+
+
+def test_agency_codes(database):
+    codelist = CodelistIndex([
+        ('CL_GEO', 'FR', 'France', 'Geo'),
+        ('CL_GEO', 'DE', 'Germany', 'Geo'),
+        ('CL_AGE', '0', 'Zero', 'Age')
+    ])
+    codes = AgencyCodes(database.codelist, 'INSEE')
+    assert [ref for _, ref in codes.delta('first', codelist)] == [code_ref(r) for r in codelist]
+    # Codelists are claimed by the first dataset of the cycle
+    assert list(codes.delta('second', codelist)) == []
+    codes.stage('first', 'foo')
+    # Hashes are only published once the loader acknowledged the dataset
+    assert AgencyCodes(database.codelist, 'INSEE').load() == {}
+    commit_codes(database.codelist, 'first', 'bar')
+    assert AgencyCodes(database.codelist, 'INSEE').load() == {}
+    commit_codes(database.codelist, 'first', 'foo')
+    assert database.codelist.count_documents({'agency': 'INSEE', 'hash': {'$exists': True}}) == 3
+    assert database.codelist.count_documents({'pending': {'$exists': True}}) == 0
+
+    codes = AgencyCodes(database.codelist, 'INSEE')
+    codelist = CodelistIndex([
+        ('CL_GEO', 'FR', 'France', 'Geo'),
+        ('CL_GEO', 'DE', 'Allemagne', 'Geo'),
+        ('CL_GEO', 'IT', 'Italy', 'Geo')
+    ])
+    assert [row[1] for row, _ in codes.delta('first', codelist)] == ['DE', 'IT']
+    codes.release('first')
+    assert [row[1] for row, _ in codes.delta('second', codelist)] == ['DE', 'IT']
+    assert list(AgencyCodes(database.codelist, 'ESTAT').delta('first', codelist)) != []
+
+
+def test_publish_codelist_delta(database):
+    service = worker_factory(SDMXCollectorService, database=database, updates=StateWriter(), metrics=MetricsRegistry())
+    codelist = [('CL_GEO', g, f'Name {g}', 'Geo') for g in ('FR', 'DE')]
+    mock_sdmx(
+        service, [('GEO', 'CL_GEO')], lambda: codelist,
+        [{'GEO': g, 'time_dimension': '2019', 'obs_value': '1'} for g in ('FR', 'DE')])
+    for resource in ('FIRST', 'SECOND'):
+        database.dataset.insert_one({
+            'agency': 'INSEE', 'resource': resource, 'root_url': 'http://foo.bar', 'version': '2.1',
+            'kind': 'specific', 'keys': {}})
+
+    def published_codes(ack=True):
+        messages = [bson.json_util.loads(c[0][0]) for c in service.pub_input.call_args_list]
+        service.pub_input.reset_mock()
+        if ack:
+            for m in messages:
+                service.update_checksum(m['id'], m['checksum'])
+        return [r['id'] for m in messages for r in m['datastore'][1]['records']]
+
+    assert [r['status'] for r in service.publish()] == ['PUBLISHED', 'PUBLISHED']
+    # Not acknowledged: codes are published again
+    assert published_codes(ack=False) == ['FR', 'DE']
+    service.publish()
+    assert published_codes() == ['FR', 'DE']
+
+    service.publish()
+    assert published_codes() == []
+
+    codelist = [('CL_GEO', 'FR', 'France', 'Geo'), ('CL_GEO', 'DE', 'Name DE', 'Geo')]
+    service.publish()
+    assert published_codes() == ['FR']
+
@@ -0,0 +1,16 @@
+from application.dependencies.spill import RecordSpill
+
+
+def test_record_spill(tmp_path):
+    rows = [{'AGE': str(r), 'obs_value': float(r), 'obs_status': None} for r in range(1050)]
+    with RecordSpill(str(tmp_path), batch_size=500) as spill:
+        spill.extend(rows)
+        assert spill.rows == 1000
+        assert [len(b) for b in spill.batches()] == [500, 500, 50]
+        assert list(spill.records()) == rows
+        assert list(spill.records()) == rows
+        assert spill.rows == 1050 and spill.size > 0
+
+    with RecordSpill(str(tmp_path)) as spill:
+        assert list(spill.batches()) == []
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,93 @@
+from application.services.sdmx_collector import SDMXCollectorService, create_indexes
+from application.dependencies.state import StateWriter
+from application.dependencies.metrics import MetricsRegistry
+from application.tests.test_services import mock_sdmx
+from nameko.testing.services import worker_factory
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, AutoReconnect
+from unittest import mock
+import pytest
+
+
+@pytest.fixture
+def database():
+    client = MongoClient()
+
+    yield client['test_db']
+
+    client.drop_database('test_db')
+    client.close()
+
+
+def test_state_writer(database):
+    database.dataset.insert_many([{'id': str(i), 'count': 0} for i in range(3)])
+    writer = StateWriter(batch_size=4)
+    with mock.patch.object(database.dataset, 'bulk_write', wraps=database.dataset.bulk_write) as bulk_write:
+        for i in range(5):
+            writer.update(database.dataset, {'id': str(i % 3)}, {'$inc': {'count': 1}})
+        assert bulk_write.call_count == 1
+        assert len(writer) == 1
+        writer.flush()
+        assert bulk_write.call_count == 2
+        writer.flush()
+        assert bulk_write.call_count == 2
+    assert [d['count'] for d in database.dataset.find({}, sort=[('id', 1)])] == [2, 2, 1]
+
+
+def test_state_writer_errors():
+    collection = mock.MagicMock()
+    # pymongo 4 collections refuse truth value testing
+    collection.__bool__.side_effect = NotImplementedError
+    writer = StateWriter()
+    for i in range(4):
+        writer.update(collection, {'id': str(i)}, {'$set': {'checksum': 'foo'}})
+
+    collection.bulk_write.side_effect = AutoReconnect('Mongo is down')
+    assert not writer.flush()
+    assert len(writer) == 4
+
+    collection.bulk_write.side_effect = [
+        BulkWriteError({'writeErrors': [{'index': 1, 'errmsg': 'Document too large'}]}), None]
+    assert writer.flush()
+    assert len(writer) == 0
+    assert [len(c[0][0]) for c in collection.bulk_write.call_args_list[1:]] == [4, 2]
+
+
+def test_create_indexes(database):
+    create_indexes(mock.Mock(db=database))
+    assert {'agency_1_resource_1', 'id_1'} <= set(database.dataset.index_information())
+    assert database.codelist.index_information()['agency_1_ref_1']['unique']
+    assert 'pending.dataset_1' in database.codelist.index_information()
+    assert database.series.index_information()['dataset_1_key_1']['unique']
+
+
+def test_publish_round_trips(database):
+    service = worker_factory(
+        SDMXCollectorService, database=database, updates=StateWriter(), metrics=MetricsRegistry())
+    mock_sdmx(
+        service, [('GEO', 'CL_GEO')], [('CL_GEO', 'FR', 'France', 'Geo')],
+        [{'GEO': 'FR', 'time_dimension': '2019', 'obs_value': '1'}])
+    service.config = {'PUBLISH': {'chunked': True, 'series_delta': True}}
+    for i in range(5):
+        database.dataset.insert_one({
+            'id': f'insee_df{i}', 'agency': 'INSEE', 'resource': f'DF{i}', 'root_url': 'http://foo.bar',
+            'version': '2.1', 'kind': 'specific', 'keys': {}, 'checksum': 'foo'})
+        database.series.insert_one({'dataset': f'insee_df{i}', 'key': 'FR', 'digest': 'bar', 'checksum': 'foo'})
+
+    with mock.patch.object(service, 'find_dataset', side_effect=AssertionError('One query per dataset')):
+        with mock.patch.object(
+                database.dataset, 'bulk_write', wraps=database.dataset.bulk_write) as bulk_write:
+            report = service.publish()
+    assert [r['status'] for r in report] == ['PUBLISHED'] * 5
+    # Incremental state and published sizes of every dataset at once
+    assert bulk_write.call_count == 1
+    assert len(bulk_write.call_args[0][0]) == 10
+
+    # Acknowledgements are queued as well, reads flush them first
+    checksum = database.series.find_one({'dataset': 'insee_df0'})['pending']['checksum']
+    service.update_checksum('insee_df0', checksum)
+    assert len(service.updates) == 1
+    assert service.find_dataset({'id': 'insee_df0'})['checksum'] == checksum
+    assert service.get_series_digests('insee_df0') == {'FR': mock.ANY}
+    assert service.get_series_digests('insee_df0')['FR'] != 'bar'
+    assert service.get_series_digests('insee_df1') == {'FR': 'bar'}
@@ -0,0 +1,119 @@
+"""Bytes transferred and parse time of the three data wire formats.
+
+The same synthetic flow is rendered as structure specific XML, SDMX-JSON and
+SDMX-CSV, then parsed into series blocks by SDMXML. Sizes are given raw and
+gzipped, the latter being what goes over the wire with compression on.
+
+    python -m benchmarks.bench_data_formats
+"""
+import gzip
+import json
+import time
+
+from application.dependencies.sdmx import SDMXML
+
+SERIES = 2000
+OBSERVATIONS = 100
+RUNS = 3
+
+GEOS = [f'G{s}' for s in range(SERIES)]
+PERIODS = [str(1900 + t) for t in range(OBSERVATIONS)]
+
+DSD = {
+    'dimensions': [('FREQ', 'CL_FREQ'), ('GEO', 'CL_GEO'), ('UNIT', 'CL_UNIT')],
+    'attributes': [('OBS_STATUS', 'CL_OBS_STATUS')],
+    'time_dimension': 'TIME_PERIOD',
+    'primary_measure': 'OBS_VALUE'
+}
+
+
+def value(s, t):
+    return f'{s * t / 7:.3f}'
+
+
+def status(s, t):
+    return 'p' if t % 10 == 0 else None
+
+
+def xml_message():
+    def obs(s, t):
+        st = status(s, t)
+        attribute = f' OBS_STATUS="{st}"' if st else ''
+        return f'<Obs TIME_PERIOD="{PERIODS[t]}" OBS_VALUE="{value(s, t)}"{attribute}/>'
+
+    series = ''.join(
+        f'<Series FREQ="A" GEO="{g}" UNIT="MIO_EUR">{"".join(obs(s, t) for t in range(OBSERVATIONS))}</Series>'
+        for s, g in enumerate(GEOS))
+    return (
+        '<message:StructureSpecificData '
+        'xmlns:message="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message">'
+        f'<message:DataSet>{series}</message:DataSet></message:StructureSpecificData>').encode('utf-8')
+
+
+def csv_message():
+    lines = ['DATAFLOW,FREQ,GEO,UNIT,TIME_PERIOD,OBS_VALUE,OBS_STATUS']
+    lines.extend(
+        f'ESTAT:FOO(1.0),A,{g},MIO_EUR,{PERIODS[t]},{value(s, t)},{status(s, t) or ""}'
+        for s, g in enumerate(GEOS) for t in range(OBSERVATIONS))
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def json_message():
+    def obs(s, t):
+        return [float(value(s, t)), 0 if status(s, t) else None]
+
+    return json.dumps({
+        'structure': {
+            'dimensions': {
+                'series': [
+                    {'id': 'FREQ', 'values': [{'id': 'A'}]},
+                    {'id': 'GEO', 'values': [{'id': g} for g in GEOS]},
+                    {'id': 'UNIT', 'values': [{'id': 'MIO_EUR'}]}],
+                'observation': [{'id': 'TIME_PERIOD', 'values': [{'id': p} for p in PERIODS]}]
+            },
+            'attributes': {'observation': [{'id': 'OBS_STATUS', 'values': [{'id': 'p'}]}]}
+        },
+        'dataSets': [{'series': {
+            f'0:{s}:0': {'observations': {str(t): obs(s, t) for t in range(OBSERVATIONS)}}
+            for s in range(SERIES)}}]
+    }, separators=(',', ':')).encode('utf-8')
+
+
+class FixtureResponse(object):
+
+    def __init__(self, content, content_type):
+        self.content = content
+        self.headers = {'Content-Type': content_type}
+
+    def iter_content(self, chunk_size=None):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def parse(content, content_type):
+    req = SDMXML('http://foo.bar', 'ESTAT', '2.1', 'specific')
+    blocks = req._observations(FixtureResponse(content, content_type), DSD).series()
+    return sum(len(b) for b in blocks)
+
+
+def main():
+    formats = (
+        ('structure specific XML', xml_message(), 'application/vnd.sdmx.structurespecificdata+xml;version=2.1'),
+        ('SDMX-JSON', json_message(), 'application/vnd.sdmx.data+json;version=1.0.0'),
+        ('SDMX-CSV', csv_message(), 'application/vnd.sdmx.data+csv;version=1.0.0'))
+    for label, content, content_type in formats:
+        best = None
+        for _ in range(RUNS):
+            start = time.perf_counter()
+            assert parse(content, content_type) == SERIES * OBSERVATIONS
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f'{label:<24} raw {len(content) / 1024:9.0f} KiB  gzip {len(gzip.compress(content)) / 1024:7.0f} KiB'
+              f'  parse {best * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
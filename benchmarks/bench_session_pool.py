@@ -0,0 +1,52 @@
+"""Compare bare requests.get with the pooled SDMX session against a local stub server.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_session_pool
+"""
+import time
+from unittest import mock
+
+from nameko.testing.services import worker_factory
+
+from application.dependencies.sdmx import SDMXWrapper, build_session, sdmx_request
+from application.services.sdmx_collector import SDMXCollectorService
+from application.cassettes import CASSETTE_DIR, StubServer, cassette_routes
+
+REQUESTS = 500
+RUNS = 20
+
+
+def requests_per_second(server, session):
+    url = f'{server.url}/series/sdmx/dataflow/FR1/CHOMAGE-TRIM-NATIONAL'
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        sdmx_request(url, session=session)
+    return REQUESTS / (time.perf_counter() - start)
+
+
+def get_dataset_latency(server, session):
+    server.routes = cassette_routes(f'{CASSETTE_DIR}/FR1/data.yaml', f'{CASSETTE_DIR}/FR1/dataflow.yaml')
+    database = mock.MagicMock()
+    database['dataset'].find_one.return_value = None
+    timings = []
+    for _ in range(RUNS):
+        service = worker_factory(SDMXCollectorService, sdmx=SDMXWrapper(session=session), database=database)
+        start = time.perf_counter()
+        service.get_dataset(f'{server.url}/series/sdmx', 'FR1', 'CHOMAGE-TRIM-NATIONAL', '2.1', 'specific', {})
+        timings.append(time.perf_counter() - start)
+    return sum(timings) / len(timings)
+
+
+def main():
+    for label, session_factory in (('bare requests.get', lambda: None), ('pooled session', build_session)):
+        with StubServer(cassette_routes(f'{CASSETTE_DIR}/FR1/dataflow_chomage.yaml')) as server:
+            session = session_factory()
+            rps = requests_per_second(server, session)
+            latency = get_dataset_latency(server, session)
+            print(f'{label:<20} {rps:10.1f} req/s  get_dataset {latency * 1000:8.1f} ms'
+                  f'  ({server.connections} TCP connections for {server.requests} requests)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Microbenchmark of the structure parsers on large synthetic messages.
+
+Compares the compiled XPath / direct traversal parsers of SDMXML with the
+per-node f-string XPath evaluation they replaced.
+
+    python -m benchmarks.bench_structure_parsers
+"""
+import time
+import itertools
+
+from lxml import etree
+
+from application.dependencies.sdmx import SDMXML
+
+CODES = 10000
+DATAFLOWS = 10000
+RUNS = 3
+
+MES = 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message'
+STR = 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure'
+COM = 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common'
+
+
+def names(text):
+    return ''.join(
+        f'<com:Name xml:lang="{lang}">{text} ({lang})</com:Name>' for lang in ('fr', 'de', 'en'))
+
+
+def structure_message(structures):
+    return etree.fromstring((
+        f'<mes:Structure xmlns:mes="{MES}" xmlns:str="{STR}" xmlns:com="{COM}">'
+        f'<mes:Structures>{structures}</mes:Structures></mes:Structure>').encode('utf-8'))
+
+
+def codelist_message():
+    codes = ''.join(f'<str:Code id="C{i}">{names(f"Code {i}")}</str:Code>' for i in range(CODES))
+    return structure_message(
+        f'<str:Codelists><str:Codelist id="CL_GEO">{names("Geo")}{codes}</str:Codelist></str:Codelists>')
+
+
+def dataflow_message():
+    dataflows = ''.join(
+        f'<str:Dataflow id="DF{i}">{names(f"Dataflow {i}")}'
+        f'<str:Structure><Ref id="DSD{i}" agencyID="ESTAT"/></str:Structure></str:Dataflow>'
+        for i in range(DATAFLOWS))
+    return structure_message(f'<str:Dataflows>{dataflows}</str:Dataflows>')
+
+
+def legacy_codelist(req, tree):
+    ns = req.structure_namespaces
+
+    def handle_codelist(node):
+        id_ = node.attrib['id']
+
+        def handle_code(code):
+            return (
+                id_,
+                code.attrib['id'],
+                node.xpath(f'./{req.com_prefix}:Name[@xml:lang="en"][1]', namespaces=ns)[0].text,
+                code.xpath(f'./{req.com_prefix}:Name[@xml:lang="en"][1]', namespaces=ns)[0].text
+            )
+        return [handle_code(c) for c in node.xpath(f'./{req.str_prefix}:Code', namespaces=ns)]
+
+    return list(itertools.chain.from_iterable(
+        [handle_codelist(n) for n in tree.xpath(f'.//{req.str_prefix}:Codelist', namespaces=ns)]))
+
+
+def legacy_dataflow(req, tree):
+    ns = req.structure_namespaces
+
+    def build_dataflow(node):
+        name = node.xpath(f'./{req.com_prefix}:Name[@xml:lang="en"]', namespaces=ns)
+        structures = node.xpath(f'./{req.str_prefix}:Structure/Ref[1]', namespaces=ns)
+        return {
+            'id': node.attrib['id'],
+            'name': name[0].text if name else None,
+            'structure': {
+                'id': structures[0].attrib['id'],
+                'agency_id': structures[0].attrib['agencyID']
+            }
+        }
+
+    return [build_dataflow(n) for n in tree.xpath(f'//{req.str_prefix}:Dataflow', namespaces=ns)]
+
+
+def best_of(fn, *args):
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    req = SDMXML('http://foo.bar', 'ESTAT', '2.1', 'specific')
+    cases = (
+        (f'codelist ({CODES} codes)', codelist_message(), legacy_codelist, req._codelistv21),
+        (f'dataflows ({DATAFLOWS} flows)', dataflow_message(), legacy_dataflow, req._build_dataflow))
+    for label, tree, legacy, current in cases:
+        legacy_time, expected = best_of(legacy, req, tree)
+        current_time, result = best_of(current, tree)
+        assert result == expected
+        print(f'{label:<26} legacy {legacy_time * 1000:9.1f} ms  compiled {current_time * 1000:9.1f} ms'
+              f'  speedup x{legacy_time / current_time:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""Offline benchmark suite of the collector stages.
+
+Every case is served from localhost by StubServer: recorded cassettes of
+the tests on one side, synthetic flows (10k codes, 1M observations at scale
+1) for each supported version and data kind on the other. For each case the
+suite times
+
+    dataflow     SDMXML.dataflows (_build_dataflow)
+    dsd          data structure only (_dsdv21 / _dsdilo)
+    codelist     codelists of the structure (_codelistv21 / _codelistilo)
+    data         every observation of the flow (_data)
+    get_dataset  SDMXCollectorService.get_dataset, structures and rows
+
+and reports latency percentiles over the runs, throughput (items per second
+at the median) and peak memory. Peak memory is traced by tracemalloc in an
+extra run, so it covers Python allocations only, not libxml2 buffers.
+
+Results can be saved as a baseline and later runs compared against it:
+
+    python -m benchmarks.suite --scale 0.1 --save
+    python -m benchmarks.suite --scale 0.1 --compare benchmarks/baselines/<commit>.json
+
+The comparison exits with status 1 when a median latency or a peak memory
+grew beyond ``--tolerance``.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import fnmatch
+import subprocess
+import tracemalloc
+from urllib.parse import urlsplit
+from unittest import mock
+
+from nameko.testing.services import worker_factory
+
+from application.dependencies.sdmx import SDMXML, SDMXWrapper, build_session
+from application.services.sdmx_collector import SDMXCollectorService
+from benchmarks import synthetic
+from application.cassettes import CASSETTE_DIR, StubServer, cassette_routes
+
+BASELINE_DIR = 'benchmarks/baselines'
+STAGES = ('dataflow', 'dsd', 'codelist', 'data', 'get_dataset')
+PERCENTILES = (50, 90, 99)
+
+RECORDED = (
+    {
+        'name': 'recorded/FR1',
+        'root_url': 'https://bdm.insee.fr/series/sdmx', 'agency': 'FR1', 'resource': 'CHOMAGE-TRIM-NATIONAL',
+        'version': '2.1', 'kind': 'specific', 'keys': {},
+        'cassettes': ('FR1/data.yaml', 'FR1/dataflow.yaml')
+    },
+    {
+        'name': 'recorded/ESTAT',
+        'root_url': 'http://ec.europa.eu/eurostat/SDMX/diss-web/rest', 'agency': 'ESTAT', 'resource': 'nama_10_gdp',
+        'version': '2.1', 'kind': 'specific',
+        'keys': {'FREQ': 'A', 'GEO': 'FR', 'UNIT': 'CLV10_MEUR', 'NA_ITEM': 'B1GQ'},
+        'cassettes': ('ESTAT/data.yaml', 'ESTAT/dataflow.yaml')
+    },
+    {
+        'name': 'recorded/ILO',
+        'root_url': 'https://www.ilo.org/sdmx/rest', 'agency': 'ILO', 'resource': 'DF_YI_ALL_EMP_TEMP_SEX_AGE_NB',
+        'version': '2.1', 'kind': 'specific', 'keys': {'SEX': 'SEX_T', 'AGE': 'AGE_5YRBANDS_TOTAL'},
+        'cassettes': ('ILO/data.yaml', 'ILO/dataflow_std.yaml')
+    }
+)
+
+SYNTHETIC = (('2.1', 'specific'), ('2.1', 'generic'), ('ilo', 'specific'))
+
+
+def recorded_cases():
+    for case in RECORDED:
+        yield case, cassette_routes(*(f'{CASSETTE_DIR}/{cassette}' for cassette in case['cassettes']))
+
+
+def synthetic_cases(scale):
+    sizes = {
+        'codes': max(int(10000 * scale), 10),
+        'dataflows': max(int(10000 * scale), 1),
+        'series': max(int(10000 * scale), 1),
+        'observations': 100
+    }
+    for version, kind in SYNTHETIC:
+        case = {
+            'name': f'synthetic/{version}/{kind}',
+            'root_url': '/synthetic', 'agency': synthetic.AGENCY, 'resource': synthetic.RESOURCE,
+            'version': version, 'kind': kind, 'keys': {}
+        }
+        yield case, lambda version=version, kind=kind: synthetic.routes('/synthetic', version, kind, **sizes)
+
+
+def percentile(timings, p):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))]
+
+
+def measure(fn, runs, memory=True):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        items = fn()
+        timings.append(time.perf_counter() - start)
+    result = {
+        'runs': runs,
+        'items': items,
+        'min': min(timings),
+        'max': max(timings),
+        **{f'p{p}': percentile(timings, p) for p in PERCENTILES}
+    }
+    result['throughput'] = items / result['p50'] if result['p50'] else None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def stages(case, root_url, session):
+    def client():
+        return SDMXML(root_url, case['agency'], case['version'], case['kind'], session=session)
+
+    req = client()
+    dataflow = req.dataflow(case['resource'])
+    structure = req._structure('datastructure', dataflow['structure']['id'], req._parse_dsd)
+    dsd = req.dsd(dataflow['structure']['id'])
+    query = req._dict_to_smdx_query(dsd['dimensions'], case['keys'])
+    database = mock.MagicMock()
+    database['dataset'].find_one.return_value = None
+
+    def get_dataflows():
+        return len(client().dataflows())
+
+    def get_dsd():
+        req = client()
+        return len(req._structure('datastructure', dataflow['structure']['id'], req._parse_dsd)['dimensions'])
+
+    def get_codelist():
+        if structure['codelist']:
+            req = client()
+            return len(req._structure('datastructure', dataflow['structure']['id'], req._parse_dsd)['codelist'])
+        return len(client()._fetch_codelists(dsd['dimensions'], dsd['attributes']))
+
+    def get_data():
+        return sum(len(block) for block in client()._data(case['resource'], dsd, query).series())
+
+    def get_dataset():
+        service = worker_factory(SDMXCollectorService, sdmx=SDMXWrapper(session=session), database=database)
+        dataset = service.get_dataset(
+            root_url, case['agency'], case['resource'], case['version'], case['kind'], case['keys'])
+        return len(dataset['datastore'][0]['records'])
+
+    return {
+        'dataflow': get_dataflows,
+        'dsd': get_dsd,
+        'codelist': get_codelist,
+        'data': get_data,
+        'get_dataset': get_dataset
+    }
+
+
+def run_case(case, routes, selected, runs, memory):
+    with StubServer(routes) as server:
+        session = build_session()
+        fns = stages(case, server.url + urlsplit(case['root_url']).path, session)
+        return {stage: measure(fns[stage], runs, memory) for stage in STAGES if stage in selected}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+    print(f'{"case":<26} {"stage":<12} {"items":>9} {"p50 ms":>10} {"p90 ms":>10} {"p99 ms":>10}'
+          f' {"items/s":>12} {"peak MiB":>9}')
+    for name, case in results.items():
+        for stage, r in case.items():
+            peak = f'{r["peak_memory"] / 2 ** 20:9.1f}' if 'peak_memory' in r else f'{"-":>9}'
+            print(f'{name:<26} {stage:<12} {r["items"]:>9} {r["p50"] * 1000:10.1f} {r["p90"] * 1000:10.1f}'
+                  f' {r["p99"] * 1000:10.1f} {r["throughput"] or 0:12.0f} {peak}')
+
+
+def compare(results, baseline, tolerance):
+    """Prints median latency and peak memory changes, returns the regressions."""
+    regressions = []
+    print(f'\nCompared with {baseline["commit"]} (tolerance {tolerance:.0%})')
+    for name, case in results.items():
+        for stage, r in case.items():
+            base = baseline['results'].get(name, {}).get(stage, None)
+            if base is None:
+                continue
+            changes = [('p50', r['p50'] / base['p50'] - 1)]
+            if r.get('peak_memory') and base.get('peak_memory'):
+                changes.append(('peak', r['peak_memory'] / base['peak_memory'] - 1))
+            flagged = [metric for metric, change in changes if change > tolerance]
+            regressions.extend((name, stage, metric) for metric in flagged)
+            print(f'{name:<26} {stage:<12} ' + '  '.join(f'{m} {c:+7.1%}' for m, c in changes)
+                  + ('  REGRESSION' if flagged else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cases', nargs='*', default=['*'], help='case name patterns, e.g. "synthetic/*"')
+    parser.add_argument('--stages', nargs='*', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0, help='size of the synthetic flows, 1 for 1M observations')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip the tracemalloc run')
+    parser.add_argument('--save', nargs='?', const='', help='save results as a baseline (default: <commit>.json)')
+    parser.add_argument('--compare', help='baseline file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    args = parser.parse_args(argv)
+
+    def selected(name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in args.cases)
+
+    results = {}
+    for case, routes in (*recorded_cases(), *synthetic_cases(args.scale)):
+        if not selected(case['name']):
+            continue
+        results[case['name']] = run_case(
+            case, routes() if callable(routes) else routes, args.stages, args.runs, args.memory)
+    report(results)
+
+    commit = git_commit()
+    if args.save is not None:
+        path = args.save or os.path.join(BASELINE_DIR, f'{commit or "baseline"}.json')
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({
+                'commit': commit,
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'scale': args.scale,
+                'runs': args.runs,
+                'results': results
+            }, f, indent=2)
+        print(f'\nBaseline saved to {path}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('scale', None) != args.scale:
+            print(f'\nWarning: baseline scale {baseline.get("scale", None)} differs from {args.scale}')
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
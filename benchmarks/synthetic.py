@@ -0,0 +1,201 @@
+"""Synthetic SDMX messages of arbitrary size, served like recorded ones.
+
+``routes(version, kind, ...)`` renders the dataflows, data structure,
+codelists and data of one fictitious flow as StubServer routes. SDMX 2.1
+flows come as structure specific or generic data; ILO (SDMX 2.0) structures
+are paired with structure specific data, the only data kind the ILO version
+is used with.
+"""
+from urllib.parse import urlsplit
+
+from application.dependencies.sdmx import SDMXML
+
+AGENCY = 'SYN'
+RESOURCE = 'DF_SYN'
+DSD_ID = 'DSD_SYN'
+
+V21_STRUCTURE = (
+    'xmlns:mes="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message" '
+    'xmlns:str="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure" '
+    'xmlns:com="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common"')
+ILO_STRUCTURE = (
+    'xmlns:mes="http://www.SDMX.org/resources/SDMXML/schemas/v2_0/message" '
+    'xmlns:str="http://www.SDMX.org/resources/SDMXML/schemas/v2_0/structure"')
+V21_MESSAGE = 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message'
+V21_GENERIC = 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/data/generic'
+
+CONTENT_TYPES = {
+    'structure': 'application/vnd.sdmx.structure+xml; version=2.1',
+    'ilo': 'application/xml',
+    'specific': 'application/vnd.sdmx.structurespecificdata+xml; version=2.1',
+    'generic': 'application/vnd.sdmx.genericdata+xml; version=2.1'
+}
+
+# Four dimensions: an empty key of three would be the dot segment '..' of the URL path
+DIMENSIONS = (('FREQ', 'CL_FREQ'), ('GEO', 'CL_GEO'), ('UNIT', 'CL_UNIT'), ('NA_ITEM', 'CL_NA_ITEM'))
+ATTRIBUTES = (('OBS_STATUS', 'CL_OBS_STATUS'),)
+TIME_DIMENSION = 'TIME_PERIOD'
+PRIMARY_MEASURE = 'OBS_VALUE'
+SMALL_CODELISTS = {'CL_FREQ': ['A'], 'CL_UNIT': ['MIO_EUR'], 'CL_NA_ITEM': ['B1GQ'], 'CL_OBS_STATUS': ['p', 'e']}
+
+
+def codelists(codes):
+    """``codes`` codes in all, most of them in CL_GEO."""
+    geo = max(codes - sum(len(c) for c in SMALL_CODELISTS.values()), 1)
+    return {**SMALL_CODELISTS, 'CL_GEO': [f'G{i}' for i in range(geo)]}
+
+
+def names(text, tag='com:Name'):
+    return ''.join(f'<{tag} xml:lang="{lang}">{text} ({lang})</{tag}>' for lang in ('fr', 'en'))
+
+
+def v21_structure(structures):
+    return f'<mes:Structure {V21_STRUCTURE}><mes:Structures>{structures}</mes:Structures></mes:Structure>'
+
+
+def ilo_structure(structures):
+    return f'<mes:Structure {ILO_STRUCTURE}>{structures}</mes:Structure>'
+
+
+def v21_dataflows(dataflows):
+    flows = ''.join(
+        f'<str:Dataflow id="{id_}">{names(f"Dataflow {id_}")}'
+        f'<str:Structure><Ref id="{DSD_ID}" agencyID="{AGENCY}"/></str:Structure></str:Dataflow>'
+        for id_ in dataflows)
+    return v21_structure(f'<str:Dataflows>{flows}</str:Dataflows>')
+
+
+def ilo_dataflows(dataflows):
+    flows = ''.join(
+        f'<str:Dataflow id="{id_}">{names(f"Dataflow {id_}", "str:Name")}<str:KeyFamilyRef>'
+        f'<str:KeyFamilyID>{DSD_ID}</str:KeyFamilyID><str:KeyFamilyAgencyID>{AGENCY}</str:KeyFamilyAgencyID>'
+        f'</str:KeyFamilyRef></str:Dataflow>'
+        for id_ in dataflows)
+    return ilo_structure(f'<mes:Dataflows>{flows}</mes:Dataflows>')
+
+
+def v21_dsd():
+    def component(tag, id_, codelist):
+        return (
+            f'<str:{tag} id="{id_}"><str:LocalRepresentation><str:Enumeration><Ref id="{codelist}"/>'
+            f'</str:Enumeration></str:LocalRepresentation></str:{tag}>')
+
+    dimensions = ''.join(component('Dimension', *d) for d in DIMENSIONS)
+    attributes = ''.join(component('Attribute', *a) for a in ATTRIBUTES)
+    return v21_structure(
+        f'<str:DataStructures><str:DataStructure id="{DSD_ID}" agencyID="{AGENCY}">{names("Synthetic")}'
+        f'<str:DataStructureComponents>'
+        f'<str:DimensionList>{dimensions}<str:TimeDimension id="{TIME_DIMENSION}"/></str:DimensionList>'
+        f'<str:AttributeList>{attributes}</str:AttributeList>'
+        f'<str:MeasureList><str:PrimaryMeasure id="{PRIMARY_MEASURE}"/></str:MeasureList>'
+        f'</str:DataStructureComponents></str:DataStructure></str:DataStructures>')
+
+
+def ilo_dsd():
+    dimensions = ''.join(f'<str:Dimension conceptRef="{d}" codelist="{c}"/>' for d, c in DIMENSIONS)
+    attributes = ''.join(f'<str:Attribute conceptRef="{a}" codelist="{c}"/>' for a, c in ATTRIBUTES)
+    return ilo_structure(
+        f'<mes:KeyFamilies><str:KeyFamily id="{DSD_ID}" agencyID="{AGENCY}">{names("Synthetic", "str:Name")}'
+        f'<str:Components>{dimensions}<str:TimeDimension conceptRef="{TIME_DIMENSION}"/>'
+        f'<str:PrimaryMeasure conceptRef="{PRIMARY_MEASURE}"/>{attributes}</str:Components>'
+        f'</str:KeyFamily></mes:KeyFamilies>')
+
+
+def v21_codelist(id_, codes):
+    codes = ''.join(f'<str:Code id="{c}">{names(f"Code {c}")}</str:Code>' for c in codes)
+    return v21_structure(f'<str:Codelists><str:Codelist id="{id_}">{names(id_)}{codes}</str:Codelist></str:Codelists>')
+
+
+def ilo_codelist(id_, codes):
+    codes = ''.join(
+        f'<str:Code value="{c}">{names(f"Code {c}", "str:Description")}</str:Code>' for c in codes)
+    return ilo_structure(
+        f'<mes:CodeLists><str:CodeList id="{id_}">{names(id_, "str:Name")}{codes}</str:CodeList></mes:CodeLists>')
+
+
+def periods(observations):
+    return [str(1000 + t) for t in range(observations)]
+
+
+def value(s, t):
+    return f'{s * t / 7:.3f}'
+
+
+def status(s, t):
+    return 'p' if t % 10 == 0 else None
+
+
+def specific_data(geos, observations):
+    times = periods(observations)
+
+    def obs(s, t):
+        st = status(s, t)
+        attribute = f' OBS_STATUS="{st}"' if st else ''
+        return f'<Obs TIME_PERIOD="{times[t]}" OBS_VALUE="{value(s, t)}"{attribute}/>'
+
+    series = (
+        f'<Series FREQ="A" GEO="{g}" UNIT="MIO_EUR" NA_ITEM="B1GQ">'
+        f'{"".join(obs(s, t) for t in range(observations))}</Series>'
+        for s, g in enumerate(geos))
+    return ''.join((
+        f'<message:StructureSpecificData xmlns:message="{V21_MESSAGE}"><message:DataSet>', *series,
+        '</message:DataSet></message:StructureSpecificData>'))
+
+
+def generic_data(geos, observations):
+    times = periods(observations)
+
+    def obs(s, t):
+        st = status(s, t)
+        attributes = (
+            f'<generic:Attributes><generic:Value id="OBS_STATUS" value="{st}"/></generic:Attributes>' if st else '')
+        return (
+            f'<generic:Obs><generic:ObsDimension value="{times[t]}"/>'
+            f'<generic:ObsValue value="{value(s, t)}"/>{attributes}</generic:Obs>')
+
+    def key(g):
+        values = (('FREQ', 'A'), ('GEO', g), ('UNIT', 'MIO_EUR'), ('NA_ITEM', 'B1GQ'))
+        return ''.join(f'<generic:Value id="{d}" value="{v}"/>' for d, v in values)
+
+    series = (
+        f'<generic:Series><generic:SeriesKey>{key(g)}</generic:SeriesKey>'
+        f'{"".join(obs(s, t) for t in range(observations))}</generic:Series>'
+        for s, g in enumerate(geos))
+    return ''.join((
+        f'<message:GenericData xmlns:message="{V21_MESSAGE}" xmlns:generic="{V21_GENERIC}"><message:DataSet>',
+        *series, '</message:DataSet></message:GenericData>'))
+
+
+def routes(root_url, version, kind, codes=10000, dataflows=10000, series=10000, observations=100):
+    """StubServer routes of a flow ``RESOURCE`` with ``series * observations`` observations.
+
+    ``root_url`` is the URL the SDMXML client is given, only its path
+    matters. Series are one per CL_GEO code, cycling if there are fewer codes.
+    """
+    req = SDMXML(root_url, AGENCY, version, kind)
+    structure_type = CONTENT_TYPES['structure' if version == '2.1' else 'ilo']
+    if version == '2.1':
+        dataflow, dsd, codelist = v21_dataflows, v21_dsd, v21_codelist
+    else:
+        dataflow, dsd, codelist = ilo_dataflows, ilo_dsd, ilo_codelist
+
+    def path(url):
+        return urlsplit(url).path
+
+    def structure(body):
+        return 200, {'Content-Type': structure_type}, body.encode('utf-8')
+
+    lists = codelists(codes)
+    flows = [RESOURCE] + [f'DF{i}' for i in range(dataflows - 1)]
+    geos = [lists['CL_GEO'][s % len(lists['CL_GEO'])] for s in range(series)]
+    data = specific_data if kind == 'specific' else generic_data
+    result = {
+        path(req._structure_url('dataflow', None)): structure(dataflow(flows)),
+        path(req._structure_url('dataflow', RESOURCE)): structure(dataflow([RESOURCE])),
+        path(req._structure_url('datastructure', DSD_ID)): structure(dsd()),
+        path(req._data_url(RESOURCE, req._dict_to_smdx_query(DIMENSIONS, {}))): (
+            200, {'Content-Type': CONTENT_TYPES[kind]}, data(geos, observations).encode('utf-8'))
+    }
+    for id_, list_codes in lists.items():
+        result[path(req._structure_url('codelist', id_))] = structure(codelist(id_, list_codes))
+    return result